@@ -0,0 +1,66 @@
+"""Carga masiva con COPY ... FROM STDIN a través de una tabla temporal.
+
+Para backfills, donde el coste por fila de los INSERT parametrizados domina: las filas
+se vuelcan en formato texto a una tabla de staging con los mismos tipos que la tabla
+destino y se pasan con un único INSERT ... SELECT (con el ON CONFLICT que toque).
+"""
+from __future__ import annotations
+
+import io
+import json
+from typing import Any, Iterable, Mapping, Sequence
+
+
+def copy_field(value: Any) -> str:
+    """Serializa un valor al formato texto de COPY (NULL como \\N, escapando separadores)."""
+    if value is None:
+        return "\\N"
+    if isinstance(value, (dict, list)):
+        value = json.dumps(value)
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def copy_insert(
+    conn,
+    table: str,
+    columns: Sequence[str],
+    rows: Iterable[Mapping[str, Any]],
+    on_conflict: str = "",
+) -> int:
+    """COPY de `rows` a {table}_stage (ON COMMIT DROP) e INSERT ... SELECT en `table`.
+
+    `conn` es una Connection de SQLAlchemy dentro de una transacción; `on_conflict` se
+    añade tal cual al INSERT (p.ej. "ON CONFLICT ON CONSTRAINT uq DO NOTHING").
+    Devuelve las filas insertadas o actualizadas según el rowcount del INSERT.
+    """
+    cols = ", ".join(columns)
+    stage = f"{table}_stage"
+    buf = io.StringIO()
+    for row in rows:
+        buf.write("\t".join(copy_field(row[c]) for c in columns))
+        buf.write("\n")
+    buf.seek(0)
+    cur = conn.connection.cursor()
+    try:
+        cur.execute(f"DROP TABLE IF EXISTS {stage}")
+        cur.execute(
+            f"CREATE TEMP TABLE {stage} ON COMMIT DROP AS "
+            f"SELECT {cols} FROM {table} WITH NO DATA"
+        )
+        copy_sql = f"COPY {stage} ({cols}) FROM STDIN"
+        if hasattr(cur, "copy_expert"):
+            cur.copy_expert(copy_sql, buf)
+        else:
+            # psycopg 3
+            with cur.copy(copy_sql) as cp:
+                cp.write(buf.getvalue())
+        cur.execute(f"INSERT INTO {table} ({cols}) SELECT {cols} FROM {stage} {on_conflict}")
+        return cur.rowcount
+    finally:
+        cur.close()
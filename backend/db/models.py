@@ -24,6 +24,13 @@ from .config import Base
 
 SourceEnum = Enum("stripe", "hotmart", "kajabi", name="source_enum")
 
+# Default en servidor para created_at/updated_at: UTC naive, igual que el antiguo datetime.utcnow
+UTC_NOW = text("timezone('utc', now())")
+
+
+# Las relaciones usan lazy="raise": navegar una relación no cargada falla en lugar de lanzar
+# una SELECT por fila (N+1). Cargarlas explícitamente con selectinload/joinedload.
+
 
 class Customer(Base):
     __tablename__ = "customers"
@@ -33,7 +40,7 @@ class Customer(Base):
     source_id: Mapped[str] = mapped_column(String(255), nullable=False)
     email: Mapped[Optional[str]] = mapped_column(String(320))
     country: Mapped[Optional[str]] = mapped_column(String(2))
-    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime, server_default=UTC_NOW, nullable=False)
 
     __table_args__ = (
         UniqueConstraint("source", "source_id", name="uq_customer_source_id"),
@@ -50,7 +57,7 @@ class Product(Base):
     sku: Mapped[Optional[str]] = mapped_column(String(255))
     currency_default: Mapped[Optional[str]] = mapped_column(String(3))
     price_standard: Mapped[Optional[float]] = mapped_column(Numeric(18, 2))
-    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime, server_default=UTC_NOW, nullable=False)
 
     __table_args__ = (
         UniqueConstraint("source", "source_id", name="uq_product_source_id"),
@@ -65,9 +72,9 @@ class Order(Base):
     source_id: Mapped[str] = mapped_column(String(255), nullable=False)
     customer_id: Mapped[Optional[int]] = mapped_column(ForeignKey("customers.id"))
     status: Mapped[Optional[str]] = mapped_column(String(50))
-    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime, server_default=UTC_NOW, nullable=False)
 
-    customer: Mapped[Optional[Customer]] = relationship("Customer")
+    customer: Mapped[Optional[Customer]] = relationship("Customer", lazy="raise")
 
     __table_args__ = (
         UniqueConstraint("source", "source_id", name="uq_order_source_id"),
@@ -86,8 +93,8 @@ class OrderItem(Base):
     currency_original: Mapped[Optional[str]] = mapped_column(String(3))
     unit_price_eur: Mapped[Optional[float]] = mapped_column(Numeric(18, 2))
 
-    order: Mapped[Order] = relationship("Order")
-    product: Mapped[Optional[Product]] = relationship("Product")
+    order: Mapped[Order] = relationship("Order", lazy="raise")
+    product: Mapped[Optional[Product]] = relationship("Product", lazy="raise")
 
 
 class Payment(Base):
@@ -106,7 +113,8 @@ class Payment(Base):
     paid_at: Mapped[Optional[datetime]] = mapped_column(DateTime)
     raw: Mapped[Optional[dict]] = mapped_column(JSONB)
 
-    order: Mapped[Optional[Order]] = relationship("Order")
+    order: Mapped[Optional[Order]] = relationship("Order", lazy="raise")
+    refunds: Mapped[list["Refund"]] = relationship("Refund", back_populates="payment", lazy="raise")
 
     __table_args__ = (
         UniqueConstraint("source", "source_payment_id", name="uq_payment_source_id"),
@@ -126,7 +134,7 @@ class Refund(Base):
     refunded_at: Mapped[Optional[datetime]] = mapped_column(DateTime)
     raw: Mapped[Optional[dict]] = mapped_column(JSONB)
 
-    payment: Mapped[Payment] = relationship("Payment")
+    payment: Mapped[Payment] = relationship("Payment", back_populates="refunds", lazy="raise")
 
 
 class SyncState(Base):
@@ -135,7 +143,7 @@ class SyncState(Base):
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     key: Mapped[str] = mapped_column(String(100), unique=True, nullable=False)
     value: Mapped[str] = mapped_column(Text, nullable=False)
-    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, nullable=False)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, server_default=UTC_NOW, nullable=False)
 
 
 
@@ -153,9 +161,9 @@ class Subscription(Base):
     trial_ends_on: Mapped[Optional[datetime]] = mapped_column(DateTime)
     canceled_on: Mapped[Optional[datetime]] = mapped_column(DateTime)
     next_payment_date: Mapped[Optional[datetime]] = mapped_column(DateTime)
-    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime, server_default=UTC_NOW, nullable=False)
 
-    customer: Mapped[Optional[Customer]] = relationship("Customer")
+    customer: Mapped[Optional[Customer]] = relationship("Customer", lazy="raise")
 
     __table_args__ = (
         UniqueConstraint("source", "source_id", name="uq_subscription_source_id"),
@@ -173,13 +181,15 @@ class AdAccount(Base):
     account_id: Mapped[str] = mapped_column(String(64), nullable=False)
     name: Mapped[Optional[str]] = mapped_column(String(255))
     currency: Mapped[Optional[str]] = mapped_column(String(3))
-    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime, server_default=UTC_NOW, nullable=False)
 
     __table_args__ = (
         UniqueConstraint("platform", "account_id", name="uq_ad_account_platform_id"),
     )
 
 
+# Catálogos de Ads: índice único con INCLUDE (name, account_id) para que la precarga de
+# ads_sync se resuelva con index-only scans.
 class AdCampaign(Base):
     __tablename__ = "ad_campaigns"
 
@@ -188,19 +198,22 @@ class AdCampaign(Base):
     account_id: Mapped[str] = mapped_column(String(64), nullable=False)
     campaign_id: Mapped[str] = mapped_column(String(64), nullable=False)
     name: Mapped[Optional[str]] = mapped_column(String(255))
-    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime, server_default=UTC_NOW, nullable=False)
 
     __table_args__ = (
-        UniqueConstraint("platform", "campaign_id", name="uq_ad_campaign_platform_id"),
+        Index("uq_ad_campaign_platform_id", "platform", "campaign_id", unique=True, postgresql_include=["name", "account_id"]),
         Index("ix_ad_campaigns_account", "platform", "account_id"),
     )
 
 
 class AdCostsDaily(Base):
+    """Particionada por rango mensual de `date` (ver backend.db.partitions); la PK y las
+    claves únicas incluyen `date` porque Postgres lo exige en tablas particionadas.
+    """
     __tablename__ = "ad_costs_daily"
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
-    date: Mapped[datetime] = mapped_column(DateTime, index=True, nullable=False)
+    date: Mapped[datetime] = mapped_column(DateTime, primary_key=True, index=True, nullable=False)
     platform: Mapped[str] = mapped_column(String(20), nullable=False)
     account_id: Mapped[Optional[str]] = mapped_column(String(64))
     campaign_id: Mapped[Optional[str]] = mapped_column(String(64))
@@ -212,7 +225,15 @@ class AdCostsDaily(Base):
     clicks: Mapped[Optional[int]] = mapped_column(Integer)
 
     __table_args__ = (
-        Index("ix_ad_costs_daily_dim", "platform", "account_id", "campaign_id", "date"),
+        # Clave natural para el upsert (ON CONFLICT) de ads_sync.
+        # platform+date al frente sirve también el filtro del dashboard; NULLS NOT DISTINCT (PG15+)
+        # evita duplicados cuando adset_id/ad_id vienen vacíos.
+        UniqueConstraint(
+            "platform", "date", "account_id", "campaign_id", "adset_id", "ad_id",
+            name="uq_ad_costs_daily_dim",
+            postgresql_nulls_not_distinct=True,
+        ),
+        {"postgresql_partition_by": "RANGE (date)"},
     )
 
 
@@ -224,10 +245,10 @@ class AdAdset(Base):
     adset_id: Mapped[str] = mapped_column(String(64), nullable=False)
     account_id: Mapped[Optional[str]] = mapped_column(String(64))
     name: Mapped[Optional[str]] = mapped_column(String(255))
-    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime, server_default=UTC_NOW, nullable=False)
 
     __table_args__ = (
-        UniqueConstraint("platform", "adset_id", name="uq_adset_platform_id"),
+        Index("uq_adset_platform_id", "platform", "adset_id", unique=True, postgresql_include=["name", "account_id"]),
         Index("ix_adsets_account", "platform", "account_id"),
     )
 
@@ -240,10 +261,10 @@ class AdAd(Base):
     ad_id: Mapped[str] = mapped_column(String(64), nullable=False)
     account_id: Mapped[Optional[str]] = mapped_column(String(64))
     name: Mapped[Optional[str]] = mapped_column(String(255))
-    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime, server_default=UTC_NOW, nullable=False)
 
     __table_args__ = (
-        UniqueConstraint("platform", "ad_id", name="uq_ad_platform_id"),
+        Index("uq_ad_platform_id", "platform", "ad_id", unique=True, postgresql_include=["name", "account_id"]),
         Index("ix_ads_account", "platform", "account_id"),
     )
 
@@ -261,7 +282,12 @@ class GaSessionsDaily(Base):
     conversions: Mapped[Optional[int]] = mapped_column(Integer)
 
     __table_args__ = (
-        Index("ix_ga_sessions_dim", "date", "source", "medium", "campaign"),
+        # Clave natural: el upsert de ga_sync resuelve conflictos contra ella
+        UniqueConstraint(
+            "date", "source", "medium", "campaign",
+            name="uq_ga_sessions_daily_dim",
+            postgresql_nulls_not_distinct=True,
+        ),
     )
 
 
@@ -278,9 +304,9 @@ class AttributionLink(Base):
     gclid: Mapped[Optional[str]] = mapped_column(String(255))
     fbclid: Mapped[Optional[str]] = mapped_column(String(255))
     weight: Mapped[Optional[float]] = mapped_column(Numeric(6, 4))
-    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime, server_default=UTC_NOW, nullable=False)
 
-    payment: Mapped[Payment] = relationship("Payment")
+    payment: Mapped[Payment] = relationship("Payment", lazy="raise")
     __table_args__ = (
         Index("ix_attrib_payment", "payment_id"),
     )
@@ -292,7 +318,7 @@ class AttributionEvent(Base):
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     platform: Mapped[str] = mapped_column(String(20), nullable=False)  # 'ga4' | 'meta'
     event_name: Mapped[str] = mapped_column(String(100), nullable=False)
-    event_time: Mapped[datetime] = mapped_column(DateTime, index=True, nullable=False)
+    event_time: Mapped[datetime] = mapped_column(DateTime, nullable=False)
     source: Mapped[Optional[str]] = mapped_column(String(100))
     medium: Mapped[Optional[str]] = mapped_column(String(100))
     campaign: Mapped[Optional[str]] = mapped_column(String(200))
@@ -308,9 +334,24 @@ class AttributionEvent(Base):
 
     __table_args__ = (
         Index("ix_attrib_events_time", "event_time"),
-        Index("ix_attrib_events_tx", "transaction_id"),
+        # Match por transaction_id de build_attribution_links: último evento por plataforma.
+        Index(
+            "ix_attrib_events_tx_platform_time",
+            "transaction_id",
+            "platform",
+            text("event_time DESC"),
+        ),
         Index("ix_attrib_events_gclid", "gclid"),
         Index("ix_attrib_events_fbclid", "fbclid"),
+        # Clave natural del evento: el insert de attribution_sync deduplica contra ella.
+        Index(
+            "uq_attrib_events_key",
+            "platform",
+            "event_name",
+            "event_time",
+            text("coalesce(transaction_id, campaign, '')"),
+            unique=True,
+        ),
     )
 
 
@@ -338,6 +379,12 @@ class LeadsKajabi(Base):
         Index("ix_leads_kajabi_platform", "platform"),
         Index("ix_leads_kajabi_gclid", "gclid"),
         Index("ix_leads_kajabi_fbclid", "fbclid"),
+        # Clave natural del lead: el upsert de kajabi_leads_sync deduplica contra ella.
+        UniqueConstraint(
+            "created_at", "email",
+            name="uq_leads_kajabi_created_email",
+            postgresql_nulls_not_distinct=True,
+        ),
     )
 
 
@@ -348,7 +395,7 @@ class CustomerLTV(Base):
     email: Mapped[str] = mapped_column(String(320), nullable=False)
     source: Mapped[str] = mapped_column(SourceEnum, nullable=False)
     ltv_eur: Mapped[float] = mapped_column(Numeric(18, 2), nullable=False)
-    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, nullable=False)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, server_default=UTC_NOW, nullable=False)
 
     __table_args__ = (
         UniqueConstraint("email", "source", name="uq_customer_ltv_email_source"),
@@ -400,7 +447,7 @@ class GA4PurchasesDaily(Base):
     purchases: Mapped[int] = mapped_column(Integer, default=0)
     revenue_eur: Mapped[float] = mapped_column(Numeric(18, 4), default=0.0)
     platform_detected: Mapped[Optional[str]] = mapped_column(String(20))  # 'google_ads', 'meta', 'organic', etc.
-    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime, server_default=UTC_NOW, nullable=False)
 
     __table_args__ = (
         # Constraint único: date, source, medium, campaign, item_name (NULLs tratados como distintos)
@@ -0,0 +1,70 @@
+"""Gestión de particiones mensuales (PARTITION BY RANGE (date)).
+
+Las tablas particionadas no aceptan filas fuera de una partición existente, así que los
+escritores llaman a `ensure_monthly_partitions` con el rango de fechas que van a insertar
+(una vez por ejecución, no por lote). En una base donde la tabla aún no se ha migrado a
+particionada (maintenance/ad_costs_partition.py) no hace nada.
+"""
+from __future__ import annotations
+
+import threading
+from datetime import date, datetime
+from typing import Dict, Iterator
+
+from sqlalchemy import text
+
+
+# Tablas ya comprobadas en este proceso: {tabla: particionada}
+_partitioned: Dict[str, bool] = {}
+_partitioned_lock = threading.Lock()
+
+
+def _next_month(d: date) -> date:
+    return date(d.year + (d.month == 12), d.month % 12 + 1, 1)
+
+
+def _month_starts(start: date, end: date) -> Iterator[date]:
+    current = date(start.year, start.month, 1)
+    while current <= end:
+        yield current
+        current = _next_month(current)
+
+
+def partition_name(table: str, month_start: date) -> str:
+    return f"{table}_p{month_start.year:04d}{month_start.month:02d}"
+
+
+def is_partitioned(conn, table: str) -> bool:
+    """True si `table` es una tabla particionada; se consulta pg_partitioned_table una vez por proceso."""
+    with _partitioned_lock:
+        cached = _partitioned.get(table)
+    if cached is not None:
+        return cached
+    found = conn.execute(
+        text("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:t)"),
+        {"t": table},
+    ).scalar() is not None
+    with _partitioned_lock:
+        _partitioned[table] = found
+    return found
+
+
+def ensure_monthly_partitions(conn, table: str, start: date | datetime, end: date | datetime) -> int:
+    """Crea (si faltan) las particiones mensuales de `table` que cubren [start, end],
+    dentro de la transacción de `conn`. Devuelve el número de meses verificados
+    (0 si la tabla no está particionada).
+    """
+    if not is_partitioned(conn, table):
+        return 0
+    if isinstance(start, datetime):
+        start = start.date()
+    if isinstance(end, datetime):
+        end = end.date()
+    months = 0
+    for month_start in _month_starts(start, end):
+        conn.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {partition_name(table, month_start)} PARTITION OF {table} "
+            f"FOR VALUES FROM ('{month_start.isoformat()}') TO ('{_next_month(month_start).isoformat()}')"
+        ))
+        months += 1
+    return months
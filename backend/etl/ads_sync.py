@@ -1,10 +1,20 @@
 from __future__ import annotations
 
+import queue
+from contextlib import nullcontext
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from datetime import date, timedelta
-from typing import Iterable, Dict, Any, Optional
+from typing import Iterable, Iterator, Dict, Any, Optional
+
+from sqlalchemy import bindparam, func, select, tuple_
+from sqlalchemy.dialects.postgresql import insert
 
 from backend.db.config import db_session
-from backend.db.models import AdCostsDaily, AdCampaign, AdAdset, AdAd, SyncState
+from backend.db.copy import copy_insert
+from backend.db.partitions import ensure_monthly_partitions
+from backend.db.models import AdCostsDaily, AdCampaign, AdAdset, AdAd, SyncState, UTC_NOW
 from . import google_ads_client as gads
 try:
     from . import meta_client as meta
@@ -12,117 +22,215 @@ except Exception:
     meta = None
 
 
-def _upsert_ad_cost_rows(rows: Iterable[Dict[str, Any]]) -> int:
+_UPSERT_CHUNK_SIZE = 1000
+# Filas en vuelo entre los hilos de fetch y el upsert (_merge_concurrent)
+_MERGE_QUEUE_SIZE = 2 * _UPSERT_CHUNK_SIZE
+
+_COST_COLUMNS = (
+    "date", "platform", "account_id", "campaign_id", "adset_id", "ad_id",
+    "currency", "cost_major", "impressions", "clicks",
+)
+
+
+def _copy_ad_cost_rows(conn, cost_rows: list[Dict[str, Any]]) -> None:
+    """Carga los costes con COPY a una tabla temporal y los fusiona con un único
+    INSERT ... SELECT ... ON CONFLICT. Pensado para backfills, donde el coste por fila
+    de los INSERT parametrizados domina.
+    """
+    copy_insert(
+        conn,
+        "ad_costs_daily",
+        _COST_COLUMNS,
+        cost_rows,
+        on_conflict="""
+            ON CONFLICT ON CONSTRAINT uq_ad_costs_daily_dim DO UPDATE SET
+                currency = EXCLUDED.currency,
+                cost_major = EXCLUDED.cost_major,
+                impressions = EXCLUDED.impressions,
+                clicks = EXCLUDED.clicks
+        """,
+    )
+
+
+def _upsert_catalog(conn, model, id_attr: str, rows: dict[tuple[str, str], Dict[str, Any]]) -> None:
+    """Upsert de un catálogo (campañas, adsets o anuncios) por (platform, id externo).
+
+    Precarga en una sola SELECT las filas ya existentes y solo escribe las nuevas o las que
+    cambian de nombre/cuenta. La escritura es un único INSERT ... ON CONFLICT ejecutado como
+    executemany, que psycopg2 agrupa en INSERTs multi-fila.
+    """
+    if not rows:
+        return
+    id_col = getattr(model, id_attr)
+    existing = {
+        (platform, ext_id): (name, account_id)
+        for platform, ext_id, name, account_id in conn.execute(
+            select(model.platform, id_col, model.name, model.account_id)
+            .where(tuple_(model.platform, id_col).in_(list(rows)))
+        )
+    }
+    pending: list[Dict[str, Any]] = []
+    for key, row in rows.items():
+        current = existing.get(key)
+        if current is None:
+            pending.append(row)
+            continue
+        # Misma semántica que el COALESCE del upsert: un valor vacío no pisa el existente
+        name = row["name"] if row["name"] is not None else current[0]
+        account_id = row["account_id"] if row["account_id"] is not None else current[1]
+        if (name, account_id) != current:
+            pending.append(row)
+    if not pending:
+        return
+    stmt = insert(model)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["platform", id_attr],
+        set_={
+            "name": func.coalesce(stmt.excluded.name, model.name),
+            "account_id": func.coalesce(stmt.excluded.account_id, model.account_id),
+        },
+    )
+    conn.execute(stmt, pending)
+
+
+def _session_scope(session=None):
+    """Reutiliza la sesión del llamador (sin commit propio) o abre una nueva con db_session()."""
+    return nullcontext(session) if session is not None else db_session()
+
+
+def _upsert_ad_cost_rows(
+    rows: Iterable[Dict[str, Any]],
+    use_copy: bool = False,
+    session=None,
+) -> int:
     """Inserta o actualiza por clave natural (date+dimensiones) para idempotencia.
+    Consume `rows` en bloques de _UPSERT_CHUNK_SIZE, de modo que la memoria no crece con
+    el rango y la escritura empieza mientras se sigue leyendo la API. Sin `session`, cada
+    bloque va en su propia transacción; con ella, todo queda en la transacción del llamador.
+    Con use_copy=True los costes se cargan vía COPY (backfills).
     Devuelve el número de filas afectadas (insertadas o actualizadas).
     """
     count = 0
-    with db_session() as s:
-        touched_campaigns: set[tuple[str, str]] = set()
-        touched_adsets: set[tuple[str, str]] = set()
-        touched_ads: set[tuple[str, str]] = set()
-        for r in rows:
-            # Upsert catálogos si vienen nombres
-            if r.get("campaign_id") and r.get("campaign_name"):
-                key = (r.get("platform"), r.get("campaign_id"))
-                if key not in touched_campaigns:
-                    camp = s.query(AdCampaign).filter_by(
-                        platform=key[0],
-                        campaign_id=key[1],
-                    ).one_or_none()
-                    if camp:
-                        camp.name = r.get("campaign_name") or camp.name
-                        camp.account_id = r.get("account_id") or camp.account_id
-                    else:
-                        s.add(AdCampaign(
-                            platform=key[0],
-                            account_id=r.get("account_id"),
-                            campaign_id=key[1],
-                            name=r.get("campaign_name"),
-                        ))
-                    touched_campaigns.add(key)
-
-            if r.get("adset_id") and r.get("adset_id") != "None" and r.get("adset_id") is not None:
-                key_as = (r.get("platform"), r.get("adset_id"))
-                if key_as not in touched_adsets:
-                    aset = s.query(AdAdset).filter_by(platform=key_as[0], adset_id=key_as[1]).one_or_none()
-                    if aset:
-                        if r.get("account_id"):
-                            aset.account_id = r.get("account_id")
-                        if r.get("adset_name"):
-                            aset.name = r.get("adset_name") or aset.name
-                    else:
-                        s.add(AdAdset(platform=key_as[0], adset_id=key_as[1], account_id=r.get("account_id"), name=r.get("adset_name")))
-                    touched_adsets.add(key_as)
-
-            if r.get("ad_id") and r.get("ad_id") != "None" and r.get("ad_id") is not None:
-                key_ad = (r.get("platform"), r.get("ad_id"))
-                if key_ad not in touched_ads:
-                    ad = s.query(AdAd).filter_by(platform=key_ad[0], ad_id=key_ad[1]).one_or_none()
-                    if ad:
-                        if r.get("account_id"):
-                            ad.account_id = r.get("account_id")
-                        if r.get("ad_name"):
-                            ad.name = r.get("ad_name") or ad.name
-                    else:
-                        s.add(AdAd(platform=key_ad[0], ad_id=key_ad[1], account_id=r.get("account_id"), name=r.get("ad_name")))
-                    touched_ads.add(key_ad)
-            existing = s.query(AdCostsDaily).filter_by(
-                date=r.get("date"),
-                platform=r.get("platform"),
-                account_id=r.get("account_id"),
-                campaign_id=r.get("campaign_id"),
-                adset_id=r.get("adset_id"),
-                ad_id=r.get("ad_id"),
-            ).one_or_none()
-            if existing:
-                existing.currency = r.get("currency")
-                existing.cost_major = r.get("cost_major")
-                existing.impressions = r.get("impressions")
-                existing.clicks = r.get("clicks")
-            else:
-                s.add(AdCostsDaily(
-                    date=r.get("date"),
-                    platform=r.get("platform"),
-                    account_id=r.get("account_id"),
-                    campaign_id=r.get("campaign_id"),
-                    adset_id=r.get("adset_id"),
-                    ad_id=r.get("ad_id"),
-                    currency=r.get("currency"),
-                    cost_major=r.get("cost_major"),
-                    impressions=r.get("impressions"),
-                    clicks=r.get("clicks"),
-                ))
-            count += 1
+    it = iter(rows)
+    while True:
+        chunk = list(islice(it, _UPSERT_CHUNK_SIZE))
+        if not chunk:
+            return count
+        count += _upsert_ad_cost_chunk(chunk, use_copy=use_copy, session=session)
+
+
+def _upsert_ad_cost_chunk(rows: list[Dict[str, Any]], use_copy: bool = False, session=None) -> int:
+    """Un único INSERT ... ON CONFLICT por tabla (campañas, adsets, anuncios y costes)."""
+    count = 0
+    campaigns: dict[tuple[str, str], Dict[str, Any]] = {}
+    adsets: dict[tuple[str, str], Dict[str, Any]] = {}
+    ads: dict[tuple[str, str], Dict[str, Any]] = {}
+    costs: dict[tuple, Dict[str, Any]] = {}
+    for r in rows:
+        # Cada campo se lee una sola vez por fila
+        get = r.get
+        platform = get("platform")
+        account_id = get("account_id")
+        campaign_id = get("campaign_id")
+        adset_id = get("adset_id")
+        ad_id = get("ad_id")
+
+        # Catálogos: gana la primera aparición de cada clave en el lote
+        if campaign_id:
+            campaign_name = get("campaign_name")
+            key = (platform, campaign_id)
+            if campaign_name and key not in campaigns:
+                campaigns[key] = {
+                    "platform": platform,
+                    "account_id": account_id,
+                    "campaign_id": campaign_id,
+                    "name": campaign_name,
+                }
+
+        if adset_id and adset_id != "None":
+            key = (platform, adset_id)
+            if key not in adsets:
+                adsets[key] = {
+                    "platform": platform,
+                    "adset_id": adset_id,
+                    "account_id": account_id,
+                    "name": get("adset_name"),
+                }
+
+        if ad_id and ad_id != "None":
+            key = (platform, ad_id)
+            if key not in ads:
+                ads[key] = {
+                    "platform": platform,
+                    "ad_id": ad_id,
+                    "account_id": account_id,
+                    "name": get("ad_name"),
+                }
+
+        # Costes: gana la última aparición (ON CONFLICT no admite la misma clave dos veces)
+        day = get("date")
+        costs[(day, platform, account_id, campaign_id, adset_id, ad_id)] = {
+            "date": day,
+            "platform": platform,
+            "account_id": account_id,
+            "campaign_id": campaign_id,
+            "adset_id": adset_id,
+            "ad_id": ad_id,
+            "currency": get("currency"),
+            "cost_major": get("cost_major"),
+            "impressions": get("impressions"),
+            "clicks": get("clicks"),
+        }
+        count += 1
+
+    with _session_scope(session) as s:
+        # Core sobre la conexión de la sesión: sin identity map ni unit of work
+        conn = s.connection()
+        _upsert_catalog(conn, AdCampaign, "campaign_id", campaigns)
+        _upsert_catalog(conn, AdAdset, "adset_id", adsets)
+        _upsert_catalog(conn, AdAd, "ad_id", ads)
+        if costs and use_copy:
+            _copy_ad_cost_rows(conn, list(costs.values()))
+        elif costs:
+            stmt = insert(AdCostsDaily)
+            stmt = stmt.on_conflict_do_update(
+                constraint="uq_ad_costs_daily_dim",
+                set_={
+                    "currency": stmt.excluded.currency,
+                    "cost_major": stmt.excluded.cost_major,
+                    "impressions": stmt.excluded.impressions,
+                    "clicks": stmt.excluded.clicks,
+                },
+            )
+            conn.execute(stmt, list(costs.values()))
     return count
 
 
-def _get_state(key: str) -> Optional[str]:
+# Sentencia construida una vez: SQLAlchemy reutiliza el SQL compilado en cada llamada.
+# Solo la columna value: sin hidratar la entidad SyncState
+_SEL_STATE = (
+    select(SyncState.value)
+    .where(SyncState.key == bindparam("key"))
+    .order_by(SyncState.id.desc())
+    .limit(1)
+)
+
+
+def _get_state(key: str, session=None) -> Optional[str]:
     # Tolerante a duplicados: usa el registro más reciente
-    with db_session() as s:
-        st = (
-            s.query(SyncState)
-            .filter(SyncState.key == key)
-            .order_by(SyncState.id.desc())
-            .first()
-        )
-        return st.value if st else None
+    with _session_scope(session) as s:
+        return s.execute(_SEL_STATE, {"key": key}).scalar_one_or_none()
 
 
-def _set_state(key: str, value: str) -> None:
-    # Upsert tolerante a duplicados
-    with db_session() as s:
-        st = (
-            s.query(SyncState)
-            .filter(SyncState.key == key)
-            .order_by(SyncState.id.desc())
-            .first()
+def _set_state(key: str, value: str, session=None) -> None:
+    # Upsert atómico sobre la clave única de sync_state (una sola sentencia)
+    with _session_scope(session) as s:
+        stmt = insert(SyncState).values(key=key, value=value)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["key"],
+            set_={"value": stmt.excluded.value, "updated_at": UTC_NOW},
         )
-        if st:
-            st.value = value
-        else:
-            from datetime import datetime as _dt
-            s.add(SyncState(key=key, value=value))
+        s.execute(stmt)
 
 
 def run_ads_sync(
@@ -131,41 +239,134 @@ def run_ads_sync(
     include_google: bool = True,
 ) -> int:
     end = date.today()
-    # Incremental con cursor (lookback 1 día por idempotencia)
+    # Incremental con cursor (lookback 1 día por idempotencia).
+    # Lectura del cursor, upserts y avance del cursor comparten una única transacción.
     cursor_key = "ads_costs_cursor"
-    state = _get_state(cursor_key)
-    if state:
-        try:
-            from datetime import datetime as _dt
-            last = _dt.fromisoformat(state).date()
-            start = max(date(1970, 1, 1), last - timedelta(days=1))
-        except Exception:
+    with db_session() as s:
+        state = _get_state(cursor_key, session=s)
+        if state:
+            try:
+                from datetime import datetime as _dt
+                last = _dt.fromisoformat(state).date()
+                start = max(date(1970, 1, 1), last - timedelta(days=1))
+            except Exception:
+                start = end - timedelta(days=days_back)
+        else:
             start = end - timedelta(days=days_back)
-    else:
-        start = end - timedelta(days=days_back)
-    inserted = run_ads_sync_range(start, end, include_meta=include_meta, include_google=include_google)
-    _set_state(cursor_key, end.isoformat())
+        progress: Dict[str, Any] = {}
+        inserted = run_ads_sync_range(
+            start,
+            end,
+            include_meta=include_meta,
+            include_google=include_google,
+            session=s,
+            progress=progress,
+        )
+        # El cursor solo avanza si todas las plataformas activas respondieron bien, y como
+        # mucho hasta el último día recibido de la más retrasada, para que una plataforma
+        # caída o incompleta se reintente en la siguiente ejecución. Una plataforma que
+        # respondió sin filas no retiene el cursor (un sondeo vacío avanza hasta end).
+        platforms = progress.get("platforms") or {}
+        if platforms and all(p["ok"] for p in platforms.values()):
+            cursor = min([end] + [p["max_date"] for p in platforms.values() if p["max_date"] is not None])
+            _set_state(cursor_key, cursor.isoformat(), session=s)
     return inserted
 
 
+def _safe_fetch(fetch, start: date, end: date, state: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    """Itera un fetcher de plataforma sin propagar sus errores (best effort por plataforma).
+
+    Anota en `state` el día más reciente recibido ("max_date", None si no llegó ninguna
+    fila) y si el fetch terminó sin error ("ok").
+    """
+    try:
+        for row in fetch(start, end):
+            d = row.get("date")
+            if d is not None and (state["max_date"] is None or d > state["max_date"]):
+                state["max_date"] = d
+            yield row
+    except Exception:
+        return
+    state["ok"] = True
+
+
+def _merge_concurrent(sources: list[Iterable[Dict[str, Any]]]) -> Iterator[Dict[str, Any]]:
+    """Consume varios iterables de filas en paralelo (un hilo por plataforma) y entrega
+    las filas según llegan, para que el upsert empiece con la primera plataforma que responda.
+    """
+    if len(sources) <= 1:
+        for src in sources:
+            yield from src
+        return
+    done = object()
+    # Cola acotada: si el upsert va más lento que la API los productores esperan, y la
+    # memoria no crece con el rango (mismo límite que el streaming por bloques)
+    q: queue.Queue = queue.Queue(maxsize=_MERGE_QUEUE_SIZE)
+    stop = threading.Event()
+
+    def _put(item: Any) -> bool:
+        # put con timeout para no quedarse bloqueado si el consumidor ya ha parado
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(src: Iterable[Dict[str, Any]]) -> None:
+        try:
+            for row in src:
+                if not _put(row):
+                    return
+        finally:
+            _put(done)
+
+    with ThreadPoolExecutor(max_workers=len(sources)) as ex:
+        for src in sources:
+            ex.submit(_produce, src)
+        remaining = len(sources)
+        try:
+            while remaining:
+                item = q.get()
+                if item is done:
+                    remaining -= 1
+                    continue
+                yield item
+        finally:
+            # Si el consumidor falla, los productores dejan de iterar
+            stop.set()
+
+
 def run_ads_sync_range(
     start: date,
     end: date,
     include_meta: bool = True,
     include_google: bool = True,
+    use_copy: bool = False,
+    session=None,
+    progress: Optional[Dict[str, Any]] = None,
 ) -> int:
-    rows: list[Dict[str, Any]] = []
+    """Descarga y guarda los costes de [start, end]. Si se pasa `progress`, deja en
+    progress["platforms"] el estado de cada plataforma pedida (ver _safe_fetch).
+    """
+    # Particiones mensuales del rango una sola vez por ejecución, no en cada bloque
+    with _session_scope(session) as s:
+        ensure_monthly_partitions(s.connection(), AdCostsDaily.__tablename__, start, end)
+    fetchers = []
     if include_google:
-        try:
-            rows += list(gads.fetch_costs_daily(start, end))
-        except Exception:
-            pass
+        fetchers.append(("google_ads", gads.fetch_costs_daily))
     if include_meta and meta is not None:
-        try:
-            rows += list(meta.fetch_costs_daily(start, end))
-        except Exception:
-            pass
-    return _upsert_ad_cost_rows(rows)
+        fetchers.append(("meta", meta.fetch_costs_daily))
+    platforms: Dict[str, Dict[str, Any]] = {
+        name: {"ok": False, "max_date": None} for name, _ in fetchers
+    }
+    if progress is not None:
+        progress["platforms"] = platforms
+    rows = _merge_concurrent([
+        _safe_fetch(fetch, start, end, platforms[name]) for name, fetch in fetchers
+    ])
+    return _upsert_ad_cost_rows(rows, use_copy=use_copy, session=session)
 
 
 def run_ads_backfill(
@@ -174,18 +375,33 @@ def run_ads_backfill(
     include_meta: bool = False,
     include_google: bool = True,
 ) -> int:
-    """Backfill histórico en ventanas no solapadas hasta cubrir total_days."""
+    """Backfill histórico hasta cubrir total_days.
+    Los costes se cargan vía COPY en lugar de INSERT parametrizados. Google Ads se pide
+    de una vez para todo el rango (el cliente lo trocea en ventanas que descarga en
+    paralelo); Meta, que no pagina, sigue en ventanas de chunk_days días.
+    """
     end = date.today()
     start_total = end - timedelta(days=total_days)
     inserted = 0
+    if include_google:
+        inserted += run_ads_sync_range(
+            start_total,
+            end,
+            include_meta=False,
+            include_google=True,
+            use_copy=True,
+        )
+    if not include_meta:
+        return inserted
     current_end = end
     while current_end > start_total:
         current_start = max(start_total, current_end - timedelta(days=chunk_days))
         inserted += run_ads_sync_range(
             current_start,
             current_end,
-            include_meta=include_meta,
-            include_google=include_google,
+            include_meta=True,
+            include_google=False,
+            use_copy=True,
         )
         current_end = current_start
     return inserted
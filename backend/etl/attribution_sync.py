@@ -1,7 +1,12 @@
 from __future__ import annotations
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, datetime, timedelta
-from typing import Dict, Any, Iterable, Optional
+from itertools import islice
+from typing import Dict, Any, Iterable
+
+from sqlalchemy import case, exists, func, literal, or_, select, text, true
+from sqlalchemy.dialects.postgresql import insert
 
 from backend.db.config import db_session
 from backend.db.models import (
@@ -9,60 +14,82 @@ from backend.db.models import (
     AttributionEvent,
     AttributionLink,
 )
-from . import ga4_client
 try:
     from . import meta_client
 except Exception:
     meta_client = None
 
 
+_INSERT_CHUNK_SIZE = 2000
+# Debe coincidir con el índice único uq_attrib_events_key de AttributionEvent.
+_EVENT_KEY = [
+    "platform",
+    "event_name",
+    "event_time",
+    text("coalesce(transaction_id, campaign, '')"),
+]
+_INSERT_EVENT = (
+    insert(AttributionEvent.__table__)
+    .on_conflict_do_nothing(index_elements=_EVENT_KEY)
+    .returning(AttributionEvent.__table__.c.id)
+)
+
+
+def _event_row(ev: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "platform": ev.get("platform"),
+        "event_name": ev.get("event_name"),
+        "event_time": ev.get("event_time"),
+        "source": ev.get("source"),
+        "medium": ev.get("medium"),
+        "campaign": ev.get("campaign"),
+        "term": ev.get("term"),
+        "content": ev.get("content"),
+        "gclid": ev.get("gclid"),
+        "fbclid": ev.get("fbclid"),
+        "transaction_id": ev.get("transaction_id"),
+        "email": ev.get("email"),
+        "value": ev.get("value"),
+        "currency": ev.get("currency"),
+        "raw": ev.get("raw"),
+    }
+
+
 def _upsert_events(events: Iterable[Dict[str, Any]]) -> int:
+    """Inserta los eventos en bloques de _INSERT_CHUNK_SIZE a medida que llegan.
+
+    Cada bloque va como executemany de una única sentencia cacheada, que el driver
+    empaqueta en páginas multi-VALUES (insertmanyvalues_page_size del engine), en
+    lugar de compilar un INSERT distinto por bloque. Los duplicados (del mismo lote o
+    de ejecuciones previas) los descarta uq_attrib_events_key; RETURNING id cuenta
+    solo las filas realmente insertadas.
+    """
     inserted = 0
-    seen: set[tuple] = set()
+    it = iter(events)
     with db_session() as s:
-        for ev in events:
-            key = (
-                ev.get("platform"),
-                ev.get("event_name"),
-                ev.get("event_time"),
-                ev.get("transaction_id") or ev.get("campaign"),
-            )
-            if key in seen:
-                continue
-            seen.add(key)
-
-            s.add(AttributionEvent(
-                platform=ev.get("platform"),
-                event_name=ev.get("event_name"),
-                event_time=ev.get("event_time"),
-                source=ev.get("source"),
-                medium=ev.get("medium"),
-                campaign=ev.get("campaign"),
-                term=ev.get("term"),
-                content=ev.get("content"),
-                gclid=ev.get("gclid"),
-                fbclid=ev.get("fbclid"),
-                transaction_id=ev.get("transaction_id"),
-                email=ev.get("email"),
-                value=ev.get("value"),
-                currency=ev.get("currency"),
-                raw=ev.get("raw"),
-            ))
-            inserted += 1
+        conn = s.connection()
+        while True:
+            rows = [_event_row(ev) for ev in islice(it, _INSERT_CHUNK_SIZE)]
+            if not rows:
+                break
+            inserted += len(conn.execute(_INSERT_EVENT, rows).all())
     return inserted
 
 
 def sync_ga4_purchase_events(days_back: int = 30) -> int:
+    """Guarda las compras GA4 como eventos de atribución."""
+    # Import diferido: el cliente GA4 arrastra grpc/protobuf y solo hace falta aquí
+    from . import ga4_client
+
     end = date.today()
     start = end - timedelta(days=days_back)
-    rows = list(ga4_client.fetch_purchases_by_day_tx(start, end))
-    events: list[Dict[str, Any]] = []
-    for r in rows:
-        d: date = r.get("date")
-        events.append({
+    rows = ga4_client.fetch_purchases_by_day_tx(start, end)
+    events = (
+        {
             "platform": "ga4",
             "event_name": "purchase",
-            "event_time": datetime(d.year, d.month, d.day),
+            # date: el INSERT lo castea a timestamp (medianoche) en Postgres
+            "event_time": r["date"],
             "source": r.get("source"),
             "medium": r.get("medium"),
             "campaign": r.get("campaign"),
@@ -70,7 +97,9 @@ def sync_ga4_purchase_events(days_back: int = 30) -> int:
             "value": None,
             "currency": None,
             "raw": r,
-        })
+        }
+        for r in rows
+    )
     return _upsert_events(events)
 
 
@@ -79,96 +108,106 @@ def sync_meta_purchase_events(days_back: int = 30) -> int:
         return 0
     end = date.today()
     start = end - timedelta(days=days_back)
-    rows = list(meta_client.fetch_purchases_daily(start, end))
-    events: list[Dict[str, Any]] = []
-    for r in rows:
-        d: date = r.get("date")
-        events.append({
+    events = (
+        {
             "platform": "meta",
             "event_name": "purchase",
-            "event_time": datetime(d.year, d.month, d.day),
+            "event_time": r["date"],
             "source": "meta",
             "medium": "paid",
             "campaign": r.get("campaign_name"),
             "value": r.get("value"),
             "currency": r.get("currency"),
             "raw": r,
-        })
+        }
+        for r in meta_client.fetch_purchases_daily(start, end)
+    )
     return _upsert_events(events)
 
 
+_LINK_FIELDS = ("source", "medium", "campaign", "term", "content", "gclid", "fbclid")
+
+
 def build_attribution_links(lookback_days: int = 30) -> int:
     """Crea AttributionLink por last-touch:
     1) Intento exacto por transaction_id (GA4) -> payment.source_payment_id
     2) Si falla, último evento (GA4/Meta) antes de paid_at dentro del lookback.
+
+    Todo se resuelve en un único INSERT ... SELECT: para cada pago sin link, dos joins
+    LATERAL buscan el evento más reciente de cada vía.
     """
-    created = 0
     cutoff = datetime.utcnow() - timedelta(days=lookback_days)
-    with db_session() as s:
-        payments = (
-            s.query(Payment)
-            .outerjoin(AttributionLink, AttributionLink.payment_id == Payment.id)
-            .filter(AttributionLink.id == None)  # noqa: E711
-            .filter(Payment.paid_at != None)  # noqa: E711
-            .filter(Payment.paid_at >= cutoff)
-            .all()
+    ev = AttributionEvent
+
+    pending = (
+        select(
+            Payment.id.label("payment_id"),
+            Payment.paid_at,
+            func.trim(Payment.source_payment_id).label("txid"),
         )
-        for pay in payments:
-            linked = False
-            txid = (pay.source_payment_id or "").strip()
-            if txid:
-                ev = (
-                    s.query(AttributionEvent)
-                    .filter(AttributionEvent.platform == "ga4")
-                    .filter(AttributionEvent.transaction_id == txid)
-                    .order_by(AttributionEvent.event_time.desc())
-                    .first()
-                )
-                if ev:
-                    s.add(AttributionLink(
-                        payment_id=pay.id,
-                        source=ev.source,
-                        medium=ev.medium,
-                        campaign=ev.campaign,
-                        term=ev.term,
-                        content=ev.content,
-                        gclid=ev.gclid,
-                        fbclid=ev.fbclid,
-                        weight=1.0,
-                    ))
-                    created += 1
-                    linked = True
-            if linked:
-                continue
-
-            # Fallback: último evento antes de paid_at
-            ev2 = (
-                s.query(AttributionEvent)
-                .filter(AttributionEvent.event_time <= (pay.paid_at or datetime.utcnow()))
-                .filter(AttributionEvent.event_time >= cutoff)
-                .order_by(AttributionEvent.event_time.desc())
-                .first()
-            )
-            if ev2:
-                s.add(AttributionLink(
-                    payment_id=pay.id,
-                    source=ev2.source,
-                    medium=ev2.medium,
-                    campaign=ev2.campaign,
-                    term=ev2.term,
-                    content=ev2.content,
-                    gclid=ev2.gclid,
-                    fbclid=ev2.fbclid,
-                    weight=1.0,
-                ))
-                created += 1
-
-    return created
+        .where(Payment.paid_at.isnot(None))
+        .where(Payment.paid_at >= cutoff)
+        # Anti-join sobre ix_attrib_payment: solo pagos aún sin link.
+        .where(~exists().where(AttributionLink.payment_id == Payment.id))
+        .cte("pending")
+    )
+
+    def _latest(name: str, *conds) -> Any:
+        # Subconsulta LATERAL: el evento más reciente por pago, vía índice y LIMIT 1.
+        return (
+            select(ev.id, *(getattr(ev, f) for f in _LINK_FIELDS))
+            .where(*conds)
+            .order_by(ev.event_time.desc())
+            .limit(1)
+            .lateral(name)
+        )
+
+    tx_match = _latest(
+        "tx_match",
+        ev.platform == "ga4",
+        pending.c.txid != "",
+        ev.transaction_id == pending.c.txid,
+    )
+    # Solo si no hubo match por transaction_id: el filtro no depende de la fila del
+    # evento, así que Postgres lo evalúa una vez y se salta el escaneo.
+    time_match = _latest(
+        "time_match",
+        tx_match.c.id.is_(None),
+        ev.event_time <= pending.c.paid_at,
+        ev.event_time >= cutoff,
+    )
+
+    # Se toma el evento completo de una sola vía: primero transaction_id, luego ventana temporal.
+    has_tx = tx_match.c.id.isnot(None)
+    picked = (
+        select(
+            pending.c.payment_id,
+            *(
+                case((has_tx, tx_match.c[f]), else_=time_match.c[f]).label(f)
+                for f in _LINK_FIELDS
+            ),
+            literal(1.0).label("weight"),
+        )
+        .select_from(pending)
+        .outerjoin(tx_match, true())
+        .outerjoin(time_match, true())
+        .where(or_(has_tx, time_match.c.id.isnot(None)))
+    )
+    stmt = insert(AttributionLink).from_select(
+        ["payment_id", *_LINK_FIELDS, "weight"], picked
+    )
+
+    with db_session() as s:
+        return s.execute(stmt).rowcount or 0
 
 
 def run_attribution_sync(days_back: int = 30) -> Dict[str, int]:
-    r1 = sync_ga4_purchase_events(days_back)
-    r2 = sync_meta_purchase_events(days_back)
+    # GA4 y Meta son independientes (I/O HTTP); cada uno abre su propia sesión.
+    # Los links se construyen cuando ambos han terminado.
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        f1 = ex.submit(sync_ga4_purchase_events, days_back)
+        f2 = ex.submit(sync_meta_purchase_events, days_back)
+        r1, r2 = f1.result(), f2.result()
     r3 = build_attribution_links(lookback_days=max(7, days_back))
     return {
         "ga4_events": r1,
@@ -7,11 +7,21 @@ Variables esperadas en entorno (o .env):
 """
 from __future__ import annotations
 
-from datetime import date
-from typing import Iterable, Dict, Any
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from functools import lru_cache, wraps
+from operator import attrgetter
+from typing import Iterable, Iterator, Dict, Any, Optional
+import hashlib
 import os
+import threading
+import time
+import pandas as pd
 from google.analytics.data_v1beta import BetaAnalyticsDataClient
+from google.api_core.exceptions import InvalidArgument
 from google.analytics.data_v1beta.types import (
+    BatchRunReportsRequest,
     DateRange,
     Dimension,
     Metric,
@@ -20,12 +30,50 @@ from google.analytics.data_v1beta.types import (
     FilterExpression,
     Filter,
 )
+from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from dotenv import load_dotenv
 
 
+load_dotenv()
+
+# Renueva el access token si le quedan menos de 5 minutos (caduca a la hora).
+_TOKEN_REFRESH_MARGIN = timedelta(minutes=5)
+# Credenciales compartidas por proceso, por sha256 del refresh token (no el token en claro).
+_credentials: Dict[str, Credentials] = {}
+_credentials_lock = threading.Lock()
+
+
+def _shared_credentials(client_id: str, client_secret: str, refresh_token: str) -> Credentials:
+    """Una única instancia de Credentials por refresh token, con el access token vigente.
+
+    Se renueva de forma explícita solo si no hay token o está a menos de
+    _TOKEN_REFRESH_MARGIN de caducar; si no, se reutiliza sin pasar por el endpoint OAuth.
+    """
+    key = hashlib.sha256(refresh_token.encode()).hexdigest()
+    with _credentials_lock:
+        creds = _credentials.get(key)
+        if creds is None:
+            creds = _credentials[key] = Credentials(
+                None,
+                refresh_token=refresh_token,
+                token_uri="https://oauth2.googleapis.com/token",
+                client_id=client_id,
+                client_secret=client_secret,
+                scopes=["https://www.googleapis.com/auth/analytics.readonly"],
+            )
+            if hasattr(creds, "with_non_blocking_refresh"):
+                # google-auth >= 2.25: con el token cerca de caducar lo renueva en segundo plano
+                creds.with_non_blocking_refresh()
+        # expiry de google-auth es UTC naive
+        if not creds.token or creds.expiry is None or (
+            creds.expiry - datetime.utcnow() < _TOKEN_REFRESH_MARGIN
+        ):
+            creds.refresh(Request())
+    return creds
+
+
 def _build_client() -> BetaAnalyticsDataClient:
-    load_dotenv()
     # Acepta múltiples variantes (token combinado de Ads/GA4 o específicos)
     client_id = (
         os.getenv("GA4_OAUTH_CLIENT_ID")
@@ -46,31 +94,243 @@ def _build_client() -> BetaAnalyticsDataClient:
     )
     if not (client_id and client_secret and refresh_token):
         raise RuntimeError("Faltan credenciales OAuth de GA4 en el entorno")
-    creds = Credentials(
-        None,
-        refresh_token=refresh_token,
-        token_uri="https://oauth2.googleapis.com/token",
-        client_id=client_id,
-        client_secret=client_secret,
-        scopes=["https://www.googleapis.com/auth/analytics.readonly"],
-    )
+    creds = _shared_credentials(client_id, client_secret, refresh_token)
     return BetaAnalyticsDataClient(credentials=creds)
 
 
-def fetch_sessions_daily(start: date, end: date) -> Iterable[Dict[str, Any]]:
-    load_dotenv()
+@lru_cache(maxsize=1)
+def _get_client() -> BetaAnalyticsDataClient:
+    """Cliente compartido entre llamadas: evita un handshake TLS y un refresh OAuth
+    por cada fetch. Las credenciales renuevan el access token por sí solas."""
+    return _build_client()
+
+
+@lru_cache(maxsize=1)
+def _property_id() -> str:
     property_id = os.getenv("GA4_PROPERTY_ID")
     if not property_id:
         raise RuntimeError("Falta GA4_PROPERTY_ID en el entorno")
+    return property_id
+
+
+# Caché de respuestas. GA4 sigue revisando las últimas ~48 h, así que solo se consideran
+# cerrados (TTL largo) los rangos que terminan hace al menos _CACHE_SETTLED_DAYS días.
+_CACHE_TTL_LIVE = 60.0
+_CACHE_TTL_CLOSED = 24 * 3600.0
+_CACHE_SETTLED_DAYS = 2
+_CACHE_MAX_ENTRIES = 128
+_cache: "OrderedDict[tuple, tuple[float, Any]]" = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _copy_result(value: Any) -> Any:
+    """Copia de los contenedores de un resultado cacheado (DataFrame, dicts, listas);
+    los valores escalares son inmutables y se comparten."""
+    if isinstance(value, pd.DataFrame):
+        return value.copy()
+    if isinstance(value, dict):
+        return {k: _copy_result(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_copy_result(v) for v in value]
+    return value
+
+
+def _cache_ga4(fn):
+    """Memoiza un fetch_*(start, end, ...) con TTL y tamaño acotado (LRU).
+
+    Rangos que llegan a los últimos _CACHE_SETTLED_DAYS días caducan a los
+    _CACHE_TTL_LIVE segundos; el resto a las _CACHE_TTL_CLOSED. Evita repetir el mismo
+    informe dentro de un refresco del dashboard o entre syncs cercanos. Cada llamada
+    recibe su propia copia del resultado, así que el llamador puede modificarlo.
+    `fn.__wrapped__` es la versión sin caché (backfills que no se vuelven a pedir).
+    """
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        key = (fn.__name__, args, tuple(sorted(kwargs.items())))
+        now = time.monotonic()
+        with _cache_lock:
+            hit = _cache.get(key)
+            if hit is not None and hit[0] > now:
+                _cache.move_to_end(key)
+                return _copy_result(hit[1])
+        result = fn(*args, **kwargs)
+        end = args[1] if len(args) > 1 else kwargs.get("end")
+        settled = date.today() - timedelta(days=_CACHE_SETTLED_DAYS)
+        ttl = _CACHE_TTL_CLOSED if end is not None and end <= settled else _CACHE_TTL_LIVE
+        with _cache_lock:
+            _cache[key] = (now + ttl, result)
+            _cache.move_to_end(key)
+            while len(_cache) > _CACHE_MAX_ENTRIES:
+                _cache.popitem(last=False)
+        return _copy_result(result)
+
+    return wrapper
+
+
+def _columns(rows, field: str, n: int) -> list[list[str]]:
+    """Traspone los valores crudos de `field` ('dimension_values'/'metric_values').
+
+    Cada fila se recorre una sola vez: indexar el campo repetido por columna
+    reconstruye el wrapper proto-plus en cada acceso. El acceso al campo se resuelve
+    una vez (attrgetter) en lugar de un getattr por fila.
+    """
+    if not rows:
+        return [[] for _ in range(n)]
+    values_of = attrgetter(field)
+    per_row = [[v.value for v in values_of(row)] for row in rows]
+    return [list(col) for col in zip(*per_row)][:n]
+
+
+def _dim_columns(rows, n: int) -> list[list[str]]:
+    """Valores crudos de las n primeras dimensiones, uno por columna."""
+    return _columns(rows, "dimension_values", n)
+
+
+def _metric_columns(rows, n: int) -> list[list[str]]:
+    """Valores crudos de las n primeras métricas, uno por columna."""
+    return _columns(rows, "metric_values", n)
+
+
+def _parse_yyyymmdd(value: str, cache: Dict[str, date]) -> date:
+    """'YYYYMMDD' -> date con un solo int() y divmod, memoizado en `cache`."""
+    parsed = cache.get(value)
+    if parsed is None:
+        y, md = divmod(int(value), 10000)
+        m, d = divmod(md, 100)
+        parsed = cache[value] = date(y, m, d)
+    return parsed
+
+
+def _parse_dates(values: list[str]) -> list[date]:
+    """Convierte la columna 'date' de GA4 (YYYYMMDD) en bloque.
+
+    Un informe trae como mucho un valor distinto por día del rango, así que cada
+    valor distinto se parsea una vez y el resto se resuelve con un lookup.
+    """
+    cache: Dict[str, date] = {}
+    return [_parse_yyyymmdd(v, cache) for v in values]
+
+
+def _parse_ints(values: list[str]) -> list[int]:
+    """Convierte una columna de métricas a int; vacíos o no numéricos cuentan como 0."""
+    nums = pd.to_numeric(pd.Series(values, dtype=object), errors="coerce").fillna(0)
+    return nums.astype("int64").tolist()
+
+
+def _float_series(values: list[str]) -> pd.Series:
+    """Columna de métricas como float64; vacíos o no numéricos cuentan como 0."""
+    return pd.to_numeric(pd.Series(values, dtype=object), errors="coerce").fillna(0.0).astype("float64")
 
-    client = _build_client()
+
+def _parse_floats(values: list[str]) -> list[float]:
+    return _float_series(values).tolist()
+
+
+def _none_if_empty(values: list[str]) -> list[Optional[str]]:
+    return [v or None for v in values]
+
+
+def _default_to(value: str):
+    """Parser de columna que sustituye vacíos por `value` (p.ej. '/' o '(Unassigned)')."""
+    return lambda values: [v or value for v in values]
+
+
+def _make_decoder(keys: tuple[str, ...], dim_parsers: tuple, metric_parsers: tuple):
+    """Decodificador especializado para un esquema de informe fijo.
+
+    Se construye una vez por informe al importar el módulo: cada dimensión y métrica
+    tiene su parser de columna, así que decodificar es transponer, convertir cada
+    columna en bloque y empaquetar, sin ramas por fila.
+    """
+    n_dims, n_metrics = len(dim_parsers), len(metric_parsers)
+
+    def decode(resp) -> list[Dict[str, Any]]:
+        d = _dim_columns(resp.rows, n_dims)
+        m = _metric_columns(resp.rows, n_metrics)
+        cols = [parse(c) for parse, c in zip(dim_parsers, d)]
+        cols += [parse(c) for parse, c in zip(metric_parsers, m)]
+        return [dict(zip(keys, vals)) for vals in zip(*cols)]
+
+    return decode
+
+
+def _key_events_decoders(keys: tuple[str, ...], dim_parsers: tuple, metric_parsers: tuple):
+    """Par de decodificadores {use_key_events: decode}; la última clave pasa a
+    'key_events' o 'conversions' según la métrica pedida."""
+    return {
+        use_key_events: _make_decoder(
+            keys + ("key_events" if use_key_events else "conversions",),
+            dim_parsers,
+            metric_parsers,
+        )
+        for use_key_events in (True, False)
+    }
+
+
+# Filas por página en run_report. Sin limit explícito GA4 corta en 10k filas sin avisar.
+_PAGE_SIZE = 100_000
+# Páginas pedidas en paralelo como máximo (cuota de GA4: ~10 peticiones concurrentes).
+_MAX_CONCURRENT_PAGES = 8
+# Tope de peticiones simultáneas a la propiedad en todo el proceso: el paginado de un
+# informe se combina con otros hilos (ventanas del backfill de ga_sync, el dashboard),
+# así que la cuota se respeta con un semáforo común alrededor de cada llamada.
+_GA4_REQUEST_SLOTS = threading.BoundedSemaphore(_MAX_CONCURRENT_PAGES)
+
+
+def _run_report(request: RunReportRequest, client: Optional[BetaAnalyticsDataClient] = None):
+    """run_report ocupando uno de los _GA4_REQUEST_SLOTS mientras dura la llamada."""
+    with _GA4_REQUEST_SLOTS:
+        return (client or _get_client()).run_report(request)
+
+
+def _batch_run_reports(batch: BatchRunReportsRequest):
+    with _GA4_REQUEST_SLOTS:
+        return _get_client().batch_run_reports(batch)
+
+
+def _report_pages(request: RunReportRequest, first=None) -> Iterator[Any]:
+    """Recorre un informe por páginas de _PAGE_SIZE usando offset/limit.
+
+    `first` es una primera página ya obtenida (p.ej. desde batchRunReports); si no se
+    pasa, se pide. Con row_count ya se conocen los offsets restantes, así que esas
+    páginas se piden en paralelo y se entregan en orden a medida que llegan.
+    """
+    if first is None:
+        request.limit = _PAGE_SIZE
+        request.offset = 0
+        first = _run_report(request)
+    yield first
+    fetched = len(first.rows)
+    if not first.rows or fetched >= first.row_count:
+        return
+
+    def _page(offset: int):
+        page_req = RunReportRequest(request)
+        page_req.limit = _PAGE_SIZE
+        page_req.offset = offset
+        return _run_report(page_req)
+
+    offsets = range(fetched, first.row_count, _PAGE_SIZE)
+    with ThreadPoolExecutor(max_workers=min(_MAX_CONCURRENT_PAGES, len(offsets))) as ex:
+        yield from ex.map(_page, offsets)
+
+
+def _top_or_all_pages(request: RunReportRequest, limit: Optional[int], first=None) -> Iterable[Any]:
+    """Con `limit` el informe es un top-N: basta la primera página. Con limit=None se
+    pagina hasta row_count para no truncar en silencio."""
+    if limit is None:
+        return _report_pages(request, first=first)
+    return [first if first is not None else _run_report(request)]
+
+
+def _sessions_request(property_id: str, start: date, end: date) -> RunReportRequest:
     # Importante: no incluir sessionDefaultChannelGroup para evitar duplicados
     # cuando agregamos por (date, source, medium, campaign) que es lo que
     # persistimos en la tabla ga_sessions_daily.
-    req = RunReportRequest(
+    return RunReportRequest(
         property=f"properties/{property_id}",
         dimensions=[
-            Dimension(name="date"),
+            _DIM_DATE,
             Dimension(name="source"),
             Dimension(name="medium"),
             Dimension(name="sessionCampaignName"),
@@ -82,33 +342,26 @@ def fetch_sessions_daily(start: date, end: date) -> Iterable[Dict[str, Any]]:
         ],
         date_ranges=[DateRange(start_date=start.isoformat(), end_date=end.isoformat())],
     )
-    resp = client.run_report(req)
-    out: list[Dict[str, Any]] = []
-    for row in resp.rows:
-        d = row.dimension_values
-        m = row.metric_values
-        conv_raw = m[2].value or "0"
-        try:
-            conv_val = int(float(conv_raw))
-        except Exception:
-            conv_val = 0
-        out.append({
-            "date": date(int(d[0].value[0:4]), int(d[0].value[4:6]), int(d[0].value[6:8])),
-            "source": d[1].value or None,
-            "medium": d[2].value or None,
-            "campaign": d[3].value or None,
-            "sessions": int(m[0].value or 0),
-            "users": int(m[1].value or 0),
-            "conversions": conv_val,
-        })
-    return out
+
+
+_sessions_rows = _make_decoder(
+    ("date", "source", "medium", "campaign", "sessions", "users", "conversions"),
+    (_parse_dates, _none_if_empty, _none_if_empty, _none_if_empty),
+    (_parse_ints, _parse_ints, _parse_ints),
+)
+
+
+@_cache_ga4
+def fetch_sessions_daily(start: date, end: date) -> Iterable[Dict[str, Any]]:
+    req = _sessions_request(_property_id(), start, end)
+    return [row for page in _report_pages(req) for row in _sessions_rows(page)]
 
 
 
 def _try_run_report(client: BetaAnalyticsDataClient, request: RunReportRequest):
     """Ejecuta un RunReport con manejo genérico de errores."""
     try:
-        return client.run_report(request)
+        return _run_report(request, client)
     except Exception as e:  # noqa: BLE001
         raise e
 
@@ -120,251 +373,252 @@ def _metric_or_fallback(primary_metric: str, fallback_metric: str, available_met
     return primary_metric if primary_metric in available_metrics else fallback_metric
 
 
-def fetch_pages_screens(start: date, end: date, limit: int = 1000):
+def _key_events_metric(use_key_events: bool) -> Metric:
+    return Metric(name="keyEvents" if use_key_events else "conversions")
+
+
+@lru_cache(maxsize=4)
+def _supports_key_events(property_id: str) -> bool:
+    """Comprueba una sola vez por proceso si la propiedad admite la métrica keyEvents.
+
+    Las propiedades antiguas solo tienen conversions; GA4 responde InvalidArgument.
+    Otros errores (red, cuota) se propagan y no quedan cacheados.
+    """
+    probe = RunReportRequest(
+        property=f"properties/{property_id}",
+        metrics=[Metric(name="keyEvents")],
+        date_ranges=[DateRange(start_date="yesterday", end_date="yesterday")],
+        limit=1,
+    )
+    try:
+        _run_report(probe)
+        return True
+    except InvalidArgument:
+        return False
+
+
+def _run_with_key_events(build) -> tuple[Any, bool]:
+    """Ejecuta `build(use_key_events)` con keyEvents o conversions según la propiedad.
+
+    Devuelve (respuesta, use_key_events).
+    """
+    use_key_events = _supports_key_events(_property_id())
+    return _try_run_report(_get_client(), build(use_key_events)), use_key_events
+
+
+def _pages_screens_request(
+    property_id: str, start: date, end: date, limit: Optional[int], use_key_events: bool
+) -> RunReportRequest:
+    metrics = [
+        Metric(name="screenPageViews"),
+        Metric(name="activeUsers"),
+        Metric(name="screenPageViewsPerUser"),
+        # No existe averageEngagementTime en API → usar userEngagementDuration (segundos totales)
+        Metric(name="userEngagementDuration"),
+        _key_events_metric(use_key_events),
+    ]
+    return RunReportRequest(
+        property=f"properties/{property_id}",
+        dimensions=[Dimension(name="pagePath")],
+        metrics=metrics,
+        date_ranges=[DateRange(start_date=start.isoformat(), end_date=end.isoformat())],
+        order_bys=[OrderBy(metric=OrderBy.MetricOrderBy(metric_name="screenPageViews"), desc=True)],
+        limit=limit or _PAGE_SIZE,
+    )
+
+
+# Orden de métricas según _pages_screens_request; userEngagementDuration en segundos totales
+_PAGES_SCREENS_DECODERS = _key_events_decoders(
+    ("page_path", "views", "active_users", "views_per_user", "user_engagement_duration_sec"),
+    (_default_to("/"),),
+    (_parse_floats,) * 5,
+)
+
+
+def _pages_screens_rows(resp, use_key_events: bool) -> list[dict]:
+    return _PAGES_SCREENS_DECODERS[use_key_events](resp)
+
+
+@_cache_ga4
+def fetch_pages_screens(start: date, end: date, limit: Optional[int] = 1000):
     """
     Devuelve métricas de 'Páginas y pantallas' (GA4) para el rango dado.
     Columnas: pagePath, screenPageViews, screenPageViewsPerUser, userEngagementDuration, keyEvents|conversions
     """
-    load_dotenv()
-    property_id = os.getenv("GA4_PROPERTY_ID")
-    if not property_id:
-        raise RuntimeError("Falta GA4_PROPERTY_ID en el entorno")
+    property_id = _property_id()
+    use_key_events = _supports_key_events(property_id)
+    req = _pages_screens_request(property_id, start, end, limit, use_key_events)
+    return [
+        row for page in _top_or_all_pages(req, limit) for row in _pages_screens_rows(page, use_key_events)
+    ]
+
+
+def _acquisition_channels_request(
+    property_id: str, start: date, end: date, limit: Optional[int], use_key_events: bool
+) -> RunReportRequest:
+    metrics = [
+        Metric(name="sessions"),
+        Metric(name="engagementRate"),
+        _key_events_metric(use_key_events),
+    ]
+    return RunReportRequest(
+        property=f"properties/{property_id}",
+        dimensions=[Dimension(name="sessionDefaultChannelGroup")],
+        metrics=metrics,
+        date_ranges=[DateRange(start_date=start.isoformat(), end_date=end.isoformat())],
+        order_bys=[OrderBy(metric=OrderBy.MetricOrderBy(metric_name="sessions"), desc=True)],
+        limit=limit or _PAGE_SIZE,
+    )
 
-    client = _build_client()
-
-    def _build_request(use_key_events: bool) -> RunReportRequest:
-        metrics = [
-            Metric(name="screenPageViews"),
-            Metric(name="activeUsers"),
-            Metric(name="screenPageViewsPerUser"),
-            # No existe averageEngagementTime en API → usar userEngagementDuration (segundos totales)
-            Metric(name="userEngagementDuration"),
-            Metric(name="keyEvents" if use_key_events else "conversions"),
-        ]
-        return RunReportRequest(
-            property=f"properties/{property_id}",
-            dimensions=[Dimension(name="pagePath")],
-            metrics=metrics,
-            date_ranges=[DateRange(start_date=start.isoformat(), end_date=end.isoformat())],
-            order_bys=[OrderBy(metric=OrderBy.MetricOrderBy(metric_name="screenPageViews"), desc=True)],
-            limit=limit,
-        )
 
-    # 1º intento con keyEvents
-    try:
-        resp = _try_run_report(client, _build_request(use_key_events=True))
-        use_key_events = True
-    except Exception:
-        # 2º intento con conversions (propiedades antiguas sin key events)
-        resp = _try_run_report(client, _build_request(use_key_events=False))
-        use_key_events = False
-
-    out: list[dict] = []
-    for row in resp.rows:
-        d = row.dimension_values
-        m = row.metric_values
-        # Orden de métricas según _build_request
-        views = float(m[0].value or 0)
-        active_users = float(m[1].value or 0)
-        views_per_user = float(m[2].value or 0)
-        user_eng_dur = float(m[3].value or 0)  # en segundos totales
-        key_events = float(m[4].value or 0)
-        out.append(
-            {
-                "page_path": d[0].value or "/",
-                "views": views,
-                "active_users": active_users,
-                "views_per_user": views_per_user,
-                "user_engagement_duration_sec": user_eng_dur,
-                "key_events" if use_key_events else "conversions": key_events,
-            }
-        )
-    return out
+# engagementRate es una proporción [0..1]
+_ACQUISITION_CHANNELS_DECODERS = _key_events_decoders(
+    ("channel", "sessions", "engagement_rate"),
+    (_default_to("(Unassigned)"),),
+    (_parse_floats,) * 3,
+)
 
 
-def fetch_acquisition_channels(start: date, end: date, limit: int = 1000):
+def _acquisition_channels_rows(resp, use_key_events: bool) -> list[dict]:
+    return _ACQUISITION_CHANNELS_DECODERS[use_key_events](resp)
+
+
+@_cache_ga4
+def fetch_acquisition_channels(start: date, end: date, limit: Optional[int] = 1000):
     """
     Devuelve métricas de 'Adquisición de tráfico' agrupadas por sessionDefaultChannelGroup.
     Columnas: channel, sessions, engagementRate, keyEvents|conversions
     """
-    load_dotenv()
-    property_id = os.getenv("GA4_PROPERTY_ID")
-    if not property_id:
-        raise RuntimeError("Falta GA4_PROPERTY_ID en el entorno")
+    property_id = _property_id()
+    use_key_events = _supports_key_events(property_id)
+    req = _acquisition_channels_request(property_id, start, end, limit, use_key_events)
+    return [
+        row for page in _top_or_all_pages(req, limit) for row in _acquisition_channels_rows(page, use_key_events)
+    ]
+
+
+# Piezas inmutables de las peticiones de purchases, construidas una sola vez. Al
+# asignarlas a un RunReportRequest proto-plus las copia, así que compartirlas es seguro.
+_PURCHASE_FILTER = FilterExpression(
+    filter=Filter(
+        field_name="eventName",
+        string_filter=Filter.StringFilter(value="purchase")
+    )
+)
+_DIM_DATE = Dimension(name="date")
+_PURCHASE_SESSION_DIMS = (
+    _DIM_DATE,
+    Dimension(name="sessionSource"),
+    Dimension(name="sessionMedium"),
+    Dimension(name="sessionCampaignName"),
+)
 
-    client = _build_client()
 
-    def _build_request(use_key_events: bool) -> RunReportRequest:
-        metrics = [
-            Metric(name="sessions"),
-            Metric(name="engagementRate"),
-            Metric(name="keyEvents" if use_key_events else "conversions"),
-        ]
-        return RunReportRequest(
-            property=f"properties/{property_id}",
-            dimensions=[Dimension(name="sessionDefaultChannelGroup")],
-            metrics=metrics,
-            date_ranges=[DateRange(start_date=start.isoformat(), end_date=end.isoformat())],
-            order_bys=[OrderBy(metric=OrderBy.MetricOrderBy(metric_name="sessions"), desc=True)],
-            limit=limit,
-        )
+def _purchase_request(
+    property_id: str, start: date, end: date, dimensions, metrics
+) -> RunReportRequest:
+    """Informe de eventos 'purchase' con las dimensiones/métricas indicadas."""
+    return RunReportRequest(
+        property=f"properties/{property_id}",
+        dimensions=list(dimensions),
+        metrics=list(metrics),
+        date_ranges=[DateRange(start_date=start.isoformat(), end_date=end.isoformat())],
+        dimension_filter=_PURCHASE_FILTER,
+    )
 
-    # 1º intento con keyEvents
-    try:
-        resp = _try_run_report(client, _build_request(use_key_events=True))
-        use_key_events = True
-    except Exception:
-        # 2º intento con conversions
-        resp = _try_run_report(client, _build_request(use_key_events=False))
-        use_key_events = False
-
-    out: list[dict] = []
-    for row in resp.rows:
-        d = row.dimension_values
-        m = row.metric_values
-        sessions = float(m[0].value or 0)
-        engagement_rate = float(m[1].value or 0)  # proporción [0..1]
-        key_events = float(m[2].value or 0)
-        out.append(
-            {
-                "channel": d[0].value or "(Unassigned)",
-                "sessions": sessions,
-                "engagement_rate": engagement_rate,
-                "key_events" if use_key_events else "conversions": key_events,
-            }
-        )
-    return out
+
+def _purchases_revenue_request(property_id: str, start: date, end: date) -> RunReportRequest:
+    """Purchases y revenue por día, sesión (source/medium/campaign) e item."""
+    return _purchase_request(
+        property_id, start, end,
+        _PURCHASE_SESSION_DIMS + (Dimension(name="itemName"),),
+        (
+            Metric(name="eventCount"),  # Número de purchases
+            Metric(name="purchaseRevenue"),  # Revenue en la moneda de GA4
+        ),
+    )
 
 
-def fetch_purchases_by_day_item(start: date, end: date) -> Iterable[Dict[str, Any]]:
-    """Devuelve compras (eventos GA4 'purchase') agregadas por día e item.
+_PURCHASE_COLUMNS = (
+    "date", "source", "medium", "campaign", "item_name", "purchases", "revenue_eur",
+)
+_purchases_detailed_rows = _make_decoder(
+    _PURCHASE_COLUMNS,
+    # item_name vacío se guarda como '' (forma parte de uq_ga4_purchases_daily)
+    (_parse_dates, _none_if_empty, _none_if_empty, _none_if_empty, _default_to("")),
+    # Revenue en la moneda configurada en GA4 (se asume EUR).
+    (_parse_ints, _parse_floats),
+)
 
-    Dimensiones: date, itemName
-    Métrica: itemPurchaseQuantity (nº de unidades compradas)
-    """
-    load_dotenv()
-    property_id = os.getenv("GA4_PROPERTY_ID")
-    if not property_id:
-        raise RuntimeError("Falta GA4_PROPERTY_ID en el entorno")
 
-    client = _build_client()
+def _purchases_frame(pages: Iterable[Any]) -> pd.DataFrame:
+    rows = [row for page in pages for row in _purchases_detailed_rows(page)]
+    return pd.DataFrame(rows, columns=list(_PURCHASE_COLUMNS))
 
-    # Filtro por evento 'purchase'
-    event_filter = FilterExpression(
-        filter=Filter(
-            field_name="eventName",
-            string_filter=Filter.StringFilter(value="purchase")
-        )
-    )
 
-    req = RunReportRequest(
-        property=f"properties/{property_id}",
-        dimensions=[
-            Dimension(name="date"),
-            Dimension(name="itemName"),
-        ],
-        metrics=[
-            Metric(name="itemPurchaseQuantity"),
-        ],
-        date_ranges=[DateRange(start_date=start.isoformat(), end_date=end.isoformat())],
-        dimension_filter=event_filter,
-    )
+@_cache_ga4
+def fetch_purchases_detailed(start: date, end: date) -> pd.DataFrame:
+    """Compras GA4 (evento 'purchase') por día, source, medium, campaign e item.
 
-    resp = client.run_report(req)
-    out: list[Dict[str, Any]] = []
-    for row in resp.rows:
-        d = row.dimension_values
-        m = row.metric_values
-        out.append({
-            "date": date(int(d[0].value[0:4]), int(d[0].value[4:6]), int(d[0].value[6:8])),
-            "item_name": d[1].value or None,
-            "purchases": int(float(m[0].value or 0)),
-        })
-    return out
-
-
-def fetch_purchases_by_day_tx(start: date, end: date) -> Iterable[Dict[str, Any]]:
-    """Devuelve compras (purchase) agregadas por día y campaña.
-    Nota: Se omite transactionId para compatibilidad de métricas/dimensiones con eventCount.
-    Dimensiones: date, source, medium, sessionCampaignName
-    Métrica: eventCount (nº de eventos 'purchase')
+    Es el superconjunto del que se derivan las vistas por campaña y por item, de modo
+    que sync_ga4_purchases y la atribución comparten un único informe (y, dentro de
+    la TTL de la caché, una única llamada). Columnas: date, source, medium, campaign,
+    item_name ('' si falta), purchases (eventCount), revenue_eur.
     """
-    load_dotenv()
-    property_id = os.getenv("GA4_PROPERTY_ID")
-    if not property_id:
-        raise RuntimeError("Falta GA4_PROPERTY_ID en el entorno")
+    req = _purchases_revenue_request(_property_id(), start, end)
+    return _purchases_frame(_report_pages(req))
 
-    client = _build_client()
-    event_filter = FilterExpression(
-        filter=Filter(
-            field_name="eventName",
-            string_filter=Filter.StringFilter(value="purchase")
-        )
-    )
-    req = RunReportRequest(
-        property=f"properties/{property_id}",
-        dimensions=[
-            Dimension(name="date"),
-            Dimension(name="sessionSource"),
-            Dimension(name="sessionMedium"),
-            Dimension(name="sessionCampaignName"),
-        ],
-        metrics=[
-            Metric(name="eventCount"),
-        ],
-        date_ranges=[DateRange(start_date=start.isoformat(), end_date=end.isoformat())],
-        dimension_filter=event_filter,
-    )
-    resp = client.run_report(req)
-    out: list[Dict[str, Any]] = []
-    for row in resp.rows:
-        d = row.dimension_values
-        m = row.metric_values
-        out.append({
-            "date": date(int(d[0].value[0:4]), int(d[0].value[4:6]), int(d[0].value[6:8])),
-            "source": d[1].value or None,
-            "medium": d[2].value or None,
-            "campaign": d[3].value or None,
-            "purchases": int(m[0].value or 0),
-        })
-    return out
 
+def _frame_records(df: pd.DataFrame) -> list[Dict[str, Any]]:
+    """Filas de un DataFrame como dicts, con NaN -> None (NULL al insertar)."""
+    return df.astype(object).where(df.notna(), None).to_dict("records")
 
-def fetch_funnel_metrics(start: date, end: date) -> Dict[str, Any]:
+
+def _purchases_by_tx(df: pd.DataFrame) -> list[Dict[str, Any]]:
+    # eventCount con itemName cuenta la compra una vez por item; sumado por campaña
+    # puede superar al nº de eventos en pedidos multi-item (la atribución solo usa las claves).
+    grouped = df.groupby(["date", "source", "medium", "campaign"], dropna=False, sort=False)
+    return _frame_records(grouped["purchases"].sum().reset_index())
+
+
+def _purchases_by_item(df: pd.DataFrame) -> list[Dict[str, Any]]:
+    out = df.groupby(["date", "item_name"], sort=False)["purchases"].sum().reset_index()
+    out["item_name"] = out["item_name"].mask(out["item_name"] == "")
+    return _frame_records(out)
+
+
+def fetch_purchases_by_day_item(start: date, end: date) -> Iterable[Dict[str, Any]]:
+    """Devuelve compras (eventos GA4 'purchase') agregadas por día e item.
+
+    Se deriva de fetch_purchases_detailed: purchases es el nº de eventos purchase que
+    incluyen el item (eventCount), no las unidades.
     """
-    Devuelve métricas agregadas del funnel de conversión:
-    - Sesiones totales
-    - Vistas de página totales
-    - Eventos clave/conversiones totales
-    - Tasa de conversión
+    return _purchases_by_item(fetch_purchases_detailed(start, end))
+
+
+def fetch_purchases_by_day_tx(start: date, end: date) -> Iterator[Dict[str, Any]]:
+    """Genera compras (purchase) agregadas por día y campaña.
+    Nota: Se omite transactionId para compatibilidad de métricas/dimensiones con eventCount.
+    Se deriva de fetch_purchases_detailed agrupando por date, source, medium, campaign.
     """
-    load_dotenv()
-    property_id = os.getenv("GA4_PROPERTY_ID")
-    if not property_id:
-        raise RuntimeError("Falta GA4_PROPERTY_ID en el entorno")
+    yield from _purchases_by_tx(fetch_purchases_detailed(start, end))
 
-    client = _build_client()
 
-    def _build_request(use_key_events: bool) -> RunReportRequest:
-        metrics = [
-            Metric(name="sessions"),
-            Metric(name="screenPageViews"),
-            Metric(name="keyEvents" if use_key_events else "conversions"),
-        ]
-        return RunReportRequest(
-            property=f"properties/{property_id}",
-            dimensions=[],
-            metrics=metrics,
-            date_ranges=[DateRange(start_date=start.isoformat(), end_date=end.isoformat())],
-        )
+def _funnel_request(property_id: str, start: date, end: date, use_key_events: bool) -> RunReportRequest:
+    metrics = [
+        Metric(name="sessions"),
+        Metric(name="screenPageViews"),
+        _key_events_metric(use_key_events),
+    ]
+    return RunReportRequest(
+        property=f"properties/{property_id}",
+        dimensions=[],
+        metrics=metrics,
+        date_ranges=[DateRange(start_date=start.isoformat(), end_date=end.isoformat())],
+    )
 
-    try:
-        resp = _try_run_report(client, _build_request(use_key_events=True))
-        use_key_events = True
-    except Exception:
-        resp = _try_run_report(client, _build_request(use_key_events=False))
-        use_key_events = False
 
+def _funnel_metrics(resp) -> Dict[str, Any]:
     if not resp.rows:
         return {
             "sessions": 0,
@@ -388,102 +642,164 @@ def fetch_funnel_metrics(start: date, end: date) -> Dict[str, Any]:
     }
 
 
+@_cache_ga4
+def fetch_funnel_metrics(start: date, end: date) -> Dict[str, Any]:
+    """
+    Devuelve métricas agregadas del funnel de conversión:
+    - Sesiones totales
+    - Vistas de página totales
+    - Eventos clave/conversiones totales
+    - Tasa de conversión
+    """
+    property_id = _property_id()
+    resp, _ = _run_with_key_events(lambda ke: _funnel_request(property_id, start, end, ke))
+    return _funnel_metrics(resp)
+
+
+def _trends_request(property_id: str, start: date, end: date, use_key_events: bool) -> RunReportRequest:
+    metrics = [
+        Metric(name="sessions"),
+        Metric(name="screenPageViews"),
+        Metric(name="engagementRate"),
+        _key_events_metric(use_key_events),
+    ]
+    return RunReportRequest(
+        property=f"properties/{property_id}",
+        dimensions=[Dimension(name="date")],
+        metrics=metrics,
+        date_ranges=[DateRange(start_date=start.isoformat(), end_date=end.isoformat())],
+        order_bys=[OrderBy(dimension=OrderBy.DimensionOrderBy(dimension_name="date"))],
+    )
+
+
+_TRENDS_DECODERS = _key_events_decoders(
+    ("date", "sessions", "views", "engagement_rate"),
+    (_parse_dates,),
+    (_parse_floats,) * 4,
+)
+
+
+def _trends_rows(resp, use_key_events: bool) -> list[Dict[str, Any]]:
+    return _TRENDS_DECODERS[use_key_events](resp)
+
+
+@_cache_ga4
 def fetch_trends_daily(start: date, end: date) -> Iterable[Dict[str, Any]]:
     """
     Devuelve tendencias diarias de métricas clave:
     date, sessions, views, key_events, engagement_rate
     """
-    load_dotenv()
-    property_id = os.getenv("GA4_PROPERTY_ID")
-    if not property_id:
-        raise RuntimeError("Falta GA4_PROPERTY_ID en el entorno")
+    property_id = _property_id()
+    resp, use_key_events = _run_with_key_events(
+        lambda ke: _trends_request(property_id, start, end, ke)
+    )
+    return _trends_rows(resp, use_key_events)
+
+
+def _landing_pages_request(
+    property_id: str, start: date, end: date, limit: Optional[int], use_key_events: bool
+) -> RunReportRequest:
+    metrics = [
+        Metric(name="sessions"),
+        Metric(name="bounceRate"),
+        _key_events_metric(use_key_events),
+    ]
+    return RunReportRequest(
+        property=f"properties/{property_id}",
+        dimensions=[Dimension(name="landingPage")],
+        metrics=metrics,
+        date_ranges=[DateRange(start_date=start.isoformat(), end_date=end.isoformat())],
+        order_bys=[OrderBy(metric=OrderBy.MetricOrderBy(metric_name="sessions"), desc=True)],
+        limit=limit or _PAGE_SIZE,
+    )
 
-    client = _build_client()
 
-    def _build_request(use_key_events: bool) -> RunReportRequest:
-        metrics = [
-            Metric(name="sessions"),
-            Metric(name="screenPageViews"),
-            Metric(name="engagementRate"),
-            Metric(name="keyEvents" if use_key_events else "conversions"),
-        ]
-        return RunReportRequest(
-            property=f"properties/{property_id}",
-            dimensions=[Dimension(name="date")],
-            metrics=metrics,
-            date_ranges=[DateRange(start_date=start.isoformat(), end_date=end.isoformat())],
-            order_bys=[OrderBy(dimension=OrderBy.DimensionOrderBy(dimension_name="date"))],
-        )
+def _landing_pages_rows(resp, use_key_events: bool) -> list[Dict[str, Any]]:
+    d = _dim_columns(resp.rows, 1)
+    m = _metric_columns(resp.rows, 3)
+    sessions = _float_series(m[0])
+    key_events = _float_series(m[2])
+    conversion_rate = (key_events / sessions.where(sessions > 0) * 100.0).fillna(0.0)
+    keys = (
+        "landing_page",
+        "sessions",
+        "bounce_rate",
+        "key_events" if use_key_events else "conversions",
+        "conversion_rate",
+    )
+    cols = (
+        [v or "/" for v in d[0]],
+        sessions.tolist(),
+        _parse_floats(m[1]),
+        key_events.tolist(),
+        conversion_rate.tolist(),
+    )
+    return [dict(zip(keys, vals)) for vals in zip(*cols)]
 
-    try:
-        resp = _try_run_report(client, _build_request(use_key_events=True))
-        use_key_events = True
-    except Exception:
-        resp = _try_run_report(client, _build_request(use_key_events=False))
-        use_key_events = False
-
-    out: list[Dict[str, Any]] = []
-    for row in resp.rows:
-        d = row.dimension_values
-        m = row.metric_values
-        out.append({
-            "date": date(int(d[0].value[0:4]), int(d[0].value[4:6]), int(d[0].value[6:8])),
-            "sessions": float(m[0].value or 0),
-            "views": float(m[1].value or 0),
-            "engagement_rate": float(m[2].value or 0),
-            "key_events" if use_key_events else "conversions": float(m[3].value or 0),
-        })
-    return out
-
-
-def fetch_landing_pages(start: date, end: date, limit: int = 50) -> Iterable[Dict[str, Any]]:
+
+@_cache_ga4
+def fetch_landing_pages(start: date, end: date, limit: Optional[int] = 50) -> Iterable[Dict[str, Any]]:
     """
     Devuelve landing pages con métricas de conversión:
     landingPage, sessions, bounceRate, keyEvents, conversionRate
     """
-    load_dotenv()
-    property_id = os.getenv("GA4_PROPERTY_ID")
-    if not property_id:
-        raise RuntimeError("Falta GA4_PROPERTY_ID en el entorno")
-
-    client = _build_client()
-
-    def _build_request(use_key_events: bool) -> RunReportRequest:
-        metrics = [
-            Metric(name="sessions"),
-            Metric(name="bounceRate"),
-            Metric(name="keyEvents" if use_key_events else "conversions"),
-        ]
-        return RunReportRequest(
-            property=f"properties/{property_id}",
-            dimensions=[Dimension(name="landingPage")],
-            metrics=metrics,
-            date_ranges=[DateRange(start_date=start.isoformat(), end_date=end.isoformat())],
-            order_bys=[OrderBy(metric=OrderBy.MetricOrderBy(metric_name="sessions"), desc=True)],
-            limit=limit,
-        )
+    property_id = _property_id()
+    use_key_events = _supports_key_events(property_id)
+    req = _landing_pages_request(property_id, start, end, limit, use_key_events)
+    return [
+        row for page in _top_or_all_pages(req, limit) for row in _landing_pages_rows(page, use_key_events)
+    ]
+
+
+@_cache_ga4
+def fetch_dashboard_bundle(
+    start: date,
+    end: date,
+    pages_limit: Optional[int] = 1000,
+    channels_limit: Optional[int] = 1000,
+    landing_limit: Optional[int] = 50,
+) -> Dict[str, Any]:
+    """Los cinco informes de la pestaña Analytics en un único batchRunReports.
+
+    Devuelve {"pages_screens", "acquisition_channels", "funnel", "trends", "landing_pages"}
+    con el mismo formato que los fetch_* individuales. Las propiedades sin keyEvents
+    usan conversions (ver _supports_key_events). Un límite None trae todas las filas,
+    pidiendo las páginas que no quepan en el batch.
+    """
+    property_id = _property_id()
+    use_key_events = _supports_key_events(property_id)
+    pages_req = _pages_screens_request(property_id, start, end, pages_limit, use_key_events)
+    channels_req = _acquisition_channels_request(property_id, start, end, channels_limit, use_key_events)
+    landing_req = _landing_pages_request(property_id, start, end, landing_limit, use_key_events)
+    batch = BatchRunReportsRequest(
+        property=f"properties/{property_id}",
+        requests=[
+            pages_req,
+            channels_req,
+            _funnel_request(property_id, start, end, use_key_events),
+            _trends_request(property_id, start, end, use_key_events),
+            landing_req,
+        ],
+    )
+    resp = _batch_run_reports(batch)
 
-    try:
-        resp = _try_run_report(client, _build_request(use_key_events=True))
-        use_key_events = True
-    except Exception:
-        resp = _try_run_report(client, _build_request(use_key_events=False))
-        use_key_events = False
-
-    out: list[Dict[str, Any]] = []
-    for row in resp.rows:
-        d = row.dimension_values
-        m = row.metric_values
-        sessions = float(m[0].value or 0)
-        bounce_rate = float(m[1].value or 0)
-        key_events = float(m[2].value or 0)
-        conversion_rate = (key_events / sessions * 100.0) if sessions > 0 else 0.0
-
-        out.append({
-            "landing_page": d[0].value or "/",
-            "sessions": sessions,
-            "bounce_rate": bounce_rate,
-            "key_events" if use_key_events else "conversions": key_events,
-            "conversion_rate": conversion_rate,
-        })
-    return out
+    pages, channels, funnel, trends, landing = resp.reports
+    return {
+        "pages_screens": [
+            row
+            for page in _top_or_all_pages(pages_req, pages_limit, first=pages)
+            for row in _pages_screens_rows(page, use_key_events)
+        ],
+        "acquisition_channels": [
+            row
+            for page in _top_or_all_pages(channels_req, channels_limit, first=channels)
+            for row in _acquisition_channels_rows(page, use_key_events)
+        ],
+        "funnel": _funnel_metrics(funnel),
+        "trends": _trends_rows(trends, use_key_events),
+        "landing_pages": [
+            row
+            for page in _top_or_all_pages(landing_req, landing_limit, first=landing)
+            for row in _landing_pages_rows(page, use_key_events)
+        ],
+    }
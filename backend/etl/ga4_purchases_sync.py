@@ -2,11 +2,12 @@
 Sincronización de purchases y revenue desde GA4 Data API.
 Guarda en ga4_purchases_daily como fuente de verdad para revenue total.
 """
-import os
 import logging
-from datetime import date, datetime
-from typing import Dict, Any
-from dotenv import load_dotenv
+from datetime import date
+from itertools import islice
+
+import numpy as np
+import pandas as pd
 
 from backend.db.config import engine
 try:
@@ -14,13 +15,14 @@ try:
 except ImportError:
     # Si el modelo no está disponible, crear la referencia directamente
     GA4PurchasesDaily = None
-from backend.etl.ga4_client import _build_client
-from google.analytics.data_v1beta import RunReportRequest, DateRange, Dimension, Metric, FilterExpression, Filter
+from backend.etl.ga4_client import _frame_records, fetch_purchases_detailed
 from sqlalchemy.dialects.postgresql import insert
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+_UPSERT_CHUNK_SIZE = 5000
+
 
 def detect_platform(source: str | None, medium: str | None, campaign: str | None) -> str:
     """Detecta la plataforma basándose en source/medium/campaign de GA4."""
@@ -53,6 +55,32 @@ def detect_platform(source: str | None, medium: str | None, campaign: str | None
     return 'organic'
 
 
+_CPC_MEDIUMS = ("cpc", "ppc")
+_ORGANIC_MEDIUMS = ("organic", "referral", "none", "")
+
+
+def detect_platforms(source: pd.Series, medium: pd.Series, campaign: pd.Series) -> list[str]:
+    """Versión vectorizada de detect_platform sobre columnas completas.
+
+    Mismo orden de reglas: CPC o gclid -> google_ads; fbclid -> meta; medium orgánico
+    -> organic; campaign no vacía -> other_paid; resto -> organic. `source` no decide
+    nada en detect_platform (sus ramas devuelven lo mismo), así que no se evalúa.
+    """
+    m = medium.fillna("").str.lower()
+    c = campaign.fillna("").str.lower()
+    platform = np.select(
+        [
+            m.isin(_CPC_MEDIUMS) | c.str.contains("gclid", regex=False),
+            c.str.contains("fbclid", regex=False),
+            m.isin(_ORGANIC_MEDIUMS),
+            c.ne(""),
+        ],
+        ["google_ads", "meta", "organic", "other_paid"],
+        default="organic",
+    )
+    return platform.tolist()
+
+
 def sync_ga4_purchases(start_date: date, end_date: date):
     """
     Sincroniza purchases y revenue desde GA4 Data API.
@@ -60,101 +88,40 @@ def sync_ga4_purchases(start_date: date, end_date: date):
     """
     logger.info(f"Iniciando sincronización de purchases GA4 desde {start_date} hasta {end_date}...")
     
-    load_dotenv()
-    property_id = os.getenv("GA4_PROPERTY_ID")
-    if not property_id:
-        raise RuntimeError("Falta GA4_PROPERTY_ID en el entorno")
-    
     try:
-        client = _build_client()
-        
-        # Filtro por evento 'purchase'
-        event_filter = FilterExpression(
-            filter=Filter(
-                field_name="eventName",
-                string_filter=Filter.StringFilter(value="purchase")
-            )
-        )
-        
-        req = RunReportRequest(
-            property=f"properties/{property_id}",
-            dimensions=[
-                Dimension(name="date"),
-                Dimension(name="sessionSource"),
-                Dimension(name="sessionMedium"),
-                Dimension(name="sessionCampaignName"),
-                Dimension(name="itemName"),  # Para granularidad de productos
-            ],
-            metrics=[
-                Metric(name="eventCount"),  # Número de purchases
-                Metric(name="purchaseRevenue"),  # Revenue en la moneda de GA4
-            ],
-            date_ranges=[DateRange(start_date=start_date.isoformat(), end_date=end_date.isoformat())],
-            dimension_filter=event_filter,
-        )
-        
-        resp = client.run_report(req)
-        purchases_data = []
-        
-        for row in resp.rows:
-            d = row.dimension_values
-            m = row.metric_values
-            
-            date_str = d[0].value
-            source = d[1].value or None
-            medium = d[2].value or None
-            campaign = d[3].value or None
-            item_name = d[4].value or None
-            
-            # Obtener métricas
-            purchases = int(float(m[0].value or 0))
-            revenue_raw = m[1].value or "0"
-            try:
-                revenue = float(revenue_raw)
-            except (ValueError, TypeError):
-                revenue = 0.0
-            
-            # Detectar plataforma
-            platform = detect_platform(source, medium, campaign)
-            
-            # Convertir revenue a EUR (asumiendo que GA4 devuelve en la moneda configurada)
-            # TODO: Si GA4 devuelve en otra moneda, necesitaríamos un conversor
-            revenue_eur = revenue
-            
-            purchases_data.append({
-                "date": datetime.strptime(date_str, "%Y%m%d"),
-                "source": source,
-                "medium": medium,
-                "campaign": campaign,
-                "item_name": item_name,
-                "purchases": purchases,
-                "revenue_eur": revenue_eur,
-                "platform_detected": platform,
-            })
-        
-        if not purchases_data:
+        # Mismo informe (memoizado) que usa la atribución vía fetch_purchases_by_day_tx
+        df = fetch_purchases_detailed(start_date, end_date)
+        if df.empty:
             logger.info("No se encontraron purchases en GA4 para el rango de fechas.")
             return
         
-        # Upsert en la base de datos
-        # Para manejar NULLs en item_name, normalizamos a '' si es None
-        for row in purchases_data:
-            if row["item_name"] is None:
-                row["item_name"] = ""
-        
-        with engine.begin() as conn:
-            stmt = insert(GA4PurchasesDaily).values(purchases_data)
-            stmt = stmt.on_conflict_do_update(
-                constraint='uq_ga4_purchases_daily',
-                set_={
-                    'purchases': stmt.excluded.purchases,
-                    'revenue_eur': stmt.excluded.revenue_eur,
-                    'platform_detected': stmt.excluded.platform_detected,
-                }
+        # Upsert por bloques (executemany) en lugar de un único INSERT gigante.
+        stmt = insert(GA4PurchasesDaily)
+        stmt = stmt.on_conflict_do_update(
+            constraint='uq_ga4_purchases_daily',
+            set_={
+                'purchases': stmt.excluded.purchases,
+                'revenue_eur': stmt.excluded.revenue_eur,
+                'platform_detected': stmt.excluded.platform_detected,
+            }
+        )
+        processed = 0
+        rows = iter(
+            _frame_records(
+                df.assign(
+                    platform_detected=detect_platforms(df["source"], df["medium"], df["campaign"])
+                )
             )
-            conn.execute(stmt)
+        )
+        with engine.begin() as conn:
+            while True:
+                chunk = list(islice(rows, _UPSERT_CHUNK_SIZE))
+                if not chunk:
+                    break
+                conn.execute(stmt, chunk)
+                processed += len(chunk)
         
-        logger.info(f"Sincronización GA4 completada. Se procesaron {len(purchases_data)} registros.")
+        logger.info(f"Sincronización GA4 completada. Se procesaron {processed} registros.")
         
     except Exception as e:
         logger.error(f"Error durante la sincronización de purchases GA4: {e}", exc_info=True)
@@ -1,95 +1,96 @@
 from __future__ import annotations
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import date, timedelta, datetime
+from itertools import islice
 from typing import Iterable, Dict, Any, Optional
 
-from backend.db.config import db_session
-from backend.db.models import GaSessionsDaily, SyncState
+from sqlalchemy import bindparam, select
+from sqlalchemy.dialects.postgresql import insert
+
+from backend.db.config import engine
+from backend.db.models import GaSessionsDaily, SyncState, UTC_NOW
 from . import ga4_client
 
 
+_UPSERT_CHUNK_SIZE = 5000
+# Ventanas del backfill en paralelo; cada una puede paginar a su vez, pero el total de
+# peticiones simultáneas lo limita ga4_client (_GA4_REQUEST_SLOTS, cuota GA4 ~10).
+_BACKFILL_WORKERS = 4
+_insert_sessions = insert(GaSessionsDaily.__table__)
+_INSERT_SESSIONS = _insert_sessions.on_conflict_do_nothing(constraint="uq_ga_sessions_daily_dim")
+_UPSERT_SESSIONS = _insert_sessions.on_conflict_do_update(
+    constraint="uq_ga_sessions_daily_dim",
+    set_={
+        "sessions": _insert_sessions.excluded.sessions,
+        "users": _insert_sessions.excluded.users,
+        "conversions": _insert_sessions.excluded.conversions,
+    },
+)
+_SEL_STATE = select(SyncState.value).where(SyncState.key == bindparam("key"))
+_insert_state = insert(SyncState.__table__)
+_UPSERT_STATE = _insert_state.on_conflict_do_update(
+    index_elements=["key"],
+    set_={"value": _insert_state.excluded.value, "updated_at": UTC_NOW},
+)
+
+
 def _get_state(key: str) -> Optional[str]:
-    # Evita excepciones si existen duplicados legacy en sync_state
-    with db_session() as s:
-        st = (
-            s.query(SyncState)
-            .filter(SyncState.key == key)
-            .order_by(SyncState.id.desc())
-            .first()
-        )
-        return st.value if st else None
+    with engine.connect() as conn:
+        return conn.execute(_SEL_STATE, {"key": key}).scalar_one_or_none()
 
 
 def _set_state(key: str, value: str) -> None:
-    # Upsert tolerante a duplicados preexistentes
-    with db_session() as s:
-        st = (
-            s.query(SyncState)
-            .filter(SyncState.key == key)
-            .order_by(SyncState.id.desc())
-            .first()
-        )
-        if st:
-            st.value = value
-        else:
-            s.add(SyncState(key=key, value=value))
-
-
-def _dedupe_state_key(key: str) -> None:
-    """Elimina duplicados de SyncState conservando el más reciente.
-    Previene errores de MultipleResultsFound en entornos legacy.
-    """
-    with db_session() as s:
-        rows = (
-            s.query(SyncState)
-            .filter(SyncState.key == key)
-            .order_by(SyncState.id.desc())
-            .all()
-        )
-        if len(rows) > 1:
-            for r in rows[1:]:
-                s.delete(r)
+    # Upsert atómico sobre la clave única de sync_state (una sola sentencia)
+    with engine.begin() as conn:
+        conn.execute(_UPSERT_STATE, {"key": key, "value": value})
 
 
 def _upsert_rows(rows: Iterable[Dict[str, Any]], insert_only: bool = True) -> int:
+    """Upsert por bloques contra uq_ga_sessions_daily_dim.
+
+    Con insert_only las filas existentes no se tocan (ON CONFLICT DO NOTHING); si no,
+    se actualizan sus métricas. Devuelve el nº de filas recibidas. Va por Core sobre
+    una conexión: no se crean objetos ORM ni interviene el flush de la sesión.
+    """
+    stmt = _INSERT_SESSIONS if insert_only else _UPSERT_SESSIONS
     count = 0
-    with db_session() as s:
-        for r in rows:
-            existing = (
-                s.query(GaSessionsDaily)
-                .filter_by(
-                    date=r.get("date"),
-                    source=r.get("source"),
-                    medium=r.get("medium"),
-                    campaign=r.get("campaign"),
-                )
-                .order_by(GaSessionsDaily.id.asc())
-                .first()
-            )
-            if existing:
-                if not insert_only:
-                    existing.sessions = r.get("sessions")
-                    existing.users = r.get("users")
-                    existing.conversions = r.get("conversions")
-            else:
-                s.add(GaSessionsDaily(
-                    date=r.get("date"),
-                    source=r.get("source"),
-                    medium=r.get("medium"),
-                    campaign=r.get("campaign"),
-                    sessions=r.get("sessions"),
-                    users=r.get("users"),
-                    conversions=r.get("conversions"),
-                ))
-            count += 1
+    it = iter(rows)
+    with engine.begin() as conn:
+        while True:
+            chunk = list(islice(it, _UPSERT_CHUNK_SIZE))
+            if not chunk:
+                break
+            count += len(chunk)
+            # Un mismo ON CONFLICT DO UPDATE no puede tocar dos veces la misma fila
+            by_key: Dict[tuple, Dict[str, Any]] = {}
+            for r in chunk:
+                key = (r.get("date"), r.get("source"), r.get("medium"), r.get("campaign"))
+                by_key[key] = {
+                    "date": key[0],
+                    "source": key[1],
+                    "medium": key[2],
+                    "campaign": key[3],
+                    "sessions": r.get("sessions"),
+                    "users": r.get("users"),
+                    "conversions": r.get("conversions"),
+                }
+            conn.execute(stmt, list(by_key.values()))
     return count
 
 
+def _sync_range(start: date, end: date, insert_only: bool = True, cached: bool = True) -> int:
+    # cached=False (backfill): ventanas que nadie vuelve a pedir, no deben ocupar la caché
+    # de ga4_client durante su TTL largo
+    fetch = ga4_client.fetch_sessions_daily if cached else ga4_client.fetch_sessions_daily.__wrapped__
+    rows = fetch(start, end)
+    return _upsert_rows(rows, insert_only=insert_only)
+
+
 def run_ga_sync(days_back: int = 30, insert_only: bool = True) -> int:
     end = date.today()
     # incremental con cursor
     cursor_key = "ga_sessions_cursor"
-    _dedupe_state_key(cursor_key)
     cursor = _get_state(cursor_key)
     start: date
     if cursor:
@@ -100,32 +101,38 @@ def run_ga_sync(days_back: int = 30, insert_only: bool = True) -> int:
             start = end - timedelta(days=days_back)
     else:
         start = end - timedelta(days=days_back)
-    rows = list(ga4_client.fetch_sessions_daily(start, end))
-    inserted = _upsert_rows(rows, insert_only=insert_only)
+    inserted = _sync_range(start, end, insert_only=insert_only)
     _set_state(cursor_key, end.isoformat())
     return inserted
 
 
 def run_ga_sync_range(start: date, end: date, insert_only: bool = True) -> int:
-    _dedupe_state_key("ga_sessions_cursor")
-    rows = list(ga4_client.fetch_sessions_daily(start, end))
-    inserted = _upsert_rows(rows, insert_only=insert_only)
+    inserted = _sync_range(start, end, insert_only=insert_only)
     _set_state("ga_sessions_cursor", end.isoformat())
     return inserted
 
 
-def run_ga_backfill(total_days: int = 3650, chunk_days: int = 30, insert_only: bool = True) -> int:
-    """Backfill histórico en ventanas hasta cubrir total_days (por defecto ~10 años)."""
+def run_ga_backfill(
+    total_days: int = 3650,
+    chunk_days: int = 30,
+    insert_only: bool = True,
+    max_workers: int = _BACKFILL_WORKERS,
+) -> int:
+    """Backfill histórico en ventanas hasta cubrir total_days (por defecto ~10 años).
+
+    Las ventanas son disjuntas e independientes, así que se procesan en paralelo
+    (fetch GA4 + upsert por hilo); el cursor se escribe una sola vez al final.
+    """
     end = date.today()
     start_total = end - timedelta(days=total_days)
-    inserted = 0
+    windows: list[tuple[date, date]] = []
     current_end = end
-    while current_end > start_total:
+    while current_end >= start_total:
         current_start = max(start_total, current_end - timedelta(days=chunk_days))
-        inserted += run_ga_sync_range(current_start, current_end, insert_only=insert_only)
-        current_end = current_start
+        windows.append((current_start, current_end))
+        current_end = current_start - timedelta(days=1)
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        futures = [ex.submit(_sync_range, ws, we, insert_only, False) for ws, we in windows]
+        inserted = sum(f.result() for f in as_completed(futures))
+    _set_state("ga_sessions_cursor", end.isoformat())
     return inserted
-
-
-
-
@@ -5,20 +5,61 @@ Variables esperadas en .env:
  - GOOGLE_ADS_CUSTOMER_ID
  - GOOGLE_ADS_CLIENT_ID / GOOGLE_ADS_CLIENT_SECRET (pueden ser los de GA4)
  - GOOGLE_ADS_REFRESH_TOKEN
+ - GOOGLE_ADS_ACCESS_TOKEN / GOOGLE_ADS_ACCESS_TOKEN_EXPIRY (opcionales, token ya emitido)
 """
 from __future__ import annotations
 
+import hashlib
 import os
-from datetime import date, timedelta
-from typing import Iterable, Dict, Any
-import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
+from functools import lru_cache, partial
+from itertools import chain, islice
+from operator import attrgetter
+from string import Template
+from typing import Iterator, Dict, Any, List, Optional, Tuple
 from google.ads.googleads.client import GoogleAdsClient
+from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from dotenv import load_dotenv
 
+from . import token_cache
+
+
+load_dotenv()
+
+
+# segments.date solo toma tantos valores como días tenga el rango: se parsea una vez
+# por fecha distinta, no una vez por fila
+_parse_date = lru_cache(maxsize=1024)(date.fromisoformat)
+
+
+def _env_access_token() -> Optional[Tuple[str, datetime]]:
+    """(access_token, expires_at UTC) de GOOGLE_ADS_ACCESS_TOKEN(_EXPIRY) si sigue vigente.
+
+    Permite que quien lanza el proceso (cron, orquestador) inyecte un token ya emitido
+    y evitar el intercambio OAuth al arrancar. La expiración va en ISO 8601 o epoch (s).
+    """
+    token = (os.getenv("GOOGLE_ADS_ACCESS_TOKEN") or "").strip()
+    raw_expiry = (os.getenv("GOOGLE_ADS_ACCESS_TOKEN_EXPIRY") or "").strip()
+    if not token or not raw_expiry:
+        return None
+    try:
+        if raw_expiry.isdigit():
+            expires_at = datetime.fromtimestamp(int(raw_expiry), tz=timezone.utc)
+        else:
+            expires_at = datetime.fromisoformat(raw_expiry.replace("Z", "+00:00"))
+    except (OverflowError, OSError, ValueError):
+        return None
+    if expires_at.tzinfo is None:
+        expires_at = expires_at.replace(tzinfo=timezone.utc)
+    if expires_at - datetime.now(timezone.utc) < token_cache.EXPIRY_MARGIN:
+        return None
+    return token, expires_at
+
 
 def _build_client() -> GoogleAdsClient:
-    load_dotenv()
     devtoken = os.getenv("GOOGLE_ADS_DEVELOPER_TOKEN")
     # Si el usuario del refresh token no está en la MCC, usar el propio CUSTOMER_ID como login header
     login = os.getenv("GOOGLE_ADS_LOGIN_CUSTOMER_ID") or os.getenv("GOOGLE_ADS_CUSTOMER_ID")
@@ -38,126 +79,294 @@ def _build_client() -> GoogleAdsClient:
     refresh_token = os.getenv("GOOGLE_ADS_REFRESH_TOKEN")
     if not all([devtoken, client_id, client_secret, refresh_token]):
         raise RuntimeError("Faltan credenciales de Google Ads en .env")
+    # Access token inyectado por entorno o de una ejecución anterior si sigue vigente; si
+    # no, se renueva aquí y se guarda para los siguientes procesos (clave ligada también
+    # al refresh token). Con token vigente google-auth solo refresca al caducar.
+    cache_id = f"{client_id}:{hashlib.sha256(refresh_token.encode()).hexdigest()[:16]}"
+    cached = _env_access_token() or token_cache.load_token("google_ads", cache_id)
     creds = Credentials(
-        None,
+        cached[0] if cached else None,
         refresh_token=refresh_token,
         token_uri="https://oauth2.googleapis.com/token",
         client_id=client_id,
         client_secret=client_secret,
         scopes=["https://www.googleapis.com/auth/adwords"],
+        # google-auth compara expiry como UTC naive
+        expiry=cached[1].replace(tzinfo=None) if cached else None,
+    )
+    if not cached:
+        creds.refresh(Request())
+        token_cache.store_token("google_ads", cache_id, creds.token, creds.expiry)
+    # Sin envoltorios proto-plus: las filas del stream son mensajes protobuf nativos, mucho
+    # más rápidos de recorrer campo a campo (los enums llegan como int, ver _enum_name).
+    return GoogleAdsClient(
+        credentials=creds,
+        developer_token=devtoken,
+        login_customer_id=login,
+        use_proto_plus=False,
+    )
+
+
+def _enum_name(message, field: str) -> str:
+    """Nombre de un campo enum de un mensaje protobuf nativo (p.ej. Ad.type -> 'RESPONSIVE_SEARCH_AD')."""
+    enum_value = message.DESCRIPTOR.fields_by_name[field].enum_type.values_by_number.get(
+        getattr(message, field)
     )
-    return GoogleAdsClient(credentials=creds, developer_token=devtoken, login_customer_id=login)
+    return enum_value.name if enum_value is not None else "UNKNOWN"
 
 
-def fetch_costs_daily(start: date, end: date) -> Iterable[Dict[str, Any]]:
-    load_dotenv()
+def _customer_id() -> str:
     customer_id = os.getenv("GOOGLE_ADS_CUSTOMER_ID")
     if not customer_id:
         raise RuntimeError("Falta GOOGLE_ADS_CUSTOMER_ID en .env")
+    return customer_id
+
+
+@lru_cache(maxsize=1)
+def _get_client() -> GoogleAdsClient:
+    """Cliente compartido entre llamadas: una sola construcción de credenciales y un
+    único refresh OAuth por proceso (el entorno no cambia en caliente)."""
+    return _build_client()
+
+
+@lru_cache(maxsize=1)
+def _ads_service():
+    # GoogleAdsService mantiene el canal gRPC; reutilizarlo evita un handshake por llamada
+    return _get_client().get_service("GoogleAdsService")
+
+
+def reload_env() -> None:
+    """Relee .env (sobrescribiendo el entorno) y descarta el cliente y servicio cacheados.
+
+    El .env se carga una sola vez al importar el módulo; esto es para tests o
+    procesos largos que cambian credenciales en caliente.
+    """
+    load_dotenv(override=True)
+    _ads_service.cache_clear()
+    _get_client.cache_clear()
+
+
+# Campos de cada fila resueltos de una vez (attrgetter en C) en vez de una cadena de
+# getattr por campo y fila
+_COST_FIELDS = attrgetter(
+    "segments.date",
+    "customer.currency_code",
+    "campaign.id",
+    "campaign.name",
+    "ad_group.id",
+    "ad_group.name",
+    "ad_group_ad.ad.id",
+    "ad_group_ad.ad.name",
+    "metrics.cost_micros",
+    "metrics.impressions",
+    "metrics.clicks",
+    "metrics.average_cpc",
+)
+_CONVERSION_FIELDS = attrgetter(
+    "segments.date",
+    "customer.currency_code",
+    "campaign.id",
+    "campaign.name",
+    "ad_group.id",
+    "ad_group.name",
+    "ad_group_ad.ad.id",
+    "ad_group_ad.ad.name",
+    "segments.conversion_action",
+    "conversion_action.name",
+    "metrics.conversions",
+    "metrics.conversions_value",
+)
+
+
+# GAQL no admite parámetros enlazados: plantillas fijas a nivel de módulo, con las
+# fechas validadas y formateadas por _gaql_range
+_COST_QUERY = Template("""
+    SELECT
+      segments.date,
+      customer.currency_code,
+      campaign.id,
+      campaign.name,
+      ad_group.id,
+      ad_group.name,
+      ad_group_ad.ad.id,
+      ad_group_ad.ad.name,
+      metrics.cost_micros,
+      metrics.clicks,
+      metrics.impressions,
+      metrics.average_cpc,
+      ad_group_ad.ad.type
+    FROM ad_group_ad
+    WHERE segments.date BETWEEN '$start' AND '$end'
+""")
+_CONVERSION_QUERY = Template("""
+    SELECT
+      segments.date,
+      customer.currency_code,
+      campaign.id,
+      campaign.name,
+      ad_group.id,
+      ad_group.name,
+      ad_group_ad.ad.id,
+      ad_group_ad.ad.name,
+      segments.conversion_action,
+      conversion_action.name,
+      conversion_action.category,
+      conversion_action.type,
+      metrics.conversions,
+      metrics.conversions_value
+    FROM ad_group_ad
+    WHERE segments.date BETWEEN '$start' AND '$end'
+      AND conversion_action.category IN (PURCHASE)
+""")
+
 
-    client = _build_client()
-    ga_service = client.get_service("GoogleAdsService")
-
-    query = f"""
-        SELECT
-          segments.date,
-          customer.currency_code,
-          campaign.id,
-          campaign.name,
-          ad_group.id,
-          ad_group.name,
-          ad_group_ad.ad.id,
-          ad_group_ad.ad.name,
-          metrics.cost_micros,
-          metrics.clicks,
-          metrics.impressions,
-          metrics.average_cpc,
-          ad_group_ad.ad.type
-        FROM ad_group_ad
-        WHERE segments.date BETWEEN '{start.isoformat()}' AND '{end.isoformat()}'
+def _gaql_range(start: date, end: date) -> Dict[str, str]:
+    """{"start", "end"} en YYYY-MM-DD; falla al llamar y no a mitad de un stream."""
+    for value in (start, end):
+        if not isinstance(value, date):
+            raise TypeError(f"Se esperaba una fecha (date) y se recibió {type(value).__name__}")
+    # datetime es subclase de date; isoformat() metería la hora en la GAQL
+    if isinstance(start, datetime):
+        start = start.date()
+    if isinstance(end, datetime):
+        end = end.date()
+    return {"start": start.isoformat(), "end": end.isoformat()}
+
+
+def _stream_rows(stream) -> Iterator[Any]:
+    """Filas de todos los lotes de un search_stream, aplanadas en C (sin doble bucle)."""
+    return chain.from_iterable(batch.results for batch in stream)
+
+
+def fetch_costs_daily(start: date, end: date) -> Iterator[Dict[str, Any]]:
+    """Costes diarios a nivel anuncio de [start, end].
+
+    Un rango de hasta _SHARD_DAYS días es un único search_stream cuyas filas se entregan
+    según llegan. Los rangos más largos (backfills) se trocean en ventanas que se piden en
+    paralelo sobre el mismo servicio (los canales gRPC admiten llamadas concurrentes), con
+    como mucho _MAX_WORKERS ventanas en vuelo, y se entregan en orden de ventana.
     """
+    _gaql_range(start, end)
+    customer_id = _customer_id()
+    ga_service = _ads_service()
+    windows = _date_windows(start, end)
+    if len(windows) == 1:
+        return _search_costs(ga_service, customer_id, start, end)
+    return _fetch_windows(_search_costs, ga_service, customer_id, windows)
+
+
+def _search_costs(ga_service, customer_id: str, start: date, end: date) -> Iterator[Dict[str, Any]]:
+    query = _COST_QUERY.substitute(_gaql_range(start, end))
     stream = ga_service.search_stream(customer_id=customer_id, query=query)
-    out: list[Dict[str, Any]] = []
-    for batch in stream:
-        for row in batch.results:
-            d = row.segments.date
-            
-            out.append({
-                "date": date.fromisoformat(d),
-                "platform": "google_ads",
-                "account_id": customer_id,
-                "campaign_id": str(row.campaign.id),
-                "campaign_name": row.campaign.name,
-                "adset_id": str(row.ad_group.id),
-                "adset_name": row.ad_group.name,
-                "ad_id": str(row.ad_group_ad.ad.id),
-                "ad_name": row.ad_group_ad.ad.name,
-                "ad_type": str(getattr(row.ad_group_ad.ad, 'type_', None) or 'UNKNOWN'),
-                "currency": row.customer.currency_code,
-                "cost_major": float(row.metrics.cost_micros) / 1_000_000.0,
-                "impressions": int(row.metrics.impressions),
-                "clicks": int(row.metrics.clicks),
-                "average_cpc": float(getattr(row.metrics, 'average_cpc', 0) or 0) / 1_000_000.0,
-            })
-    return out
-
-
-def fetch_conversions_daily(start: date, end: date) -> Iterable[Dict[str, Any]]:
+    # Generador: las filas se entregan según llegan los lotes del stream, sin acumularlas
+    yield from map(partial(_cost_row, customer_id), _stream_rows(stream))
+
+
+def _cost_row(customer_id: str, row) -> Dict[str, Any]:
+    (
+        d, currency, campaign_id, campaign_name, adset_id, adset_name,
+        ad_id, ad_name, cost_micros, impressions, clicks, average_cpc,
+    ) = _COST_FIELDS(row)
+    return {
+        "date": _parse_date(d),
+        "platform": "google_ads",
+        "account_id": customer_id,
+        "campaign_id": str(campaign_id),
+        "campaign_name": campaign_name,
+        "adset_id": str(adset_id),
+        "adset_name": adset_name,
+        "ad_id": str(ad_id),
+        "ad_name": ad_name,
+        "ad_type": _enum_name(row.ad_group_ad.ad, "type"),
+        "currency": currency,
+        "cost_major": float(cost_micros) / 1_000_000.0,
+        "impressions": int(impressions),
+        "clicks": int(clicks),
+        "average_cpc": float(average_cpc or 0) / 1_000_000.0,
+    }
+
+
+def fetch_conversions_daily(start: date, end: date) -> Iterator[Dict[str, Any]]:
     """Devuelve conversiones y valor por día a nivel anuncio, desglosado por acción de conversión.
 
     Incluye detalles de la acción (nombre, tipo, categoría) para entender el origen del tracking
     (importadas de GA4, etiqueta web, offline, etc. según configuración de la cuenta).
     """
-    load_dotenv()
-    customer_id = os.getenv("GOOGLE_ADS_CUSTOMER_ID")
-    if not customer_id:
-        raise RuntimeError("Falta GOOGLE_ADS_CUSTOMER_ID en .env")
+    _gaql_range(start, end)
+    customer_id = _customer_id()
+    return _search_conversions(_ads_service(), customer_id, start, end)
 
-    client = _build_client()
-    ga_service = client.get_service("GoogleAdsService")
-
-    query = f"""
-        SELECT
-          segments.date,
-          customer.currency_code,
-          campaign.id,
-          campaign.name,
-          ad_group.id,
-          ad_group.name,
-          ad_group_ad.ad.id,
-          ad_group_ad.ad.name,
-          segments.conversion_action,
-          conversion_action.name,
-          conversion_action.category,
-          conversion_action.type,
-          metrics.conversions,
-          metrics.conversions_value
-        FROM ad_group_ad
-        WHERE segments.date BETWEEN '{start.isoformat()}' AND '{end.isoformat()}'
-          AND conversion_action.category IN (PURCHASE)
-    """
+
+def _search_conversions(
+    ga_service, customer_id: str, start: date, end: date
+) -> Iterator[Dict[str, Any]]:
+    query = _CONVERSION_QUERY.substitute(_gaql_range(start, end))
     stream = ga_service.search_stream(customer_id=customer_id, query=query)
-    out: list[Dict[str, Any]] = []
-    for batch in stream:
-        for row in batch.results:
-            d = row.segments.date
-            out.append({
-                "date": date.fromisoformat(d),
-                "platform": "google_ads",
-                "account_id": customer_id,
-                "campaign_id": str(row.campaign.id),
-                "campaign_name": row.campaign.name,
-                "adset_id": str(row.ad_group.id),
-                "adset_name": row.ad_group.name,
-                "ad_id": str(row.ad_group_ad.ad.id),
-                "ad_name": row.ad_group_ad.ad.name,
-                "currency": row.customer.currency_code,
-                "conversion_action": row.segments.conversion_action,
-                "conversion_action_name": getattr(row.conversion_action, "name", None),
-                "conversion_action_category": getattr(row.conversion_action, "category", None),
-                "conversion_action_type": getattr(row.conversion_action, "type", None),
-                "conversions": float(row.metrics.conversions or 0),
-                "conversions_value": float(row.metrics.conversions_value or 0.0),
-            })
-    return out
+    yield from map(partial(_conversion_row, customer_id), _stream_rows(stream))
+
+
+def _conversion_row(customer_id: str, row) -> Dict[str, Any]:
+    (
+        d, currency, campaign_id, campaign_name, adset_id, adset_name, ad_id,
+        ad_name, conversion_action, action_name, conversions, conversions_value,
+    ) = _CONVERSION_FIELDS(row)
+    return {
+        "date": _parse_date(d),
+        "platform": "google_ads",
+        "account_id": customer_id,
+        "campaign_id": str(campaign_id),
+        "campaign_name": campaign_name,
+        "adset_id": str(adset_id),
+        "adset_name": adset_name,
+        "ad_id": str(ad_id),
+        "ad_name": ad_name,
+        "currency": currency,
+        "conversion_action": conversion_action,
+        "conversion_action_name": action_name,
+        "conversion_action_category": _enum_name(row.conversion_action, "category"),
+        "conversion_action_type": _enum_name(row.conversion_action, "type"),
+        "conversions": float(conversions or 0),
+        "conversions_value": float(conversions_value or 0.0),
+    }
+
+
+# search_stream concurrentes como máximo (cada uno es I/O gRPC independiente)
+_MAX_WORKERS = 4
+# Días por ventana al trocear rangos largos
+_SHARD_DAYS = 31
+
 
+def _date_windows(start: date, end: date, days: int = _SHARD_DAYS) -> List[Tuple[date, date]]:
+    """Ventanas disjuntas [ws, we] de como mucho `days` días que cubren [start, end]."""
+    windows: List[Tuple[date, date]] = []
+    current = start
+    while current <= end:
+        window_end = min(end, current + timedelta(days=days - 1))
+        windows.append((current, window_end))
+        current = window_end + timedelta(days=1)
+    return windows
+
+
+def _collect(search, ga_service, customer_id: str, start: date, end: date) -> List[Dict[str, Any]]:
+    return list(search(ga_service, customer_id, start, end))
+
+
+def _fetch_windows(
+    search, ga_service, customer_id: str, windows: List[Tuple[date, date]]
+) -> Iterator[Dict[str, Any]]:
+    """Filas de `search` por ventana, con hasta _MAX_WORKERS ventanas descargándose a la vez.
+
+    Cola acotada de futuros: solo se encarga una ventana nueva al entregar la más antigua,
+    así que la memoria no crece con el número de ventanas del rango.
+    """
+    pending = iter(windows)
+    with ThreadPoolExecutor(max_workers=_MAX_WORKERS) as ex:
+        in_flight = deque(
+            ex.submit(_collect, search, ga_service, customer_id, ws, we)
+            for ws, we in islice(pending, _MAX_WORKERS)
+        )
+        while in_flight:
+            rows = in_flight.popleft().result()
+            for ws, we in islice(pending, 1):
+                in_flight.append(ex.submit(_collect, search, ga_service, customer_id, ws, we))
+            yield from rows
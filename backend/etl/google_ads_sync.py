@@ -3,6 +3,10 @@ Módulo para la sincronización de datos de rendimiento de Google Ads.
 """
 import os
 from datetime import date, datetime
+from functools import lru_cache
+from itertools import chain, islice
+from string import Template
+from typing import Any, Dict, Iterator
 import logging
 from google.ads.googleads.client import GoogleAdsClient
 from google.ads.googleads.errors import GoogleAdsException
@@ -12,26 +16,74 @@ from dotenv import load_dotenv
 from backend.db.config import engine
 from backend.db.models import GoogleAdsInsightsDaily
 
+load_dotenv()
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+_UPSERT_CHUNK_SIZE = 5000
+_insert_insights = insert(GoogleAdsInsightsDaily.__table__)
+_UPSERT_INSIGHTS = _insert_insights.on_conflict_do_update(
+    index_elements=['date', 'ad_id'],
+    set_={
+        'conversions': _insert_insights.excluded.conversions,
+        'conversions_value': _insert_insights.excluded.conversions_value,
+    }
+)
+
+_INSIGHTS_QUERY = Template("""
+    SELECT
+        campaign.id,
+        ad_group.id,
+        ad_group_ad.ad.id,
+        customer.currency_code,
+        metrics.conversions,
+        metrics.conversions_value,
+        segments.date
+    FROM ad_group_ad
+    WHERE
+        segments.date BETWEEN '$start' AND '$end'
+        AND metrics.conversions > 0
+""")
+
 def get_google_ads_client():
     """Inicializa y devuelve el cliente de la API de Google Ads usando variables de entorno."""
     try:
-        from backend.etl.google_ads_client import _build_client
-        load_dotenv()
-        client = _build_client()
+        from backend.etl.google_ads_client import _get_client
+        client = _get_client()
         return client
     except Exception as e:
         logger.error(f"Error al inicializar el cliente de Google Ads: {e}", exc_info=True)
         return None
 
+@lru_cache(maxsize=1024)
+def _segment_datetime(value: str) -> datetime:
+    """segments.date ('YYYY-MM-DD') a datetime a medianoche, memoizado por fecha."""
+    return datetime.fromisoformat(value)
+
+def _insight_rows(stream, customer_id: str) -> Iterator[Dict[str, Any]]:
+    """Filas con conversiones, según llegan del search_stream.
+
+    Las filas sin conversiones ya las descarta la GAQL (metrics.conversions > 0):
+    no viajan ni se deserializan.
+    """
+    for row in chain.from_iterable(batch.results for batch in stream):
+        yield {
+            "date": _segment_datetime(row.segments.date),
+            "account_id": customer_id,
+            "campaign_id": str(row.campaign.id),
+            "adgroup_id": str(row.ad_group.id),
+            "ad_id": str(row.ad_group_ad.ad.id),
+            "conversions": float(row.metrics.conversions),
+            "conversions_value": float(row.metrics.conversions_value or 0.0),
+            "currency": row.customer.currency_code or "EUR",
+        }
+
 def sync_google_ads_insights(start_date: date, end_date: date):
     """
     Sincroniza los datos de rendimiento de Google Ads.
     El customer_id se carga desde las variables de entorno.
     """
-    load_dotenv()
     customer_id = os.getenv("GOOGLE_ADS_CUSTOMER_ID")
     if not customer_id:
         raise ValueError("La variable de entorno GOOGLE_ADS_CUSTOMER_ID no está definida en el .env")
@@ -43,63 +95,32 @@ def sync_google_ads_insights(start_date: date, end_date: date):
     if not client:
         return
 
-    ga_service = client.get_service("GoogleAdsService")
-
-    query = f"""
-        SELECT
-            campaign.id,
-            ad_group.id,
-            ad_group_ad.ad.id,
-            customer.currency_code,
-            metrics.conversions,
-            metrics.conversions_value,
-            segments.date
-        FROM ad_group_ad
-        WHERE
-            segments.date BETWEEN '{start_date.strftime("%Y-%m-%d")}' AND '{end_date.strftime("%Y-%m-%d")}'
-    """
+    # Servicio cacheado en google_ads_client: mismo canal gRPC que los demás fetch
+    from backend.etl.google_ads_client import _ads_service, _gaql_range
+    ga_service = _ads_service()
+
+    query = _INSIGHTS_QUERY.substitute(_gaql_range(start_date, end_date))
 
     try:
         stream = ga_service.search_stream(customer_id=customer_id, query=query)
-        insights_data = []
-
-        for batch in stream:
-            for row in batch.results:
-                conversions = float(row.metrics.conversions or 0)
-                conversions_value = float(row.metrics.conversions_value or 0.0)
-                
-                # Solo incluir si hay conversiones o valor
-                if conversions > 0 or conversions_value > 0:
-                    insights_data.append({
-                        "date": datetime.strptime(row.segments.date, "%Y-%m-%d"),
-                        "account_id": customer_id,
-                        "campaign_id": str(row.campaign.id),
-                        "adgroup_id": str(row.ad_group.id),
-                        "ad_id": str(row.ad_group_ad.ad.id),
-                        "conversions": conversions,
-                        "conversions_value": conversions_value,
-                        "currency": row.customer.currency_code or "EUR",
-                    })
-
-        if not insights_data:
+        rows = _insight_rows(stream, customer_id)
+
+        # Upsert por bloques (executemany) a medida que llegan los lotes del stream:
+        # memoria acotada a un bloque en lugar de todo el rango
+        processed = 0
+        with engine.begin() as conn:
+            while True:
+                chunk = list(islice(rows, _UPSERT_CHUNK_SIZE))
+                if not chunk:
+                    break
+                conn.execute(_UPSERT_INSIGHTS, chunk)
+                processed += len(chunk)
+
+        if not processed:
             logger.info(f"No se encontraron insights de Google Ads para el cliente {customer_id}.")
             return
 
-        # Upsert en la base de datos
-        with engine.begin() as conn:
-            stmt = insert(GoogleAdsInsightsDaily).values(insights_data)
-            # Necesitamos un índice único para el upsert
-            # Lo añadiremos al modelo
-            stmt = stmt.on_conflict_do_update(
-                index_elements=['date', 'ad_id'],
-                set_={
-                    'conversions': stmt.excluded.conversions,
-                    'conversions_value': stmt.excluded.conversions_value,
-                }
-            )
-            conn.execute(stmt)
-
-        logger.info(f"Sincronizados {len(insights_data)} registros de insights de Google Ads para el cliente {customer_id}.")
+        logger.info(f"Sincronizados {processed} registros de insights de Google Ads para el cliente {customer_id}.")
 
     except GoogleAdsException as ex:
         logger.error(f"Error en la petición a la API de Google Ads: {ex}")
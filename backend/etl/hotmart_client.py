@@ -1,14 +1,23 @@
 from __future__ import annotations
 
+import json
 import os
-from datetime import datetime
-from typing import Dict, Iterable, Optional
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, Optional, Tuple
 
 import requests
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from tenacity import retry, stop_after_attempt, wait_exponential
 import base64
 
+from . import token_cache
+
 
 load_dotenv()
 
@@ -23,6 +32,37 @@ BASE_URLS = [
     "https://api-sec-vlc.hotmart.com",
 ]
 
+# Páginas pedidas en paralelo una vez conocido total_pages
+_MAX_PARALLEL_PAGES = 8
+
+
+def _build_session() -> requests.Session:
+    """Sesión compartida con keep-alive: evita un handshake TCP+TLS por petición.
+
+    Los GET (idempotentes) se reintentan en el adaptador ante 429/5xx; el POST del
+    token no, y su reintento sigue en manos de @retry.
+    """
+    retry_get = Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset({"GET"}),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=len(BASE_URLS), pool_maxsize=2 * _MAX_PARALLEL_PAGES, max_retries=retry_get)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    return session
+
+
+_session = _build_session()
+
+# Vida asumida del token si la respuesta no trae expires_in
+_DEFAULT_TOKEN_TTL = timedelta(hours=1)
+# Token client_credentials vigente en este proceso: (access_token, expires_at UTC)
+_token: Optional[Tuple[str, datetime]] = None
+_token_lock = threading.Lock()
+
 
 def _headers(token: str) -> Dict[str, str]:
     return {
@@ -43,6 +83,30 @@ def get_token() -> str:
     if not HOTMART_CLIENT_ID or not HOTMART_CLIENT_SECRET:
         raise RuntimeError("Configura HOTMART_CLIENT_ID y HOTMART_CLIENT_SECRET o HOTMART_ACCESS_TOKEN")
 
+    # 3) Token ya obtenido (en este proceso o en uno anterior) que aún no caduca
+    global _token
+    with _token_lock:
+        now = datetime.now(timezone.utc)
+        if _token is None or _token[1] - now < token_cache.EXPIRY_MARGIN:
+            _token = token_cache.load_token("hotmart", HOTMART_CLIENT_ID)
+        if _token is not None:
+            return _token[0]
+        token, expires_at = _request_token()
+        _token = (token, expires_at)
+        token_cache.store_token("hotmart", HOTMART_CLIENT_ID, token, expires_at)
+        return token
+
+
+def _forget_token() -> None:
+    global _token
+    with _token_lock:
+        _token = None
+    if HOTMART_CLIENT_ID:
+        token_cache.clear_token("hotmart", HOTMART_CLIENT_ID)
+
+
+def _request_token() -> Tuple[str, datetime]:
+    """Intercambio client_credentials; devuelve (access_token, expires_at UTC)."""
     basic = base64.b64encode(f"{HOTMART_CLIENT_ID}:{HOTMART_CLIENT_SECRET}".encode()).decode()
     headers_basic = {
         "Authorization": f"Basic {basic}",
@@ -58,7 +122,7 @@ def get_token() -> str:
     for base in BASE_URLS:
         for headers in (headers_basic, headers_plain):
             try:
-                resp = requests.post(
+                resp = _session.post(
                     f"{base}/security/oauth/token",
                     data={
                         "grant_type": "client_credentials",
@@ -75,58 +139,133 @@ def get_token() -> str:
                     data = {}
                 token = (data or {}).get("access_token")
                 if token:
-                    return token
+                    try:
+                        ttl = timedelta(seconds=int(data["expires_in"]))
+                    except (KeyError, TypeError, ValueError):
+                        ttl = _DEFAULT_TOKEN_TTL
+                    return token, datetime.now(timezone.utc) + ttl
             except Exception as e:
                 last_err = e
     raise RuntimeError(f"Hotmart: no se pudo obtener access_token ({last_err})")
 
 
+_PATH_CANDIDATES = [
+    "/payments/api/v1/transactions",
+    "/payments/api/v1/sales",
+]
+
+# (base, path) que respondió la última vez; se prueba primero y evita el sondeo
+# base×path en cada página. Se persiste junto a la caché de tokens.
+_resolved_endpoint: Optional[Tuple[str, str]] = None
+_endpoint_lock = threading.Lock()
+
+
+def _endpoint_path() -> str:
+    return os.path.join(token_cache.cache_dir(), "hotmart.json")
+
+
+def _load_endpoint() -> Optional[Tuple[str, str]]:
+    try:
+        with open(_endpoint_path(), encoding="utf-8") as f:
+            data = json.load(f)
+        endpoint = (data["base"], data["path"])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    # Solo se reutiliza si sigue siendo uno de los candidatos configurados
+    if endpoint[0] in BASE_URLS and endpoint[1] in _PATH_CANDIDATES:
+        return endpoint
+    return None
+
+
+def _remember_endpoint(endpoint: Tuple[str, str]) -> None:
+    global _resolved_endpoint
+    with _endpoint_lock:
+        if _resolved_endpoint == endpoint:
+            return
+        _resolved_endpoint = endpoint
+    try:
+        os.makedirs(token_cache.cache_dir(), exist_ok=True)
+        tmp = f"{_endpoint_path()}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"base": endpoint[0], "path": endpoint[1]}, f)
+        os.replace(tmp, _endpoint_path())
+    except OSError:
+        pass
+
+
+def _endpoint_candidates() -> Iterable[Tuple[str, str]]:
+    """Endpoint resuelto primero; el resto solo si ese deja de responder (404)."""
+    global _resolved_endpoint
+    with _endpoint_lock:
+        if _resolved_endpoint is None:
+            _resolved_endpoint = _load_endpoint()
+        resolved = _resolved_endpoint
+    if resolved is not None:
+        yield resolved
+    for base in BASE_URLS:
+        for path in _PATH_CANDIDATES:
+            if (base, path) != resolved:
+                yield base, path
+
+
 @retry(wait=wait_exponential(min=1, max=10), stop=stop_after_attempt(5))
-def list_transactions(updated_after: Optional[datetime] = None) -> Iterable[Dict]:
+def _fetch_page(page: int, updated_after: Optional[datetime] = None) -> Dict:
+    """Una página de transacciones (JSON ya parseado). Se reintenta de forma independiente."""
     token = get_token()
-    path_candidates = [
-        "/payments/api/v1/transactions",
-        "/payments/api/v1/sales",
-    ]
-    page = 1
-    while True:
-        params = {"page": page, "rows": 100}
-        if updated_after:
-            params["start_date"] = int(updated_after.timestamp() * 1000)
-
-        response_ok = None
-        for base in BASE_URLS:
-            for path in path_candidates:
-                url = f"{base}{path}"
-                resp = requests.get(url, headers=_headers(token), params=params, timeout=60, allow_redirects=True)
-                if resp.status_code in (200, 206):
-                    response_ok = resp
-                    break
-                # 404: probar siguiente path/base
-                if resp.status_code in (401, 403):
-                    # Autorización inválida
-                    resp.raise_for_status()
-            if response_ok:
-                break
-
-        if not response_ok:
-            raise requests.HTTPError("No se encontró un endpoint válido para Hotmart (404 en todas las rutas)")
-
-        # Parseo robusto: algunos proxies devuelven HTML o cuerpo vacío con 200
-        data = {}
-        try:
-            if "application/json" in (response_ok.headers.get("Content-Type") or "").lower():
-                data = response_ok.json() or {}
-            else:
-                data = response_ok.json() or {}
-        except Exception:
-            data = {}
-        items = data.get("items") or data.get("list") or []
-        for it in items:
-            yield it
-        total_pages = (data.get("total_pages") or data.get("totalPages") or 1)
-        if page >= int(total_pages):
+    params = {"page": page, "rows": 100}
+    if updated_after:
+        params["start_date"] = int(updated_after.timestamp() * 1000)
+
+    response_ok = None
+    for base, path in _endpoint_candidates():
+        url = f"{base}{path}"
+        resp = _session.get(url, headers=_headers(token), params=params, timeout=60, allow_redirects=True)
+        if resp.status_code in (200, 206):
+            response_ok = resp
+            _remember_endpoint((base, path))
             break
-        page += 1
+        # 404: probar siguiente path/base
+        if resp.status_code in (401, 403):
+            # Autorización inválida: descartar el token cacheado para que el
+            # reintento pida uno nuevo
+            _forget_token()
+            resp.raise_for_status()
+
+    if not response_ok:
+        raise requests.HTTPError("No se encontró un endpoint válido para Hotmart (404 en todas las rutas)")
+
+    # Parseo robusto: algunos proxies devuelven HTML o cuerpo vacío con 200
+    try:
+        return response_ok.json() or {}
+    except Exception:
+        return {}
 
 
+def _page_items(data: Dict) -> list:
+    return data.get("items") or data.get("list") or []
+
+
+def list_transactions(updated_after: Optional[datetime] = None) -> Iterable[Dict]:
+    """Genera las transacciones en orden de página.
+
+    La primera página da total_pages; el resto se piden por adelantado en paralelo
+    (hasta _MAX_PARALLEL_PAGES en vuelo) mientras se consumen las anteriores.
+    """
+    first = _fetch_page(1, updated_after)
+    yield from _page_items(first)
+    total_pages = int(first.get("total_pages") or first.get("totalPages") or 1)
+    if total_pages <= 1:
+        return
+    pages = iter(range(2, total_pages + 1))
+    with ThreadPoolExecutor(max_workers=_MAX_PARALLEL_PAGES) as ex:
+        # Ventana acotada de páginas en vuelo: memoria O(_MAX_PARALLEL_PAGES), no O(total)
+        pending = deque(
+            ex.submit(_fetch_page, page, updated_after)
+            for page in islice(pages, _MAX_PARALLEL_PAGES)
+        )
+        while pending:
+            data = pending.popleft().result()
+            next_page = next(pages, None)
+            if next_page is not None:
+                pending.append(ex.submit(_fetch_page, next_page, updated_after))
+            yield from _page_items(data)
@@ -1,9 +1,13 @@
 from datetime import datetime, timedelta, timezone
+from decimal import ROUND_HALF_UP, Decimal, InvalidOperation
+from itertools import islice
 from typing import Optional
 
-from sqlalchemy import select
+from sqlalchemy import case, func, literal_column, or_, select
+from sqlalchemy.dialects.postgresql import insert
 
-from backend.db.config import db_session
+from backend.db.config import db_session, engine
+from backend.db.copy import copy_insert
 from backend.db.models import Customer, Order, Payment, Refund, SyncState, Product, OrderItem
 from backend.etl.hotmart_client import list_transactions
 
@@ -39,23 +43,22 @@ def _set_sync_dt(key: str, dt: datetime) -> None:
 
 
 def _parse_dt_any(value: Optional[str]) -> Optional[datetime]:
+    # Despacho por forma del valor en lugar de encadenar try/except: se llama por transacción
     if not value:
         return None
-    s = str(value).strip()
-    # ISO con o sin Z
-    for v in (s, s.replace("Z", "+00:00")):
-        try:
-            return datetime.fromisoformat(v)
-        except Exception:
-            pass
+    s = value.strip() if isinstance(value, str) else str(value)
     # Epoch (ms o s)
     if s.isdigit():
+        iv = int(s)
         try:
-            iv = int(s)
-            if iv > 10_000_000_000:  # ms
-                return datetime.fromtimestamp(iv / 1000, tz=timezone.utc)
-            return datetime.fromtimestamp(iv, tz=timezone.utc)
-        except Exception:
+            return datetime.fromtimestamp(iv / 1000 if iv > 10_000_000_000 else iv, tz=timezone.utc)
+        except (OverflowError, OSError, ValueError):
+            return None
+    # ISO con o sin Z (sin Z se queda naive, como hasta ahora)
+    if len(s) >= 10 and s[4] == "-":
+        try:
+            return datetime.fromisoformat(s.replace("Z", "+00:00") if s.endswith("Z") else s)
+        except ValueError:
             return None
     return None
 
@@ -67,12 +70,281 @@ def _first(*vals):
     return None
 
 
+# Transacciones por lote: una sesión y una consulta por tabla por lote, no por transacción
+_TX_BATCH_SIZE = 500
+# En el primer backfill (tablas frías) se usan lotes mayores cargados con COPY
+_COLD_BATCH_SIZE = 5000
+
+
+def _tx_fields(tx: dict) -> dict:
+    """Campos normalizados de una transacción Hotmart (tolerante a variantes de la API).
+
+    El importe se deja en bruto (amount_raw); _batch_fields lo pasa a unidades menores.
+    """
+    # Sub-objetos resueltos una vez (antes se releían en cada candidato)
+    purchase = tx.get("purchase") or {}
+    price = tx.get("price") or {}
+    product_info = tx.get("product") or {}
+
+    # Campos robustos
+    tx_id = _first(
+        tx.get("transaction"),
+        purchase.get("transaction"),
+        tx.get("id"),
+        purchase.get("id"),
+    )
+    
+    # Estado
+    status_raw = _first(
+        tx.get("status"),
+        tx.get("transaction_status"),
+        purchase.get("status"),
+    ) or ""
+
+    # Email
+    email = _first(
+        (tx.get("buyer") or {}).get("email"),
+        (tx.get("customer") or {}).get("email"),
+        tx.get("customer_email"),
+        tx.get("email"),
+    )
+
+    # Moneda
+    currency = _first(
+        tx.get("currency"),
+        tx.get("currency_code"),
+        purchase.get("currency_code"),
+        price.get("currency_code"),
+    )
+
+    # Fechas
+    created_str = _first(
+        tx.get("approved_date"),
+        tx.get("purchase_date"),
+        tx.get("date_created"),
+        tx.get("approvedDate"),
+        tx.get("purchaseDate"),
+        tx.get("creationDate"),
+        tx.get("lastUpdateDate"),
+        tx.get("approved_at"),
+    )
+    return {
+        "tx_id": tx_id,
+        "product_id": str(product_info.get("id", "")),
+        "product_name": product_info.get("name"),
+        "status": str(status_raw).lower(),
+        "email": email,
+        "currency": str(currency).upper() if currency else "EUR",
+        # Importe
+        "amount_raw": _first(
+            tx.get("value"),
+            tx.get("amount"),
+            price.get("value"),
+            purchase.get("amount"),
+        ),
+        "created": _parse_dt_any(created_str),
+        "raw": tx,
+    }
+
+
+_CENT = Decimal("0.01")
+
+
+def _to_minor(value) -> int:
+    """Importe a unidades menores exactas (19.99 -> 1999) sin pasar por float * 100.
+
+    Decimal(str(x)) conserva el literal decimal (también para floats del JSON, cuyo str
+    es el más corto que los representa); se redondea a céntimos con ROUND_HALF_UP.
+    Vacío, no numérico o no finito -> 0, como antes.
+    """
+    if value is None or value == "" or isinstance(value, bool):
+        return 0
+    try:
+        amount = Decimal(value.strip() if isinstance(value, str) else str(value))
+    except InvalidOperation:
+        return 0
+    if not amount.is_finite():
+        return 0
+    return int(amount.quantize(_CENT, rounding=ROUND_HALF_UP).scaleb(2))
+
+
+def _batch_fields(txs: list[dict]) -> list[dict]:
+    """_tx_fields de un lote, con el importe a unidades menores exactas."""
+    fields = [_tx_fields(tx) for tx in txs]
+    for f in fields:
+        f["amount_minor"] = _to_minor(f.pop("amount_raw"))
+    return fields
+
+
+_customers = Customer.__table__
+_products = Product.__table__
+_orders = Order.__table__
+_order_items = OrderItem.__table__
+_payments = Payment.__table__
+
+# Clientes, productos y pedidos existentes no se modifican: solo se crean los que faltan
+_INSERT_CUSTOMERS = insert(_customers).on_conflict_do_nothing(constraint="uq_customer_source_id")
+_INSERT_PRODUCTS = insert(_products).on_conflict_do_nothing(constraint="uq_product_source_id")
+_INSERT_ORDERS = insert(_orders).on_conflict_do_nothing(constraint="uq_order_source_id")
+_INSERT_PAYMENTS = (
+    insert(_payments)
+    .on_conflict_do_nothing(constraint="uq_payment_source_id")
+    .returning(_payments.c.id)
+)
+_insert_payments = insert(_payments)
+_excluded = _insert_payments.excluded
+_PAYMENT_UPDATES = {
+    "status": func.coalesce(func.nullif(_excluded.status, ""), _payments.c.status),
+    "paid_at": func.coalesce(_excluded.paid_at, _payments.c.paid_at),
+    "amount_original_minor": case(
+        (_excluded.amount_original_minor != 0, _excluded.amount_original_minor),
+        else_=_payments.c.amount_original_minor,
+    ),
+    "currency_original": func.coalesce(
+        func.nullif(_excluded.currency_original, ""), _payments.c.currency_original
+    ),
+}
+# Solo se reescribe (y cuenta como actualizado) el pago cuyos campos cambian.
+# RETURNING xmax = 0 distingue filas insertadas de actualizadas.
+_UPSERT_PAYMENTS = (
+    _insert_payments.on_conflict_do_update(
+        constraint="uq_payment_source_id",
+        set_={**_PAYMENT_UPDATES, "raw": _excluded.raw},
+        where=or_(*(_payments.c[col].is_distinct_from(expr) for col, expr in _PAYMENT_UPDATES.items())),
+    )
+    .returning(literal_column("xmax = 0"))
+)
+
+
+def _insert_missing(conn, stmt, table, constraint: str, rows: list[dict], use_copy: bool) -> None:
+    """INSERT ... ON CONFLICT DO NOTHING de `rows`, por COPY + staging si use_copy."""
+    if not rows:
+        return
+    if use_copy:
+        copy_insert(
+            conn, table.name, tuple(rows[0]), rows,
+            on_conflict=f"ON CONFLICT ON CONSTRAINT {constraint} DO NOTHING",
+        )
+    else:
+        conn.execute(stmt, rows)
+
+
+def _id_map(conn, table, key_col: str, keys: set) -> dict:
+    """{clave de origen: id} para las filas Hotmart con esas claves."""
+    if not keys:
+        return {}
+    key = table.c[key_col]
+    rows = conn.execute(
+        select(key, table.c.id).where(table.c.source == "hotmart", key.in_(keys))
+    )
+    return {source_id: id_ for source_id, id_ in rows}
+
+
+def _sync_tx_batch(batch: list[dict], insert_only: bool, use_copy: bool = False) -> tuple[int, int]:
+    """Persiste un lote de transacciones ya normalizadas; devuelve (inserted, updated).
+
+    Una sentencia INSERT ... ON CONFLICT por tabla y lote (executemany), en orden de
+    dependencia: clientes/productos -> pedidos -> líneas/pagos. Los ids de las claves
+    foráneas se resuelven con una SELECT IN por tabla tras cada insert.
+    Con use_copy (solo insert_only) cada tabla se carga con COPY a una tabla temporal y
+    un único INSERT ... SELECT ... ON CONFLICT DO NOTHING.
+    """
+    # Una fila por transacción (la última gana): un mismo ON CONFLICT DO UPDATE no
+    # puede tocar dos veces la misma fila
+    by_tx = {f["tx_id"]: f for f in batch}
+    emails = {f["email"] for f in by_tx.values() if f["email"]}
+    products = {f["product_id"]: f["product_name"] for f in by_tx.values() if f["product_name"]}
+
+    with engine.begin() as conn:
+        _insert_missing(
+            conn, _INSERT_CUSTOMERS, _customers, "uq_customer_source_id",
+            [{"source": "hotmart", "source_id": e, "email": e} for e in emails],
+            use_copy,
+        )
+        _insert_missing(
+            conn, _INSERT_PRODUCTS, _products, "uq_product_source_id",
+            [{"source": "hotmart", "source_id": pid, "name": name} for pid, name in products.items()],
+            use_copy,
+        )
+        customer_ids = _id_map(conn, _customers, "source_id", emails)
+        product_ids = _id_map(conn, _products, "source_id", set(products))
+
+        _insert_missing(
+            conn, _INSERT_ORDERS, _orders, "uq_order_source_id",
+            [
+                {
+                    "source": "hotmart",
+                    "source_id": tx_id,
+                    "customer_id": customer_ids.get(f["email"]),
+                    "status": f["status"],
+                }
+                for tx_id, f in by_tx.items()
+            ],
+            use_copy,
+        )
+        order_ids = _id_map(conn, _orders, "source_id", set(by_tx))
+
+        # order_items no tiene clave única: se insertan las parejas (pedido, producto) nuevas
+        existing_items = {
+            (order_id, product_id)
+            for order_id, product_id in conn.execute(
+                select(_order_items.c.order_id, _order_items.c.product_id).where(
+                    _order_items.c.order_id.in_(order_ids.values())
+                )
+            )
+        }
+        new_items = {}
+        for tx_id, f in by_tx.items():
+            product_id = product_ids.get(f["product_id"]) if f["product_name"] else None
+            key = (order_ids[tx_id], product_id)
+            if product_id is not None and key not in existing_items and key not in new_items:
+                new_items[key] = {
+                    "order_id": key[0],
+                    "product_id": product_id,
+                    "quantity": 1,
+                    "unit_price_original_minor": f["amount_minor"],
+                    "currency_original": f["currency"],
+                }
+        if new_items and use_copy:
+            copy_insert(conn, _order_items.name, tuple(next(iter(new_items.values()))), new_items.values())
+        elif new_items:
+            conn.execute(insert(_order_items), list(new_items.values()))
+
+        payment_rows = [
+            {
+                "order_id": order_ids[tx_id],
+                "source": "hotmart",
+                "source_payment_id": tx_id,
+                "status": f["status"],
+                "amount_original_minor": f["amount_minor"],
+                "currency_original": f["currency"],
+                "paid_at": f["created"],
+                "raw": f["raw"],
+            }
+            for tx_id, f in by_tx.items()
+        ]
+        if insert_only and use_copy:
+            inserted = copy_insert(
+                conn, _payments.name, tuple(payment_rows[0]), payment_rows,
+                on_conflict="ON CONFLICT ON CONSTRAINT uq_payment_source_id DO NOTHING",
+            )
+            return inserted, 0
+        if insert_only:
+            return len(conn.execute(_INSERT_PAYMENTS, payment_rows).all()), 0
+        flags = conn.execute(_UPSERT_PAYMENTS, payment_rows).scalars().all()
+        inserted = sum(1 for was_inserted in flags if was_inserted)
+        return inserted, len(flags) - inserted
+
+
 def sync_hotmart_transactions(days_back: int = 365, insert_only: bool = True) -> dict:
     """
     Sincroniza transacciones de Hotmart. Si no hay cursor, hace backfill de days_back días.
     Si insert_only=False, fuerza backfill de al menos 90 días desde hoy para capturar datos recientes.
     """
     last = _get_sync_dt("hotmart_tx_last")
+    # Primer backfill solo de inserción: nada que actualizar, carga con COPY
+    cold = insert_only and last is None
+    batch_size = _COLD_BATCH_SIZE if cold else _TX_BATCH_SIZE
     # Si estamos en modo update, forzamos un backfill para asegurarnos de que todo se actualiza.
     if not insert_only:
         # Forzar backfill de al menos 90 días desde hoy para asegurar datos recientes
@@ -87,169 +359,19 @@ def sync_hotmart_transactions(days_back: int = 365, insert_only: bool = True) ->
     inserted = 0
     updated = 0
 
-    for tx in list_transactions(updated_after=last):
-        detected += 1
-        # Campos robustos
-        tx_id = _first(
-            tx.get("transaction"),
-            (tx.get("purchase") or {}).get("transaction"),
-            tx.get("id"),
-            (tx.get("purchase") or {}).get("id"),
-        )
-        product_info = tx.get("product") or {}
-        product_name = product_info.get("name")
-        product_id = str(product_info.get("id", ""))
-        
-        # Estado
-        status_raw = _first(
-            tx.get("status"),
-            tx.get("transaction_status"),
-            (tx.get("purchase") or {}).get("status"),
-        ) or ""
-        status = str(status_raw).lower()
-
-        # Email
-        buyer = tx.get("buyer") or {}
-        customer = tx.get("customer") or {}
-        email = _first(
-            buyer.get("email"),
-            customer.get("email"),
-            tx.get("customer_email"),
-            tx.get("email"),
-        )
-
-        # Moneda
-        currency = _first(
-            (tx.get("currency") or "").upper() or None,
-            (tx.get("currency_code") or "").upper() or None,
-            ((tx.get("purchase") or {}).get("currency_code") or "").upper() or None,
-            (((tx.get("price") or {}).get("currency_code")) or "").upper() if tx.get("price") else None,
-        ) or "EUR"
-
-        # Importe
-        amount_candidate = _first(
-            tx.get("value"),
-            tx.get("amount"),
-            (tx.get("price") or {}).get("value"),
-            (tx.get("purchase") or {}).get("amount"),
-        )
-        try:
-            amount_minor = int(round(float(amount_candidate or 0) * 100))
-        except Exception:
-            amount_minor = 0
-
-        # Fechas
-        created_str = _first(
-            tx.get("approved_date"),
-            tx.get("purchase_date"),
-            tx.get("date_created"),
-            tx.get("approvedDate"),
-            tx.get("purchaseDate"),
-            tx.get("creationDate"),
-            tx.get("lastUpdateDate"),
-            tx.get("approved_at"),
-        )
-        created = _parse_dt_any(created_str)
-
-        with db_session() as s:
-            customer_obj = None
-            if email:
-                customer_obj = (
-                    s.query(Customer)
-                    .filter((Customer.source == "hotmart") & (Customer.source_id == email))
-                    .order_by(Customer.id.desc())
-                    .first()
-                )
-                if not customer_obj:
-                    customer_obj = Customer(source="hotmart", source_id=email, email=email)
-                    s.add(customer_obj)
-
-            order = (
-                s.query(Order)
-                .filter((Order.source == "hotmart") & (Order.source_id == tx_id))
-                .order_by(Order.id.desc())
-                .first()
-            )
-            if not order:
-                order = Order(source="hotmart", source_id=tx_id, customer_id=customer_obj.id if customer_obj else None, status=status)
-                s.add(order)
-                s.flush()
-
-            product_obj = None
-            if product_name:
-                product_obj = (
-                    s.query(Product)
-                    .filter_by(source="hotmart", source_id=product_id)
-                    .first()
-                )
-                if not product_obj:
-                    product_obj = Product(
-                        source="hotmart", source_id=product_id, name=product_name
-                    )
-                    s.add(product_obj)
-                    s.flush()
-
-            if product_obj:
-                order_item = (
-                    s.query(OrderItem)
-                    .filter_by(order_id=order.id, product_id=product_obj.id)
-                    .first()
-                )
-                if not order_item:
-                    order_item = OrderItem(
-                        order_id=order.id,
-                        product_id=product_obj.id,
-                        quantity=1,
-                        unit_price_original_minor=amount_minor,
-                        currency_original=currency,
-                    )
-                    s.add(order_item)
-                    s.flush()
-
-            payment = (
-                s.query(Payment)
-                .filter((Payment.source == "hotmart") & (Payment.source_payment_id == tx_id))
-                .order_by(Payment.id.desc())
-                .first()
-            )
-            if not payment:
-                payment = Payment(
-                    order_id=order.id,
-                    source="hotmart",
-                    source_payment_id=tx_id,
-                    status=status,
-                    amount_original_minor=amount_minor,
-                    currency_original=currency,
-                    paid_at=created,
-                    raw=tx,
-                )
-                s.add(payment)
-                inserted += 1
-            else:
-                if not insert_only:
-                    prev = (
-                        payment.status,
-                        payment.paid_at,
-                        payment.amount_original_minor,
-                        payment.currency_original,
-                    )
-                    payment.status = status or payment.status
-                    payment.paid_at = created or payment.paid_at
-                    if amount_minor:
-                        payment.amount_original_minor = amount_minor
-                    if currency:
-                        payment.currency_original = currency
-                    payment.raw = tx
-                    if prev != (
-                        payment.status,
-                        payment.paid_at,
-                        payment.amount_original_minor,
-                        payment.currency_original,
-                    ):
-                        updated += 1
-
-        if created and (not latest_seen or created > latest_seen):
-            latest_seen = created
+    transactions = iter(list_transactions(updated_after=last))
+    while True:
+        batch = _batch_fields(list(islice(transactions, batch_size)))
+        if not batch:
+            break
+        detected += len(batch)
+        batch_inserted, batch_updated = _sync_tx_batch(batch, insert_only, use_copy=cold)
+        inserted += batch_inserted
+        updated += batch_updated
+        for f in batch:
+            created = f["created"]
+            if created and (not latest_seen or created > latest_seen):
+                latest_seen = created
 
     if latest_seen:
         _set_sync_dt("hotmart_tx_last", latest_seen)
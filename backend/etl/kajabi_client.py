@@ -1,11 +1,75 @@
 from __future__ import annotations
 
 import os
-from typing import Dict, Any, Iterable, Optional
-from datetime import datetime, timedelta, date
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Any, Iterable, Iterator, Optional, Tuple
+from datetime import datetime, timedelta, date, timezone
 
 import requests
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from . import token_cache
+
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:  # sin orjson: json de la stdlib (más lento con páginas grandes)
+    import json
+    _loads = json.loads
+
+
+def _index_included(included: Iterable[Dict[str, Any]]) -> Dict[tuple, Dict[str, Any]]:
+    """{(type, id): recurso} del included de una página (JSON:API garantiza type e id)."""
+    return {(inc["type"], inc["id"]): inc for inc in included}
+
+
+_CUSTOM_FIELD_VALUE_TYPES = ("custom_field_value", "contact_custom_field_value")
+
+
+def _custom_field_slugs(included: Iterable[Dict[str, Any]]) -> Dict[str, str]:
+    """{id de custom_field: slug} a partir del bloque included de una respuesta JSON:API."""
+    fields_by_id: Dict[str, str] = {}
+    for inc in included:
+        if inc.get("type") == "custom_field":
+            fid = inc.get("id")
+            attrs = inc.get("attributes") or {}
+            slug = attrs.get("slug") or attrs.get("name") or attrs.get("label")
+            if fid and slug:
+                fields_by_id[str(fid)] = str(slug)
+    return fields_by_id
+
+
+def _custom_field_value_slug(value: Dict[str, Any], fields_by_id: Dict[str, str]) -> Optional[str]:
+    attrs = value.get("attributes") or {}
+    fid = str((value.get("relationships") or {}).get("custom_field", {}).get("data", {}).get("id") or attrs.get("custom_field_id") or "")
+    return fields_by_id.get(fid)
+
+
+def _included_custom_fields(
+    row: Dict[str, Any],
+    inc_map: Dict[tuple, Dict[str, Any]],
+    fields_by_id: Dict[str, str],
+) -> Optional[Dict[str, Any]]:
+    """{slug: value} del contacto según sus relaciones y el included de la página.
+
+    None si el contacto no trae la relación custom_field_values (la API no la incluyó).
+    """
+    rel = (row.get("relationships") or {}).get("custom_field_values") or {}
+    refs = rel.get("data")
+    if refs is None:
+        return None
+    slug_to_value: Dict[str, Any] = {}
+    for ref in refs:
+        value = inc_map.get((ref.get("type"), ref.get("id")))
+        if value is None:
+            return None
+        slug = _custom_field_value_slug(value, fields_by_id)
+        if slug:
+            slug_to_value[slug] = (value.get("attributes") or {}).get("value")
+    return slug_to_value
 
 
 class KajabiClient:
@@ -27,6 +91,29 @@ class KajabiClient:
             raise RuntimeError("Faltan KAJABI_CLIENT_ID/KAJABI_CLIENT_SECRET en .env")
         self._token: Optional[str] = None
         self._token_exp: Optional[datetime] = None
+        # Los custom fields se piden desde varios hilos: un único refresh a la vez
+        self._token_lock = threading.Lock()
+        # Clave en la caché de tokens en disco (compartida entre procesos y reinicios)
+        self._token_cache_id = f"{self.base_url}|{self.client_id}"
+        # Sesión con keep-alive para todas las llamadas (una petición por contacto en los
+        # custom fields): sin handshake TCP+TLS por petición. El POST del token
+        # (client_credentials) es idempotente y también se reintenta.
+        self._sess = requests.Session()
+        self._sess.mount(
+            "https://",
+            HTTPAdapter(
+                pool_connections=16,
+                pool_maxsize=32,
+                max_retries=Retry(
+                    total=3,
+                    backoff_factor=0.3,
+                    status_forcelist=(429, 500, 502, 503, 504),
+                    allowed_methods=frozenset({"GET", "POST"}),
+                    raise_on_status=False,
+                ),
+            ),
+        )
+        self._sess.headers.update({"Accept": "application/vnd.api+json"})
         try:
             self.page_size = int(os.getenv("KAJABI_PAGE_SIZE") or 500)
         except Exception:
@@ -35,49 +122,109 @@ class KajabiClient:
     def _ensure_token(self) -> str:
         if self._token and self._token_exp and datetime.utcnow() < self._token_exp:
             return self._token
-        resp = requests.post(
+        with self._token_lock:
+            if self._token and self._token_exp and datetime.utcnow() < self._token_exp:
+                return self._token
+            # Token de una ejecución anterior (caché en disco) antes que un POST nuevo
+            cached = token_cache.load_token("kajabi", self._token_cache_id)
+            if cached is not None:
+                token, expires_at = cached
+            else:
+                token, expires_at = self._request_token()
+                token_cache.store_token("kajabi", self._token_cache_id, token, expires_at)
+            self._token = token
+            # En memoria como UTC naive, con un minuto de margen
+            self._token_exp = expires_at.astimezone(timezone.utc).replace(tzinfo=None) - timedelta(seconds=60)
+            return self._token or ""
+
+    def _request_token(self) -> Tuple[str, datetime]:
+        """POST client_credentials; devuelve (access_token, expires_at UTC)."""
+        resp = self._sess.post(
             f"{self.base_url}/v1/oauth/token",
             data={
                 "grant_type": "client_credentials",
                 "client_id": self.client_id,
                 "client_secret": self.client_secret,
             },
+            # El endpoint OAuth no es JSON:API; no hereda el Accept de la sesión
+            headers={"Accept": "application/json"},
             timeout=30,
         )
         resp.raise_for_status()
-        js = resp.json()
-        self._token = js.get("access_token")
+        js = _loads(resp.content)
         exp = int(js.get("expires_in") or 3600)
-        self._token_exp = datetime.utcnow() + timedelta(seconds=max(60, exp - 60))
-        return self._token or ""
+        return js.get("access_token") or "", datetime.now(timezone.utc) + timedelta(seconds=max(120, exp))
+
+    def _forget_token(self) -> None:
+        with self._token_lock:
+            self._token = None
+            self._token_exp = None
+        token_cache.clear_token("kajabi", self._token_cache_id)
 
     def _headers(self) -> Dict[str, str]:
-        return {
-            "Authorization": f"Bearer {self._ensure_token()}",
-            "Accept": "application/vnd.api+json",
-        }
+        # Accept va en la sesión; aquí solo el bearer
+        return {"Authorization": f"Bearer {self._ensure_token()}"}
 
     def _get(self, path: str, params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
-        resp = requests.get(
+        resp = self._sess.get(
             f"{self.base_url}{path}", params=params or {}, headers=self._headers(), timeout=60
         )
+        if resp.status_code == 401:
+            # Token cacheado revocado antes de caducar: se descarta y se reintenta una vez
+            self._forget_token()
+            resp = self._sess.get(
+                f"{self.base_url}{path}", params=params or {}, headers=self._headers(), timeout=60
+            )
         resp.raise_for_status()
-        return resp.json()
+        # Decodifica los bytes directamente (páginas con included grandes)
+        return _loads(resp.content)
+
+    def _pages(
+        self,
+        path: str,
+        params: Optional[Dict[str, Any]] = None,
+        max_pages: Optional[int] = None,
+    ) -> Iterator[Dict[str, Any]]:
+        """JSON de cada página de `path`, en orden.
+
+        En cuanto llega una página llena se pide la siguiente en segundo plano, de modo
+        que su latencia se solapa con el procesado de la actual por el consumidor.
+        """
+        def fetch(page: int) -> Dict[str, Any]:
+            return self._get(path, params={**(params or {}), "page[number]": page, "page[size]": self.page_size})
+
+        with ThreadPoolExecutor(max_workers=1) as ex:
+            page = 1
+            future: Optional[Future] = ex.submit(fetch, page)
+            while future is not None:
+                js = future.result()
+                data = js.get("data", []) or []
+                page += 1
+                more = len(data) >= self.page_size and (max_pages is None or page <= max_pages)
+                future = ex.submit(fetch, page) if more else None
+                yield js
 
     def iter_contacts(
         self,
         start: Optional[date] = None,
         end: Optional[date] = None,
         max_pages: Optional[int] = None,
+        with_custom_fields: bool = False,
     ) -> Iterable[Dict[str, Any]]:
         """Itera contactos (leads) desde Kajabi.
         Nota: La API pública puede no exponer todos los campos UTM; mapeamos lo disponible.
+
+        Con with_custom_fields=True los custom fields se piden con include en el propio
+        listado y se produce {"contact": row, "custom_fields": {slug: value} | None};
+        None indica que la respuesta no los trae (usar get_contact_custom_fields).
         """
-        page = 1
-        while True:
-            params: Dict[str, Any] = {"page[number]": page, "page[size]": self.page_size}
-            js = self._get("/v1/contacts", params=params)
+        params: Dict[str, Any] = {"include": "custom_field_values,custom_fields"} if with_custom_fields else {}
+        for js in self._pages("/v1/contacts", params=params, max_pages=max_pages):
             data = js.get("data", []) or []
+            if with_custom_fields:
+                included = js.get("included", []) or []
+                inc_map = _index_included(included)
+                fields_by_id = _custom_field_slugs(included)
             for row in data:
                 attrs = row.get("attributes") or {}
                 # Filtro local por fechas si se proporcionan
@@ -91,12 +238,10 @@ class KajabiClient:
                         continue
                     if end and created_dt and created_dt > end:
                         continue
-                yield row
-            if not data or len(data) < self.page_size:
-                break
-            page += 1
-            if max_pages is not None and page > max_pages:
-                break
+                if with_custom_fields:
+                    yield {"contact": row, "custom_fields": _included_custom_fields(row, inc_map, fields_by_id)}
+                else:
+                    yield row
 
     def get_contact_custom_fields(self, contact_id: str) -> Dict[str, Any]:
         """Devuelve un dict {slug: value} de custom fields para el contacto.
@@ -110,21 +255,12 @@ class KajabiClient:
         try:
             js = self._get(f"/v1/contacts/{contact_id}", params={"include": "custom_fields,custom_field_values"})
             incl = js.get("included", []) or []
-            fields_by_id: Dict[str, str] = {}
+            fields_by_id = _custom_field_slugs(incl)
             for inc in incl:
-                if inc.get("type") == "custom_field":
-                    fid = inc.get("id")
-                    attrs = inc.get("attributes") or {}
-                    slug = attrs.get("slug") or attrs.get("name") or attrs.get("label")
-                    if fid and slug:
-                        fields_by_id[str(fid)] = str(slug)
-            for inc in incl:
-                if inc.get("type") in ("custom_field_value", "contact_custom_field_value"):
-                    attrs = inc.get("attributes") or {}
-                    fid = str((inc.get("relationships") or {}).get("custom_field", {}).get("data", {}).get("id") or attrs.get("custom_field_id") or "")
-                    slug = fields_by_id.get(fid)
+                if inc.get("type") in _CUSTOM_FIELD_VALUE_TYPES:
+                    slug = _custom_field_value_slug(inc, fields_by_id)
                     if slug:
-                        slug_to_value[slug] = attrs.get("value")
+                        slug_to_value[slug] = (inc.get("attributes") or {}).get("value")
             if slug_to_value:
                 return slug_to_value
         except Exception:
@@ -135,14 +271,7 @@ class KajabiClient:
             js2 = self._get(f"/v1/contacts/{contact_id}/custom_field_values")
             data = js2.get("data", []) or []
             incl = js2.get("included", []) or []
-            fields_by_id: Dict[str, str] = {}
-            for inc in incl:
-                if inc.get("type") == "custom_field":
-                    fid = inc.get("id")
-                    attrs = inc.get("attributes") or {}
-                    slug = attrs.get("slug") or attrs.get("name") or attrs.get("label")
-                    if fid and slug:
-                        fields_by_id[str(fid)] = str(slug)
+            fields_by_id = _custom_field_slugs(incl)
             for row in data:
                 attrs = row.get("attributes") or {}
                 fid = str(attrs.get("custom_field_id") or "")
@@ -163,18 +292,12 @@ class KajabiClient:
         include: str = "customer,offer",
         max_pages: Optional[int] = None,
     ) -> Iterable[Dict[str, Any]]:
-        page = 1
-        while True:
-            params: Dict[str, Any] = {"page[number]": page, "page[size]": self.page_size}
-            if include:
-                params["include"] = include
-            # Nota: la API de compras de Kajabi no siempre soporta filtros por fecha con client_credentials.
-            js = self._get("/v1/purchases", params=params)
+        params: Dict[str, Any] = {"include": include} if include else {}
+        # Nota: la API de compras de Kajabi no siempre soporta filtros por fecha con client_credentials.
+        for js in self._pages("/v1/purchases", params=params, max_pages=max_pages):
             data = js.get("data", []) or []
             included = js.get("included", []) or []
-            inc_map: Dict[tuple, Dict[str, Any]] = {}
-            for inc in included:
-                inc_map[(inc.get("type"), inc.get("id"))] = inc
+            inc_map = _index_included(included)
             for row in data:
                 rel = row.get("relationships", {}) or {}
                 cust = None
@@ -198,11 +321,6 @@ class KajabiClient:
                     if end and paid_dt and paid_dt > end:
                         continue
                 yield {"purchase": row, "customer": cust, "offer": off}
-            if not data or len(data) < self.page_size:
-                break
-            page += 1
-            if max_pages is not None and page > max_pages:
-                break
 
     def iter_subscriptions(
         self,
@@ -210,39 +328,25 @@ class KajabiClient:
         max_pages: Optional[int] = None,
     ) -> Iterable[Dict[str, Any]]:
         """Itera suscripciones (API pública)."""
-        page = 1
-        while True:
-            params: Dict[str, Any] = {"page[number]": page, "page[size]": self.page_size}
-            if include:
-                params["include"] = include
-            try:
-                js = self._get("/v1/subscriptions", params=params)
-            except requests.HTTPError as e:
-                # Muchas cuentas no tienen este recurso activo con client_credentials
-                if getattr(e, "response", None) is not None and e.response.status_code == 404:
-                    return
-                raise
-            data = js.get("data", []) or []
-            included = js.get("included", []) or []
-            inc_map: Dict[tuple, Dict[str, Any]] = {}
-            for inc in included:
-                inc_map[(inc.get("type"), inc.get("id"))] = inc
-            for row in data:
-                rel = row.get("relationships", {}) or {}
-                cust = None
-                off = None
-                if rel.get("customer", {}).get("data"):
-                    cd = rel["customer"]["data"]
-                    cust = inc_map.get((cd.get("type"), cd.get("id")))
-                if rel.get("offer", {}).get("data"):
-                    od = rel["offer"]["data"]
-                    off = inc_map.get((od.get("type"), od.get("id")))
-                yield {"subscription": row, "customer": cust, "offer": off}
-            if not data or len(data) < self.page_size:
-                break
-            page += 1
-            if max_pages is not None and page > max_pages:
-                break
-
-
-
+        params: Dict[str, Any] = {"include": include} if include else {}
+        try:
+            for js in self._pages("/v1/subscriptions", params=params, max_pages=max_pages):
+                data = js.get("data", []) or []
+                included = js.get("included", []) or []
+                inc_map = _index_included(included)
+                for row in data:
+                    rel = row.get("relationships", {}) or {}
+                    cust = None
+                    off = None
+                    if rel.get("customer", {}).get("data"):
+                        cd = rel["customer"]["data"]
+                        cust = inc_map.get((cd.get("type"), cd.get("id")))
+                    if rel.get("offer", {}).get("data"):
+                        od = rel["offer"]["data"]
+                        off = inc_map.get((od.get("type"), od.get("id")))
+                    yield {"subscription": row, "customer": cust, "offer": off}
+        except requests.HTTPError as e:
+            # Muchas cuentas no tienen este recurso activo con client_credentials
+            if getattr(e, "response", None) is not None and e.response.status_code == 404:
+                return
+            raise
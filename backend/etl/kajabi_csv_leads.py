@@ -1,141 +1,164 @@
 """
 Procesar CSV de leads de Kajabi para cargar en leads_kajabi
 """
+import io
+import os
+import re
+import numpy as np
 import pandas as pd
 from datetime import datetime
-from typing import List, Dict, Any, Optional
+from typing import IO, List, Dict, Any, Optional, Union
 import logging
 
+from sqlalchemy.dialects.postgresql import insert
+
 from backend.db.config import engine, init_db
+from backend.db.models import LeadsKajabi
 
 logger = logging.getLogger(__name__)
 
 
-def process_kajabi_leads_csv(csv_content: str) -> Dict[str, Any]:
+# Columnas del CSV de Kajabi -> columnas de leads_kajabi (custom fields con su sufijo)
+_CSV_COLUMNS = {
+    'utm_source (custom_22)': 'utm_source',
+    'utm_medium (custom_21)': 'utm_medium',
+    'utm_campaign (custom_23)': 'utm_campaign',
+    'utm_content (custom_24)': 'utm_content',
+    'gclid': 'gclid',
+    'fbclid': 'fbclid',
+    'campaign_id': 'campaign_id',
+    'adset_id': 'adset_id',
+    'ad_id': 'ad_id',
+}
+# Filas del CSV por bloque (parseo e inserción)
+_CSV_CHUNK_ROWS = 10_000
+_INSERT_LEADS = insert(LeadsKajabi.__table__).on_conflict_do_nothing()
+# Formatos de 'Created At' en orden de preferencia
+_DATE_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d', '%d/%m/%Y', '%m/%d/%Y')
+
+
+def _text_column(df: pd.DataFrame, column: str) -> pd.Series:
+    """Columna de texto limpia: strip, y vacío/'nan'/ausente -> None."""
+    if column not in df:
+        # pd.Series(None, dtype=object) sería NaN, no None: Postgres lo guardaría como 'NaN'
+        return pd.Series([None] * len(df), index=df.index, dtype=object)
+    s = df[column].astype('string').str.strip()
+    return s.where(s.notna() & (s != '') & (s != 'nan')).astype(object).where(lambda x: x.notna(), None)
+
+
+def _parse_created_at(df: pd.DataFrame) -> pd.Series:
+    """'Created At' probando _DATE_FORMATS en orden; lo no parseable -> ahora.
+
+    Cada formato solo se prueba sobre lo que aún no se ha parseado. El format='mixed'
+    (inferencia por valor, más lento) queda como último recurso, para no cambiar la
+    precedencia dd/mm sobre mm/dd de los formatos fijos.
+    """
+    raw = _text_column(df, 'Created At')
+    created = pd.Series(pd.NaT, index=df.index, dtype='datetime64[ns]')
+    pending = raw.notna()
+    for fmt in _DATE_FORMATS:
+        if not pending.any():
+            break
+        created[pending] = pd.to_datetime(raw[pending], format=fmt, errors='coerce')
+        pending &= created.isna()
+    if pending.any():
+        created[pending] = pd.to_datetime(
+            raw[pending], format='mixed', errors='coerce', utc=True
+        ).dt.tz_convert(None)
+    created = created.fillna(pd.Timestamp(datetime.now()))
+    return pd.Series(list(created.dt.to_pydatetime()), index=df.index, dtype=object)
+
+
+# Reglas de plataforma compiladas una vez (patrones sobre texto ya en minúsculas)
+_GOOGLE_SOURCES = ['youtube', 'google', 'gclid']
+_META_SOURCES = ['facebook', 'meta', 'fb', 'instagram']
+_GOOGLE_SRC = re.compile(r'google|gclid')
+_META_SRC = re.compile(r'facebook|meta|fb')
+_PAID_MEDIUM = re.compile(r'cpc|ppc')
+_GOOGLE_CAMPAIGN = re.compile(r'google|ads')
+_META_CAMPAIGN = re.compile(r'facebook|meta|fb')
+_META_ADS_MEDIUM = re.compile(re.escape('meta-ads'))
+_TEST_ADS_MEDIUM = re.compile(re.escape('test-ads'))  # test-ads probablemente sea Google Ads
+# Etiqueta de cada condición de _classify_platform, en el mismo orden
+_PLATFORM_CHOICES = [
+    'google_ads', 'meta', 'meta', 'google_ads', 'google_ads', 'meta',
+    'google_ads', 'meta', 'google_ads', 'meta', 'google_ads',
+]
+
+
+def _classify_platform(leads: pd.DataFrame) -> pd.Series:
+    """Plataforma por UTMs/CLIDs; las reglas se evalúan en orden y gana la primera.
+
+    Cada regla es una máscara booleana calculada por columna; np.select elige la primera.
+    """
+    source = leads['utm_source'].str.lower()
+    medium = leads['utm_medium'].str.lower()
+    campaign = leads['utm_campaign'].str.lower()
+    paid = medium.str.contains(_PAID_MEDIUM, na=False)
+    conditions = [
+        leads['gclid'].notna(),
+        leads['fbclid'].notna(),
+        medium.str.contains(_META_ADS_MEDIUM, na=False),
+        medium.str.contains(_TEST_ADS_MEDIUM, na=False),
+        source.isin(_GOOGLE_SOURCES),
+        source.isin(_META_SOURCES),
+        # CPC/PPC: intentar determinar por campaign antes que por source
+        paid & campaign.str.contains(_GOOGLE_CAMPAIGN, na=False),
+        paid & campaign.str.contains(_META_CAMPAIGN, na=False),
+        source.str.contains(_GOOGLE_SRC, na=False),
+        source.str.contains(_META_SRC, na=False),
+        # Por defecto a Google Ads si es paid pero no se puede determinar
+        paid,
+    ]
+    return pd.Series(np.select(conditions, _PLATFORM_CHOICES, default=None), index=leads.index, dtype=object)
+
+
+def _chunk_leads(df: pd.DataFrame) -> List[Dict[str, Any]]:
+    """Filas de leads_kajabi de un bloque del CSV (solo las que traen email)."""
+    email = _text_column(df, 'Email')
+    df = df[email.notna()]
+    leads = pd.DataFrame({'email': email[email.notna()]})
+    leads['created_at'] = _parse_created_at(df)
+    for csv_column, column in _CSV_COLUMNS.items():
+        leads[column] = _text_column(df, csv_column)
+    leads['platform'] = _classify_platform(leads)
+    return leads.to_dict('records')
+
+
+def process_kajabi_leads_csv(csv_content: Union[str, os.PathLike, IO[str]]) -> Dict[str, Any]:
     """
     Procesa un CSV de leads de Kajabi y los carga en la base de datos.
     
     Args:
-        csv_content: Contenido del CSV como string
+        csv_content: Contenido del CSV como string, ruta (Path) o fichero abierto.
+            Se lee por bloques de _CSV_CHUNK_ROWS filas: la memoria no crece con el fichero.
         
     Returns:
         Dict con estadísticas del procesamiento
     """
     try:
-        # Parsear CSV
-        df = pd.read_csv(pd.io.common.StringIO(csv_content))
+        source = io.StringIO(csv_content) if isinstance(csv_content, str) else csv_content
         
         # Asegurar que existe la tabla
         init_db()
         
-        # Mapear columnas del CSV a nuestros campos
-        # Asumimos que el CSV tiene estas columnas (ajustar según sea necesario):
-        # - email, created_at, utm_source, utm_medium, utm_campaign, utm_content, gclid, fbclid
-        
-        leads_data = []
         processed = 0
         errors = 0
         
-        for _, row in df.iterrows():
-            try:
-                # Extraer email
-                email = str(row.get('Email', '')).strip()
-                if not email or email == 'nan':
+        # Parseo e inserción por bloques en una sola transacción (todo o nada, como antes).
+        # Todo como texto: los ids largos no pasan por float
+        with engine.begin() as conn:
+            for chunk in pd.read_csv(source, dtype=str, chunksize=_CSV_CHUNK_ROWS):
+                leads_data = _chunk_leads(chunk)
+                if not leads_data:
                     continue
-                    
-                # Extraer fecha de creación
-                created_at_str = str(row.get('Created At', '')).strip()
-                if created_at_str and created_at_str != 'nan':
-                    try:
-                        # Intentar diferentes formatos de fecha
-                        for fmt in ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d', '%d/%m/%Y', '%m/%d/%Y']:
-                            try:
-                                created_at = datetime.strptime(created_at_str, fmt)
-                                break
-                            except ValueError:
-                                continue
-                        else:
-                            created_at = datetime.now()
-                    except:
-                        created_at = datetime.now()
-                else:
-                    created_at = datetime.now()
-                
-                # Extraer UTMs (mapear custom fields del CSV de Kajabi)
-                utm_source = str(row.get('utm_source (custom_22)', '')).strip() if pd.notna(row.get('utm_source (custom_22)')) else None
-                utm_medium = str(row.get('utm_medium (custom_21)', '')).strip() if pd.notna(row.get('utm_medium (custom_21)')) else None
-                utm_campaign = str(row.get('utm_campaign (custom_23)', '')).strip() if pd.notna(row.get('utm_campaign (custom_23)')) else None
-                utm_content = str(row.get('utm_content (custom_24)', '')).strip() if pd.notna(row.get('utm_content (custom_24)')) else None
-                
-                # Extraer IDs de tracking
-                gclid = str(row.get('gclid', '')).strip() if pd.notna(row.get('gclid')) else None
-                fbclid = str(row.get('fbclid', '')).strip() if pd.notna(row.get('fbclid')) else None
-                
-                # Determinar plataforma basada en UTMs o IDs
-                platform = None
-                campaign_id = None
-                adset_id = None
-                ad_id = None
-                
-                if gclid:
-                    platform = 'google_ads'
-                elif fbclid:
-                    platform = 'meta'
-                elif utm_medium and 'meta-ads' in utm_medium.lower():
-                    platform = 'meta'
-                elif utm_medium and 'test-ads' in utm_medium.lower():
-                    platform = 'google_ads'  # test-ads probablemente sea Google Ads
-                elif utm_source and utm_source.lower() in ['youtube', 'google', 'gclid']:
-                    platform = 'google_ads'
-                elif utm_source and utm_source.lower() in ['facebook', 'meta', 'fb', 'instagram']:
-                    platform = 'meta'
-                elif utm_medium and ('cpc' in utm_medium.lower() or 'ppc' in utm_medium.lower()):
-                    # Si es CPC/PPC, intentar determinar por campaign o source
-                    if utm_campaign and ('google' in utm_campaign.lower() or 'ads' in utm_campaign.lower()):
-                        platform = 'google_ads'
-                    elif utm_campaign and ('facebook' in utm_campaign.lower() or 'meta' in utm_campaign.lower() or 'fb' in utm_campaign.lower()):
-                        platform = 'meta'
-                    elif utm_source and ('google' in utm_source.lower() or 'gclid' in utm_source.lower()):
-                        platform = 'google_ads'
-                    elif utm_source and ('facebook' in utm_source.lower() or 'meta' in utm_source.lower() or 'fb' in utm_source.lower()):
-                        platform = 'meta'
-                    else:
-                        # Por defecto a Google Ads si es paid pero no se puede determinar
-                        platform = 'google_ads'
-                elif utm_source and ('google' in utm_source.lower() or 'gclid' in utm_source.lower()):
-                    platform = 'google_ads'
-                elif utm_source and ('facebook' in utm_source.lower() or 'meta' in utm_source.lower() or 'fb' in utm_source.lower()):
-                    platform = 'meta'
-                
-                # Extraer IDs de campaña si están disponibles
-                campaign_id = str(row.get('campaign_id', '')).strip() if pd.notna(row.get('campaign_id')) else None
-                adset_id = str(row.get('adset_id', '')).strip() if pd.notna(row.get('adset_id')) else None
-                ad_id = str(row.get('ad_id', '')).strip() if pd.notna(row.get('ad_id')) else None
-                
-                lead_data = {
-                    'email': email,
-                    'created_at': created_at,
-                    'utm_source': utm_source if utm_source and utm_source != 'nan' else None,
-                    'utm_medium': utm_medium if utm_medium and utm_medium != 'nan' else None,
-                    'utm_campaign': utm_campaign if utm_campaign and utm_campaign != 'nan' else None,
-                    'utm_content': utm_content if utm_content and utm_content != 'nan' else None,
-                    'gclid': gclid if gclid and gclid != 'nan' else None,
-                    'fbclid': fbclid if fbclid and fbclid != 'nan' else None,
-                    'platform': platform,
-                    'campaign_id': campaign_id if campaign_id and campaign_id != 'nan' else None,
-                    'adset_id': adset_id if adset_id and adset_id != 'nan' else None,
-                    'ad_id': ad_id if ad_id and ad_id != 'nan' else None,
-                }
-                
-                leads_data.append(lead_data)
-                processed += 1
-                
-            except Exception as e:
-                logger.error(f"Error procesando fila {processed}: {e}")
-                errors += 1
-                continue
+                # Un único executemany por bloque sobre un insert() Core: SQLAlchemy lo
+                # agrupa en INSERTs multi-fila (insertmanyvalues). ON CONFLICT DO NOTHING
+                # omite filas que choquen con una restricción única sin abortar la transacción
+                conn.execute(_INSERT_LEADS, leads_data)
+                processed += len(leads_data)
         
-        if not leads_data:
+        if not processed:
             return {
                 'success': False,
                 'message': 'No se encontraron leads válidos en el CSV',
@@ -143,31 +166,6 @@ def process_kajabi_leads_csv(csv_content: str) -> Dict[str, Any]:
                 'errors': errors
             }
         
-        # Insertar en base de datos
-        with engine.begin() as conn:
-            from sqlalchemy import text
-            # Insertar directamente (sin ON CONFLICT por ahora)
-            insert_sql = text("""
-            INSERT INTO leads_kajabi (
-                email, created_at, utm_source, utm_medium, utm_campaign, utm_content,
-                gclid, fbclid, platform, campaign_id, adset_id, ad_id
-            ) VALUES (
-                :email, :created_at, :utm_source, :utm_medium, :utm_campaign, :utm_content,
-                :gclid, :fbclid, :platform, :campaign_id, :adset_id, :ad_id
-            )
-            """)
-            
-            # Insertar uno por uno
-            for lead_data in leads_data:
-                try:
-                    conn.execute(insert_sql, lead_data)
-                except Exception as e:
-                    # Si hay duplicados, continuar con el siguiente
-                    if "duplicate key" in str(e).lower() or "unique constraint" in str(e).lower():
-                        continue
-                    else:
-                        raise e
-        
         return {
             'success': True,
             'message': f'CSV procesado correctamente: {processed} leads cargados',
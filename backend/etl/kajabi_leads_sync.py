@@ -1,10 +1,14 @@
 from __future__ import annotations
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, date
+from itertools import islice
 from typing import Dict, Any, Optional
 
-from sqlalchemy import text as _t
+from sqlalchemy import func, literal_column, text as _t
+from sqlalchemy.dialects.postgresql import insert
 from backend.db.config import db_session, init_db
+from backend.db.models import LeadsKajabi
 from .kajabi_client import KajabiClient
 
 
@@ -38,6 +42,62 @@ def _set_state(key: str, value: str) -> None:
             pass
 
 
+_CREATE_LEADS_TABLE = """
+    CREATE TABLE IF NOT EXISTS leads_kajabi (
+      id SERIAL PRIMARY KEY,
+      created_at TIMESTAMP NOT NULL,
+      email VARCHAR(320),
+      utm_source VARCHAR(100),
+      utm_medium VARCHAR(100),
+      utm_campaign VARCHAR(200),
+      utm_content VARCHAR(200),
+      gclid VARCHAR(255),
+      fbclid VARCHAR(255),
+      platform VARCHAR(20),
+      campaign_id VARCHAR(64),
+      adset_id VARCHAR(64),
+      ad_id VARCHAR(64),
+      CONSTRAINT uq_leads_kajabi_created_email UNIQUE NULLS NOT DISTINCT (created_at, email)
+    )
+"""
+
+_leads = LeadsKajabi.__table__
+_insert_leads = insert(_leads)
+# Actualización ligera: solo los campos no nulos pisan a los guardados.
+# RETURNING xmax = 0 distingue filas insertadas de actualizadas.
+_UPSERT_LEADS = _insert_leads.on_conflict_do_update(
+    constraint="uq_leads_kajabi_created_email",
+    set_={
+        col: func.coalesce(_insert_leads.excluded[col], _leads.c[col])
+        for col in (
+            "utm_source", "utm_medium", "utm_campaign", "utm_content", "gclid", "fbclid", "platform",
+        )
+    },
+).returning(literal_column("xmax = 0"))
+
+# Peticiones de custom fields simultáneas y contactos por lote
+_CUSTOM_FIELDS_WORKERS = 16
+_CONTACT_BATCH_SIZE = 500
+_TRACKING_ATTRS = ("utm_source", "utm_medium", "utm_campaign", "utm_content", "gclid", "fbclid")
+
+
+def _custom_fields(client, row: Dict[str, Any], listed: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Custom fields del contacto; {} si ya trae todos los UTMs/CLIDs o si la API falla.
+
+    `listed` son los que vinieron con el listado (include); solo si faltan (None) se
+    hace la petición por contacto.
+    """
+    if listed is not None:
+        return listed
+    attrs = row.get("attributes") or {}
+    if all(attrs.get(k) for k in _TRACKING_ATTRS):
+        return {}
+    try:
+        return client.get_contact_custom_fields(str(row.get("id") or "").strip())
+    except Exception:
+        return {}
+
+
 def run_kajabi_leads_sync(days_back: int = 365) -> Dict[str, int]:
     """Sincroniza contactos/leads desde Kajabi y guarda UTMs/CLIDs en leads_kajabi."""
     try:
@@ -45,18 +105,16 @@ def run_kajabi_leads_sync(days_back: int = 365) -> Dict[str, int]:
     except Exception:
         pass
 
-    # Recarga defensiva del cliente por si la app mantiene un módulo antiguo
+    # Sin importlib.reload del módulo: recargarlo descartaba el token en memoria
+    client = KajabiClient()
+    # Crea tabla si falta (por si init_db falló o alguien llama directo a este sync): una
+    # vez por ejecución y en su propia sesión, no en cada escritura
     try:
-        import importlib
-        cli_mod = importlib.import_module("backend.etl.kajabi_client")
-        try:
-            cli_mod = importlib.reload(cli_mod)  # type: ignore
-        except Exception:
-            pass
-        _KajabiClient = getattr(cli_mod, "KajabiClient", KajabiClient)
-        client = _KajabiClient()
+        with db_session() as s:
+            s.execute(_t(_CREATE_LEADS_TABLE))
     except Exception:
-        client = KajabiClient()
+        pass
+
     cursor_key = "kajabi_leads_cursor"
     state = _get_state(cursor_key)
 
@@ -81,95 +139,60 @@ def run_kajabi_leads_sync(days_back: int = 365) -> Dict[str, int]:
                 break
             data = js.get("data", []) or []
             for r in data:
-                yield r
+                yield {"contact": r, "custom_fields": None}
             if not data or len(data) < 500:
                 break
             page += 1
 
     if hasattr(client, "iter_contacts"):
-        iter_gen = client.iter_contacts(start=start, end=end)
+        iter_gen = client.iter_contacts(start=start, end=end, with_custom_fields=True)
     else:
         iter_gen = _iter_contacts_fallback(client)
 
-    for row in iter_gen:
-        detected += 1
-        attrs: Dict[str, Any] = row.get("attributes") or {}
-        cid = str(row.get("id") or "").strip()
-        email = (attrs.get("email") or "").lower() or None
-        created_at = _parse_iso(attrs.get("created_at") or attrs.get("updated_at")) or datetime.utcnow()
-
-        utm_source = attrs.get("utm_source") or None
-        utm_medium = attrs.get("utm_medium") or None
-        utm_campaign = attrs.get("utm_campaign") or None
-        utm_content = attrs.get("utm_content") or None
-        gclid = attrs.get("gclid") or None
-        fbclid = attrs.get("fbclid") or None
-
-        # Fallback a custom fields
-        try:
-            cf = client.get_contact_custom_fields(cid)
-        except Exception:
-            cf = {}
-        if cf:
-            utm_source = utm_source or cf.get("utm_source") or cf.get("UTM Source")
-            utm_medium = utm_medium or cf.get("utm_medium") or cf.get("UTM Medium")
-            utm_campaign = utm_campaign or cf.get("utm_campaign") or cf.get("UTM Campaign")
-            utm_content = utm_content or cf.get("utm_content") or cf.get("UTM Content")
-            gclid = gclid or cf.get("gclid") or cf.get("GCLID")
-            fbclid = fbclid or cf.get("fbclid") or cf.get("FBCLID")
-
-        platform: Optional[str] = None
-        src_l = (utm_source or "").lower()
-        if gclid or any(k in src_l for k in ("google", "adwords", "google_ads")):
-            platform = "google_ads"
-        elif fbclid or any(k in src_l for k in ("facebook", "meta", "instagram")):
-            platform = "meta"
-
-        if max_seen is None or created_at > max_seen:
-            max_seen = created_at
-
-        with db_session() as s:
-            # Crea tabla si falta (por si alguien llama directo a este sync)
-            try:
-                s.execute(_t("""
-                    CREATE TABLE IF NOT EXISTS leads_kajabi (
-                      id SERIAL PRIMARY KEY,
-                      created_at TIMESTAMP NOT NULL,
-                      email VARCHAR(320),
-                      utm_source VARCHAR(100),
-                      utm_medium VARCHAR(100),
-                      utm_campaign VARCHAR(200),
-                      utm_content VARCHAR(200),
-                      gclid VARCHAR(255),
-                      fbclid VARCHAR(255),
-                      platform VARCHAR(20),
-                      campaign_id VARCHAR(64),
-                      adset_id VARCHAR(64),
-                      ad_id VARCHAR(64)
-                    )
-                """))
-            except Exception:
-                pass
-            # Evita duplicados email+created_at si hay email
-            try:
-                params = {
-                    "created_at": created_at,
-                    "email": email,
-                }
-                if email:
-                    exists = s.execute(_t("SELECT 1 FROM leads_kajabi WHERE created_at=:created_at AND email=:email LIMIT 1"), params).scalar()
-                else:
-                    exists = s.execute(_t("SELECT 1 FROM leads_kajabi WHERE created_at=:created_at LIMIT 1"), params).scalar()
-            except Exception:
-                exists = None
-            if not exists:
-                s.execute(_t("""
-                    INSERT INTO leads_kajabi (
-                      created_at, email, utm_source, utm_medium, utm_campaign, utm_content, gclid, fbclid, platform, campaign_id, adset_id, ad_id
-                    ) VALUES (
-                      :created_at, :email, :utm_source, :utm_medium, :utm_campaign, :utm_content, :gclid, :fbclid, :platform, :campaign_id, :adset_id, :ad_id
-                    )
-                """), {
+    # Los custom fields llegan con el listado (include); los contactos para los que la
+    # respuesta no los trae cuestan una petición cada uno: esas se hacen en paralelo por
+    # lotes (hilos sobre la sesión HTTP del cliente) y después se escribe en orden
+    contacts = iter(iter_gen)
+    with ThreadPoolExecutor(max_workers=_CUSTOM_FIELDS_WORKERS) as ex:
+        while True:
+            batch = list(islice(contacts, _CONTACT_BATCH_SIZE))
+            if not batch:
+                break
+            custom_fields = ex.map(lambda c: _custom_fields(client, c["contact"], c["custom_fields"]), batch)
+            leads: Dict[tuple, Dict[str, Any]] = {}
+            for row, cf in zip((c["contact"] for c in batch), custom_fields):
+                detected += 1
+                attrs: Dict[str, Any] = row.get("attributes") or {}
+                email = (attrs.get("email") or "").lower() or None
+                created_at = _parse_iso(attrs.get("created_at") or attrs.get("updated_at")) or datetime.utcnow()
+
+                utm_source = attrs.get("utm_source") or None
+                utm_medium = attrs.get("utm_medium") or None
+                utm_campaign = attrs.get("utm_campaign") or None
+                utm_content = attrs.get("utm_content") or None
+                gclid = attrs.get("gclid") or None
+                fbclid = attrs.get("fbclid") or None
+
+                # Fallback a custom fields (del listado o descargados en paralelo para el lote)
+                if cf:
+                    utm_source = utm_source or cf.get("utm_source") or cf.get("UTM Source")
+                    utm_medium = utm_medium or cf.get("utm_medium") or cf.get("UTM Medium")
+                    utm_campaign = utm_campaign or cf.get("utm_campaign") or cf.get("UTM Campaign")
+                    utm_content = utm_content or cf.get("utm_content") or cf.get("UTM Content")
+                    gclid = gclid or cf.get("gclid") or cf.get("GCLID")
+                    fbclid = fbclid or cf.get("fbclid") or cf.get("FBCLID")
+
+                platform: Optional[str] = None
+                src_l = (utm_source or "").lower()
+                if gclid or any(k in src_l for k in ("google", "adwords", "google_ads")):
+                    platform = "google_ads"
+                elif fbclid or any(k in src_l for k in ("facebook", "meta", "instagram")):
+                    platform = "meta"
+
+                if max_seen is None or created_at > max_seen:
+                    max_seen = created_at
+
+                lead = {
                     "created_at": created_at,
                     "email": email,
                     "utm_source": utm_source,
@@ -179,35 +202,25 @@ def run_kajabi_leads_sync(days_back: int = 365) -> Dict[str, int]:
                     "gclid": gclid,
                     "fbclid": fbclid,
                     "platform": platform,
-                    "campaign_id": None,
-                    "adset_id": None,
-                    "ad_id": None,
-                })
-                inserted += 1
-            else:
-                # Actualización ligera de campos no nulos
-                s.execute(_t("""
-                    UPDATE leads_kajabi SET
-                      utm_source = COALESCE(:utm_source, utm_source),
-                      utm_medium = COALESCE(:utm_medium, utm_medium),
-                      utm_campaign = COALESCE(:utm_campaign, utm_campaign),
-                      utm_content = COALESCE(:utm_content, utm_content),
-                      gclid = COALESCE(:gclid, gclid),
-                      fbclid = COALESCE(:fbclid, fbclid),
-                      platform = COALESCE(:platform, platform)
-                    WHERE created_at=:created_at AND (email=:email OR :email IS NULL)
-                """), {
-                    "utm_source": utm_source,
-                    "utm_medium": utm_medium,
-                    "utm_campaign": utm_campaign,
-                    "utm_content": utm_content,
-                    "gclid": gclid,
-                    "fbclid": fbclid,
-                    "platform": platform,
-                    "created_at": created_at,
-                    "email": email,
-                })
-                updated += 1
+                }
+                # Un mismo upsert no puede tocar dos veces la misma fila: los repetidos del
+                # lote se fusionan como lo haría la actualización ligera (no nulos pisan)
+                key = (created_at, email)
+                previous = leads.get(key)
+                if previous is None:
+                    leads[key] = lead
+                else:
+                    previous.update({k: v for k, v in lead.items() if v is not None})
+
+            if not leads:
+                continue
+            with db_session() as s:
+                # Un INSERT ... ON CONFLICT por lote: inserta los nuevos y actualiza los
+                # existentes con los campos no nulos, sin SELECT previo por contacto
+                flags = s.execute(_UPSERT_LEADS, list(leads.values())).scalars().all()
+            batch_inserted = sum(1 for was_inserted in flags if was_inserted)
+            inserted += batch_inserted
+            updated += len(flags) - batch_inserted
 
     if max_seen:
         _set_state(cursor_key, max_seen.isoformat())
@@ -467,7 +467,8 @@ def run_kajabi_leads_sync(days_back: int = 365) -> Dict[str, int]:
     except Exception:
         max_pages = None
 
-    for row in client.iter_contacts(start=start, end=end, max_pages=max_pages):
+    for item in client.iter_contacts(start=start, end=end, max_pages=max_pages, with_custom_fields=True):
+        row = item["contact"]
         detected += 1
         attrs = row.get("attributes") or {}
         cid = str(row.get("id") or "").strip()
@@ -513,12 +514,14 @@ def run_kajabi_leads_sync(days_back: int = 365) -> Dict[str, int]:
             elif k == "fbclid" and not fbclid and val:
                 fbclid = val
 
-        # Si siguen faltando, consulta custom fields por contacto
+        # Si siguen faltando, custom fields del listado o, si no vinieron, por contacto
         if any(x is None for x in (utm_source, utm_medium, utm_campaign, utm_content, gclid, fbclid)):
-            try:
-                cf_map = client.get_contact_custom_fields(cid)
-            except Exception:
-                cf_map = {}
+            cf_map = item["custom_fields"]
+            if cf_map is None:
+                try:
+                    cf_map = client.get_contact_custom_fields(cid)
+                except Exception:
+                    cf_map = {}
             if cf_map:
                 utm_source = utm_source or cf_map.get("utm_source") or cf_map.get("UTM Source")
                 utm_medium = utm_medium or cf_map.get("utm_medium") or cf_map.get("UTM Medium")
@@ -5,8 +5,10 @@ from datetime import datetime
 from decimal import Decimal
 from typing import Dict, Tuple
 
+from sqlalchemy.orm import selectinload
+
 from backend.db.config import db_session
-from backend.db.models import Payment, Refund, Order, Customer, CustomerLTV
+from backend.db.models import Payment, Order, Customer, CustomerLTV
 
 
 # Tipos de cambio de respaldo hacia EUR (aprox.)
@@ -49,6 +51,8 @@ def compute_and_persist_ltv_global() -> dict:
             s.query(Payment, Order, Customer)
             .join(Order, Payment.order_id == Order.id)
             .join(Customer, Order.customer_id == Customer.id)
+            # Reembolsos precargados en una sola SELECT ... IN en lugar de una consulta por pago
+            .options(selectinload(Payment.refunds))
         )
         for pay, order, cust in q:
             if not cust.email:
@@ -66,7 +70,7 @@ def compute_and_persist_ltv_global() -> dict:
 
             # Restar reembolsos
             ref_total_eur = 0.0
-            for rf in s.query(Refund).filter(Refund.payment_id == pay.id):
+            for rf in pay.refunds:
                 ref_total_eur += _to_eur(rf.amount_original_minor, rf.currency_original)
 
             net_eur = max(0.0, amt_eur - ref_total_eur)
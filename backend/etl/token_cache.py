@@ -0,0 +1,125 @@
+"""Caché en disco de access tokens OAuth entre ejecuciones.
+
+Cada ETL es un proceso nuevo: sin esta caché, Google Ads y Hotmart repiten el
+intercambio OAuth en cada arranque aunque el token anterior siga vigente.
+Se guarda {access_token, expires_at} por (proveedor, client_id) en un JSON
+(por defecto ~/.cache/dashboard-phil/tokens.json, o TOKEN_CACHE_PATH), con
+permisos 0600 y bloqueo de fichero entre procesos donde exista fcntl.
+"""
+from __future__ import annotations
+
+import json
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows: solo el lock en proceso
+    fcntl = None
+
+
+# Un token que caduca en menos de este margen se considera caducado
+EXPIRY_MARGIN = timedelta(seconds=60)
+
+_lock = threading.Lock()
+
+
+def _cache_path() -> str:
+    return os.getenv("TOKEN_CACHE_PATH") or os.path.join(
+        os.path.expanduser("~"), ".cache", "dashboard-phil", "tokens.json"
+    )
+
+
+def cache_dir() -> str:
+    """Directorio de la caché; otros datos de descubrimiento por proveedor van junto a tokens.json."""
+    return os.path.dirname(_cache_path())
+
+
+def _key(provider: str, client_id: str) -> str:
+    return f"{provider}:{client_id}"
+
+
+@contextmanager
+def _locked():
+    path = _cache_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with _lock, open(f"{path}.lock", "a") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield path
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _read(path: str) -> Dict[str, Dict[str, str]]:
+    try:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        return data if isinstance(data, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def _write(path: str, data: Dict[str, Dict[str, str]]) -> None:
+    # Escritura atómica (temporal + rename) con permisos 0600: contiene secretos
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tokens.")
+    try:
+        os.chmod(tmp, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def load_token(provider: str, client_id: str) -> Optional[Tuple[str, datetime]]:
+    """(access_token, expires_at UTC) si hay uno guardado que no caduca en EXPIRY_MARGIN."""
+    try:
+        with _locked() as path:
+            entry = _read(path).get(_key(provider, client_id))
+    except OSError:
+        return None
+    if not entry:
+        return None
+    try:
+        token = entry["access_token"]
+        expires_at = datetime.fromisoformat(entry["expires_at"])
+    except (KeyError, TypeError, ValueError):
+        return None
+    if expires_at - datetime.now(timezone.utc) < EXPIRY_MARGIN:
+        return None
+    return token, expires_at
+
+
+def clear_token(provider: str, client_id: str) -> None:
+    """Olvida el token guardado (p.ej. si la API lo rechaza con 401 antes de caducar)."""
+    try:
+        with _locked() as path:
+            data = _read(path)
+            if data.pop(_key(provider, client_id), None) is not None:
+                _write(path, data)
+    except OSError:
+        pass
+
+
+def store_token(provider: str, client_id: str, access_token: str, expires_at: datetime) -> None:
+    """Guarda el token (best effort: un fallo de escritura no interrumpe el ETL)."""
+    if expires_at.tzinfo is None:
+        expires_at = expires_at.replace(tzinfo=timezone.utc)
+    try:
+        with _locked() as path:
+            data = _read(path)
+            data[_key(provider, client_id)] = {
+                "access_token": access_token,
+                "expires_at": expires_at.isoformat(),
+            }
+            _write(path, data)
+    except OSError:
+        pass
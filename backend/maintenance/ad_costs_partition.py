@@ -0,0 +1,71 @@
+from __future__ import annotations
+
+"""Migración única: convierte ad_costs_daily en tabla particionada por mes.
+
+Renombra la tabla actual, crea la nueva (PARTITION BY RANGE (date)) desde el modelo,
+crea las particiones que cubren los datos existentes, copia las filas y elimina la
+tabla antigua. Todo en una transacción; si la tabla ya está particionada no hace nada.
+"""
+
+from typing import Dict
+
+from sqlalchemy import text
+
+from backend.db.config import engine
+from backend.db.models import AdCostsDaily
+from backend.db.partitions import ensure_monthly_partitions
+
+
+_COLUMNS = (
+    "id, date, platform, account_id, campaign_id, adset_id, ad_id, "
+    "currency, cost_major, impressions, clicks"
+)
+
+
+def migrate_ad_costs_partition() -> Dict[str, int]:
+    stats = {"copied": 0, "partitions": 0}
+    with engine.begin() as conn:
+        kind = conn.execute(
+            text("SELECT relkind FROM pg_class WHERE relname = 'ad_costs_daily'")
+        ).scalar()
+        if kind is None:
+            AdCostsDaily.__table__.create(conn)
+            return stats
+        if kind == "p":
+            return stats
+
+        # Liberar nombres (tabla, secuencia, índices y restricciones) para la nueva tabla
+        conn.execute(text("ALTER TABLE ad_costs_daily RENAME TO ad_costs_daily_legacy"))
+        conn.execute(text("ALTER SEQUENCE IF EXISTS ad_costs_daily_id_seq RENAME TO ad_costs_daily_legacy_id_seq"))
+        conn.execute(text("ALTER TABLE ad_costs_daily_legacy DROP CONSTRAINT IF EXISTS ad_costs_daily_pkey"))
+        conn.execute(text("ALTER TABLE ad_costs_daily_legacy DROP CONSTRAINT IF EXISTS uq_ad_costs_daily_dim"))
+        conn.execute(text("DROP INDEX IF EXISTS ix_ad_costs_daily_date"))
+        conn.execute(text("DROP INDEX IF EXISTS ix_ad_costs_daily_dim"))
+
+        AdCostsDaily.__table__.create(conn)
+
+        bounds = conn.execute(
+            text("SELECT MIN(date), MAX(date) FROM ad_costs_daily_legacy")
+        ).first()
+        if bounds and bounds[0] is not None:
+            stats["partitions"] = ensure_monthly_partitions(conn, "ad_costs_daily", bounds[0], bounds[1])
+            res = conn.execute(text(
+                f"INSERT INTO ad_costs_daily ({_COLUMNS}) "
+                f"SELECT {_COLUMNS} FROM ad_costs_daily_legacy "
+                "ON CONFLICT ON CONSTRAINT uq_ad_costs_daily_dim DO NOTHING"
+            ))
+            stats["copied"] = res.rowcount or 0
+            conn.execute(text(
+                "SELECT setval('ad_costs_daily_id_seq', (SELECT MAX(id) FROM ad_costs_daily))"
+            ))
+        conn.execute(text("DROP TABLE ad_costs_daily_legacy"))
+    return stats
+
+
+def main() -> None:
+    res = migrate_ad_costs_partition()
+    print(f"ad_costs_daily particionada: {res}")
+
+
+if __name__ == "__main__":
+    main()
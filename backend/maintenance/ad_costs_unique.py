@@ -0,0 +1,58 @@
+from __future__ import annotations
+
+"""Migración única: clave natural única en ad_costs_daily.
+
+Elimina duplicados por (platform, date, account_id, campaign_id, adset_id, ad_id)
+conservando el registro más reciente, crea la restricción `uq_ad_costs_daily_dim`
+que usa el upsert de ads_sync y borra el índice `ix_ad_costs_daily_dim`, ya cubierto.
+Es idempotente: puede ejecutarse varias veces sin efecto.
+init_db() la aplica al cambiar la huella del esquema.
+"""
+
+from typing import Dict
+
+from sqlalchemy import text
+
+from backend.db.config import engine
+
+
+def migrate_ad_costs_unique() -> Dict[str, int]:
+    stats = {"deleted": 0, "constraint_created": 0}
+    with engine.begin() as conn:
+        exists = conn.execute(
+            text("SELECT 1 FROM pg_constraint WHERE conname = 'uq_ad_costs_daily_dim'")
+        ).first()
+        if not exists:
+            res = conn.execute(text(
+                """
+                DELETE FROM ad_costs_daily a
+                USING ad_costs_daily b
+                WHERE a.id < b.id
+                  AND a.platform = b.platform
+                  AND a.date = b.date
+                  AND a.account_id IS NOT DISTINCT FROM b.account_id
+                  AND a.campaign_id IS NOT DISTINCT FROM b.campaign_id
+                  AND a.adset_id IS NOT DISTINCT FROM b.adset_id
+                  AND a.ad_id IS NOT DISTINCT FROM b.ad_id
+                """
+            ))
+            stats["deleted"] = res.rowcount or 0
+            conn.execute(text(
+                """
+                ALTER TABLE ad_costs_daily
+                ADD CONSTRAINT uq_ad_costs_daily_dim UNIQUE NULLS NOT DISTINCT
+                    (platform, date, account_id, campaign_id, adset_id, ad_id)
+                """
+            ))
+            stats["constraint_created"] = 1
+        conn.execute(text("DROP INDEX IF EXISTS ix_ad_costs_daily_dim"))
+    return stats
+
+
+def main() -> None:
+    res = migrate_ad_costs_unique()
+    print(f"ad_costs_daily migrada: {res}")
+
+
+if __name__ == "__main__":
+    main()
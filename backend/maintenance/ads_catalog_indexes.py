@@ -0,0 +1,47 @@
+from __future__ import annotations
+
+"""Migración única: índices únicos de cobertura en los catálogos de Ads.
+
+Sustituye las UNIQUE (platform, <id>) de ad_campaigns, ad_adsets y ad_ads por índices
+únicos con el mismo nombre e INCLUDE (name, account_id), de modo que la precarga de
+ads_sync se resuelva con index-only scans. Es idempotente.
+"""
+
+from typing import Dict
+
+from sqlalchemy import text
+
+from backend.db.config import engine
+
+
+_CATALOG_INDEXES = (
+    ("ad_campaigns", "campaign_id", "uq_ad_campaign_platform_id"),
+    ("ad_adsets", "adset_id", "uq_adset_platform_id"),
+    ("ad_ads", "ad_id", "uq_ad_platform_id"),
+)
+
+
+def migrate_ads_catalog_indexes() -> Dict[str, int]:
+    stats = {"replaced": 0}
+    with engine.begin() as conn:
+        for table, id_col, name in _CATALOG_INDEXES:
+            has_constraint = conn.execute(
+                text("SELECT 1 FROM pg_constraint WHERE conname = :n"), {"n": name}
+            ).first()
+            if not has_constraint:
+                continue
+            conn.execute(text(f"ALTER TABLE {table} DROP CONSTRAINT {name}"))
+            conn.execute(text(
+                f"CREATE UNIQUE INDEX {name} ON {table} (platform, {id_col}) INCLUDE (name, account_id)"
+            ))
+            stats["replaced"] += 1
+    return stats
+
+
+def main() -> None:
+    res = migrate_ads_catalog_indexes()
+    print(f"Índices de catálogos de Ads: {res}")
+
+
+if __name__ == "__main__":
+    main()
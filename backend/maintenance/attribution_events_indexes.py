@@ -0,0 +1,53 @@
+from __future__ import annotations
+
+"""Migración única: índices de attribution_events para el enlace por transaction_id.
+
+Crea `ix_attrib_events_tx_platform_time` (transaction_id, platform, event_time DESC),
+que resuelve el match exacto de build_attribution_links con un único descenso del
+btree, y elimina `ix_attrib_events_tx` (prefijo suyo) y el índice automático
+`ix_attribution_events_event_time` (duplicado de `ix_attrib_events_time`).
+Usa CREATE/DROP INDEX CONCURRENTLY para no bloquear escrituras. Es idempotente.
+"""
+
+from typing import Dict
+
+from sqlalchemy import text
+
+from backend.db.config import engine
+
+
+_DROPPED = ("ix_attrib_events_tx", "ix_attribution_events_event_time")
+
+
+def migrate_attribution_events_indexes() -> Dict[str, int]:
+    stats = {"created": 0, "dropped": 0}
+    # CONCURRENTLY no admite transacción explícita
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        exists = conn.execute(
+            text("SELECT 1 FROM pg_indexes WHERE indexname = 'ix_attrib_events_tx_platform_time'")
+        ).first()
+        if not exists:
+            conn.execute(text(
+                """
+                CREATE INDEX CONCURRENTLY ix_attrib_events_tx_platform_time
+                    ON attribution_events (transaction_id, platform, event_time DESC)
+                """
+            ))
+            stats["created"] = 1
+        for name in _DROPPED:
+            present = conn.execute(
+                text("SELECT 1 FROM pg_indexes WHERE indexname = :n"), {"n": name}
+            ).first()
+            if present:
+                conn.execute(text(f"DROP INDEX CONCURRENTLY {name}"))
+                stats["dropped"] += 1
+    return stats
+
+
+def main() -> None:
+    res = migrate_attribution_events_indexes()
+    print(f"Índices de attribution_events: {res}")
+
+
+if __name__ == "__main__":
+    main()
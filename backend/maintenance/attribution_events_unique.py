@@ -0,0 +1,55 @@
+from __future__ import annotations
+
+"""Migración única: clave natural única en attribution_events.
+
+Elimina duplicados por (platform, event_name, event_time, coalesce(transaction_id, campaign))
+conservando el registro más reciente y crea el índice único `uq_attrib_events_key`
+contra el que deduplica el insert de attribution_sync.
+Es idempotente: puede ejecutarse varias veces sin efecto.
+init_db() la aplica al cambiar la huella del esquema.
+"""
+
+from typing import Dict
+
+from sqlalchemy import text
+
+from backend.db.config import engine
+
+
+def migrate_attribution_events_unique() -> Dict[str, int]:
+    stats = {"deleted": 0, "index_created": 0}
+    with engine.begin() as conn:
+        exists = conn.execute(
+            text("SELECT 1 FROM pg_indexes WHERE indexname = 'uq_attrib_events_key'")
+        ).first()
+        if not exists:
+            res = conn.execute(text(
+                """
+                DELETE FROM attribution_events a
+                USING attribution_events b
+                WHERE a.id < b.id
+                  AND a.platform = b.platform
+                  AND a.event_name = b.event_name
+                  AND a.event_time = b.event_time
+                  AND coalesce(a.transaction_id, a.campaign, '')
+                      = coalesce(b.transaction_id, b.campaign, '')
+                """
+            ))
+            stats["deleted"] = res.rowcount or 0
+            conn.execute(text(
+                """
+                CREATE UNIQUE INDEX uq_attrib_events_key ON attribution_events
+                    (platform, event_name, event_time, coalesce(transaction_id, campaign, ''))
+                """
+            ))
+            stats["index_created"] = 1
+    return stats
+
+
+def main() -> None:
+    res = migrate_attribution_events_unique()
+    print(f"attribution_events migrada: {res}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+from __future__ import annotations
+
+"""Migración única: clave natural única en ga_sessions_daily.
+
+Elimina duplicados por (date, source, medium, campaign) conservando el registro más
+antiguo (el que actualizaba el sync anterior), crea la restricción
+`uq_ga_sessions_daily_dim` que usa el upsert de ga_sync y borra el índice
+`ix_ga_sessions_dim`, ya cubierto. Es idempotente.
+init_db() la aplica al cambiar la huella del esquema.
+"""
+
+from typing import Dict
+
+from sqlalchemy import text
+
+from backend.db.config import engine
+
+
+def migrate_ga_sessions_unique() -> Dict[str, int]:
+    stats = {"deleted": 0, "constraint_created": 0}
+    with engine.begin() as conn:
+        exists = conn.execute(
+            text("SELECT 1 FROM pg_constraint WHERE conname = 'uq_ga_sessions_daily_dim'")
+        ).first()
+        if not exists:
+            res = conn.execute(text(
+                """
+                DELETE FROM ga_sessions_daily a
+                USING ga_sessions_daily b
+                WHERE a.id > b.id
+                  AND a.date = b.date
+                  AND a.source IS NOT DISTINCT FROM b.source
+                  AND a.medium IS NOT DISTINCT FROM b.medium
+                  AND a.campaign IS NOT DISTINCT FROM b.campaign
+                """
+            ))
+            stats["deleted"] = res.rowcount or 0
+            conn.execute(text(
+                """
+                ALTER TABLE ga_sessions_daily
+                ADD CONSTRAINT uq_ga_sessions_daily_dim UNIQUE NULLS NOT DISTINCT
+                    (date, source, medium, campaign)
+                """
+            ))
+            stats["constraint_created"] = 1
+        conn.execute(text("DROP INDEX IF EXISTS ix_ga_sessions_dim"))
+    return stats
+
+
+def main() -> None:
+    res = migrate_ga_sessions_unique()
+    print(f"ga_sessions_daily migrada: {res}")
+
+
+if __name__ == "__main__":
+    main()
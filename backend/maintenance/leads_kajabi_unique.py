@@ -0,0 +1,82 @@
+from __future__ import annotations
+
+"""Migración única: clave natural única en leads_kajabi.
+
+Fusiona los duplicados por (created_at, email) en el registro más antiguo (los campos
+vacíos se completan con los del duplicado más reciente que los tenga), los elimina y crea
+la restricción `uq_leads_kajabi_created_email` que usa el upsert de kajabi_leads_sync.
+Es idempotente.
+init_db() la aplica al cambiar la huella del esquema.
+"""
+
+from typing import Dict
+
+from sqlalchemy import text
+
+from backend.db.config import engine
+
+
+_MERGED_COLUMNS = (
+    "utm_source", "utm_medium", "utm_campaign", "utm_content",
+    "gclid", "fbclid", "platform", "campaign_id", "adset_id", "ad_id",
+)
+
+
+def migrate_leads_kajabi_unique() -> Dict[str, int]:
+    stats = {"merged": 0, "deleted": 0, "constraint_created": 0}
+    with engine.begin() as conn:
+        exists = conn.execute(
+            text("SELECT 1 FROM pg_constraint WHERE conname = 'uq_leads_kajabi_created_email'")
+        ).first()
+        if not exists:
+            merged_cols = ",\n                    ".join(
+                f"{c} = coalesce(k.{c}, d.{c})" for c in _MERGED_COLUMNS
+            )
+            picked_cols = ",\n                        ".join(
+                f"(array_agg({c} ORDER BY id DESC) FILTER (WHERE {c} IS NOT NULL))[1] AS {c}"
+                for c in _MERGED_COLUMNS
+            )
+            res = conn.execute(text(
+                f"""
+                UPDATE leads_kajabi k SET
+                    {merged_cols}
+                FROM (
+                    SELECT
+                        min(id) AS keep_id,
+                        {picked_cols}
+                    FROM leads_kajabi
+                    GROUP BY created_at, email
+                    HAVING count(*) > 1
+                ) d
+                WHERE k.id = d.keep_id
+                """
+            ))
+            stats["merged"] = res.rowcount or 0
+            res = conn.execute(text(
+                """
+                DELETE FROM leads_kajabi a
+                USING leads_kajabi b
+                WHERE a.id > b.id
+                  AND a.created_at = b.created_at
+                  AND a.email IS NOT DISTINCT FROM b.email
+                """
+            ))
+            stats["deleted"] = res.rowcount or 0
+            conn.execute(text(
+                """
+                ALTER TABLE leads_kajabi
+                ADD CONSTRAINT uq_leads_kajabi_created_email UNIQUE NULLS NOT DISTINCT
+                    (created_at, email)
+                """
+            ))
+            stats["constraint_created"] = 1
+    return stats
+
+
+def main() -> None:
+    res = migrate_leads_kajabi_unique()
+    print(f"leads_kajabi migrada: {res}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+from __future__ import annotations
+
+"""Aplica los `server_default` de los modelos a tablas ya existentes.
+
+`create_all` solo crea tablas nuevas; en una BD previa las columnas created_at/updated_at
+no tienen DEFAULT en el servidor y los INSERT que las omiten fallarían por NOT NULL.
+Es idempotente: SET DEFAULT puede repetirse sin efecto. init_db() lo aplica cuando cambia
+la huella del esquema; este script permite forzarlo.
+"""
+
+from typing import Dict
+
+from sqlalchemy import inspect
+
+from backend.db.config import Base, engine, init_db
+
+
+def apply_server_defaults() -> Dict[str, int]:
+    stats = {"columns": 0}
+    existing = set(inspect(engine).get_table_names())
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing:
+                continue
+            for col in table.columns:
+                if col.server_default is None or col.primary_key:
+                    continue
+                default_sql = str(col.server_default.arg.compile(dialect=engine.dialect))
+                conn.exec_driver_sql(
+                    f'ALTER TABLE "{table.name}" ALTER COLUMN "{col.name}" SET DEFAULT {default_sql}'
+                )
+                stats["columns"] += 1
+    return stats
+
+
+def main() -> None:
+    init_db()
+    res = apply_server_defaults()
+    print(f"Defaults de servidor aplicados: {res}")
+
+
+if __name__ == "__main__":
+    main()
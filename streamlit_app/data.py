@@ -7,7 +7,7 @@ import pandas as pd
 from sqlalchemy import text, inspect as sqla_inspect
 import logging
 
-from backend.db.config import engine, init_db
+from backend.db.config import read_engine as engine, init_db
 from .fx import get_fx_timeseries, FALLBACK_FX_RATES
 from .utils import normalize_series, date_trunc_alias
 
@@ -6,22 +6,25 @@ import streamlit as st
 import plotly.express as px
 import plotly.graph_objects as go
 
-from backend.etl import ga4_client
-
 
 @st.cache_data(ttl=300)
-def _load_pages_screens(start: date, end: date) -> pd.DataFrame:
-    # Evita módulos cacheados sin la función recién añadida
-    if not hasattr(ga4_client, "fetch_pages_screens"):
+def _load_ga4_bundle(start: date, end: date) -> dict:
+    # Un único batchRunReports para los cinco informes de la pestaña. El cliente GA4
+    # (grpc/protobuf) se importa al pedir datos, no al arrancar la app.
+    from backend.etl import ga4_client
+
+    if not hasattr(ga4_client, "fetch_dashboard_bundle"):
         try:
             import importlib
             importlib.reload(ga4_client)  # type: ignore
         except Exception:
             pass
-    fetch_fn = getattr(ga4_client, "fetch_pages_screens", None)
-    if fetch_fn is None:
-        raise AttributeError("backend.etl.ga4_client no expone fetch_pages_screens()")
-    rows = fetch_fn(start, end, limit=1000) or []
+    return ga4_client.fetch_dashboard_bundle(start, end, pages_limit=1000, channels_limit=1000, landing_limit=50)
+
+
+@st.cache_data(ttl=300)
+def _load_pages_screens(start: date, end: date) -> pd.DataFrame:
+    rows = _load_ga4_bundle(start, end)["pages_screens"] or []
     if not rows:
         return pd.DataFrame()
     df = pd.DataFrame(rows)
@@ -39,17 +42,7 @@ def _load_pages_screens(start: date, end: date) -> pd.DataFrame:
 
 @st.cache_data(ttl=300)
 def _load_acquisition_channels(start: date, end: date) -> pd.DataFrame:
-    # Evita módulos cacheados sin la función recién añadida
-    if not hasattr(ga4_client, "fetch_acquisition_channels"):
-        try:
-            import importlib
-            importlib.reload(ga4_client)  # type: ignore
-        except Exception:
-            pass
-    fetch_fn = getattr(ga4_client, "fetch_acquisition_channels", None)
-    if fetch_fn is None:
-        raise AttributeError("backend.etl.ga4_client no expone fetch_acquisition_channels()")
-    rows = fetch_fn(start, end, limit=1000) or []
+    rows = _load_ga4_bundle(start, end)["acquisition_channels"] or []
     if not rows:
         return pd.DataFrame()
     df = pd.DataFrame(rows)
@@ -66,30 +59,12 @@ def _load_acquisition_channels(start: date, end: date) -> pd.DataFrame:
 
 @st.cache_data(ttl=300)
 def _load_funnel_metrics(start: date, end: date) -> dict:
-    if not hasattr(ga4_client, "fetch_funnel_metrics"):
-        try:
-            import importlib
-            importlib.reload(ga4_client)  # type: ignore
-        except Exception:
-            pass
-    fetch_fn = getattr(ga4_client, "fetch_funnel_metrics", None)
-    if fetch_fn is None:
-        return {"sessions": 0, "views": 0, "key_events": 0, "conversion_rate": 0.0}
-    return fetch_fn(start, end) or {"sessions": 0, "views": 0, "key_events": 0, "conversion_rate": 0.0}
+    return _load_ga4_bundle(start, end)["funnel"] or {"sessions": 0, "views": 0, "key_events": 0, "conversion_rate": 0.0}
 
 
 @st.cache_data(ttl=300)
 def _load_trends_daily(start: date, end: date) -> pd.DataFrame:
-    if not hasattr(ga4_client, "fetch_trends_daily"):
-        try:
-            import importlib
-            importlib.reload(ga4_client)  # type: ignore
-        except Exception:
-            pass
-    fetch_fn = getattr(ga4_client, "fetch_trends_daily", None)
-    if fetch_fn is None:
-        return pd.DataFrame()
-    rows = fetch_fn(start, end) or []
+    rows = _load_ga4_bundle(start, end)["trends"] or []
     if not rows:
         return pd.DataFrame()
     df = pd.DataFrame(rows)
@@ -104,16 +79,7 @@ def _load_trends_daily(start: date, end: date) -> pd.DataFrame:
 
 @st.cache_data(ttl=300)
 def _load_landing_pages(start: date, end: date) -> pd.DataFrame:
-    if not hasattr(ga4_client, "fetch_landing_pages"):
-        try:
-            import importlib
-            importlib.reload(ga4_client)  # type: ignore
-        except Exception:
-            pass
-    fetch_fn = getattr(ga4_client, "fetch_landing_pages", None)
-    if fetch_fn is None:
-        return pd.DataFrame()
-    rows = fetch_fn(start, end, limit=50) or []
+    rows = _load_ga4_bundle(start, end)["landing_pages"] or []
     if not rows:
         return pd.DataFrame()
     df = pd.DataFrame(rows)
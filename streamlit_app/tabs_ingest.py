@@ -759,10 +759,9 @@ def render_ingest_tab():
                 st.error(f"No existe la ruta: {p}")
             else:
                 try:
-                    with open(p, "r", encoding="utf-8") as fh:
-                        content = fh.read()
                     from backend.etl.kajabi_csv_leads import process_kajabi_leads_csv
-                    result = process_kajabi_leads_csv(content)
+                    # Se pasa la ruta: el CSV se lee por bloques sin cargarlo entero
+                    result = process_kajabi_leads_csv(p)
                     if result['success']:
                         _add_notice(f"Leads Kajabi: {result['message']} (procesados: {result['processed']}, errores: {result['errors']})")
                         st.success(st.session_state["ingest_notices"][-1])
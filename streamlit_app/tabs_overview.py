@@ -8,7 +8,7 @@ from sqlalchemy import text
 from plotly.subplots import make_subplots
 import plotly.graph_objects as go
 
-from backend.db.config import engine
+from backend.db.config import read_engine as engine
 from .utils import build_color_map
 from .fx import get_fx_timeseries, FALLBACK_FX_RATES
 from .data import load_economics_from_sheets, load_ltv_global, load_sales_global_total
@@ -6,7 +6,7 @@ import streamlit as st
 from sqlalchemy import text
 from datetime import date, timedelta
 
-from backend.db.config import engine
+from backend.db.config import read_engine as engine
 
 
 def render_subs_tab():
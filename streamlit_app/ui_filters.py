@@ -5,7 +5,7 @@ import pandas as pd
 import streamlit as st
 from sqlalchemy import text
 
-from backend.db.config import engine
+from backend.db.config import read_engine as engine
 
 
 def render_filters(default_start: date, default_end: date, key_prefix: str = ""):